@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# bench_batch.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Block ingest against one message per sample, for accelerometers at 100 Hz.
+Every device's samples go through the app both ways, as single messages to
+onAdaptorData and as blocks (one second by default) to onAdaptorBlock, and
+everything posted or left in the buffers is compared. Each case is run
+with NumPy if it is installed and without.
+Reports samples/sec each way and exits non-zero if any output differs.
+With --crossover, times blocks of a range of sizes with and without NumPy
+instead, which is what the thresholds in uwe_filters are set from.
+Usage: python benchmarks/bench_batch.py [devices] [seconds] [block_seconds]
+       python benchmarks/bench_batch.py --crossover
+"""
+import sys
+import json
+import math
+import time
+import random
+import fakecb
+fakecb.install()
+import uwe_app_a
+import uwe_filters
+from uwe_buffer import bufferRecords
+
+RATE = 100
+
+def samples(seconds, seed):
+    """ At rest with a little noise, picked up and moved for a few seconds in every 30 """
+    random.seed(seed)
+    t0 = 1430000000.0
+    times, x, y, z = [], [], [], []
+    for i in range(seconds*RATE):
+        moving = (i // RATE) % 30 < 3
+        amp = 0.3 if moving else 0.0
+        times.append(t0 + float(i)/RATE)
+        x.append(amp*math.sin(i/20.0) + random.gauss(0, 0.004))
+        y.append(amp*math.cos(i/35.0) + random.gauss(0, 0.004))
+        z.append(1.0 + random.gauss(0, 0.004))
+    return times, {"x": x, "y": y, "z": z}
+
+def makeApp(devices, appConfig):
+    uwe_app_a.config.update(journal='False', snapshot='False', sinks='', accel='True',
+                            binary='False', connected='False', accel_compression='deadband',
+                            accel_features='off', accel_aggregate=0, aggregate_variance='False')
+    uwe_app_a.config.update(appConfig)
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(d) for d in range(devices)]
+    app.onConfigureMessage({"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i}
+                                         for i in ids]})
+    for i in ids:
+        app.onAdaptorService({"id": i, "service": [{"characteristic": "acceleration", "interval": 0.01}]})
+    posts = []
+    def post(lane, values, deviceID, ids, first, fresh):
+        posts.append((lane.name, deviceID, values))
+    app.dm.post = post
+    return app, ids, posts
+
+def output(app, posts):
+    left = []
+    for lane in app.dm.lanes:
+        for deviceID in sorted(lane.s):
+            left.append((lane.name, deviceID, bufferRecords(lane.s[deviceID])))
+    return posts, left, dict(app.emitted), app.dm.stored
+
+def perMessage(devices, streams, appConfig):
+    app, ids, posts = makeApp(devices, appConfig)
+    start = time.time()
+    for i, (times, data) in zip(ids, streams):
+        x, y, z = data["x"], data["y"], data["z"]
+        for n in range(len(times)):
+            app.onAdaptorData({"id": i, "characteristic": "acceleration", "timeStamp": times[n],
+                               "data": {"x": x[n], "y": y[n], "z": z[n]}})
+    elapsed = time.time() - start
+    result = output(app, posts)
+    app.dm.stop()
+    return result, elapsed
+
+def blocks(devices, streams, appConfig, size):
+    app, ids, posts = makeApp(devices, appConfig)
+    start = time.time()
+    for i, (times, data) in zip(ids, streams):
+        for n in range(0, len(times), size):
+            app.onAdaptorBlock({"id": i, "characteristic": "acceleration", "timeStamps": times[n:n + size],
+                                "data": dict((k, v[n:n + size]) for k, v in data.items())})
+    elapsed = time.time() - start
+    result = output(app, posts)
+    app.dm.stop()
+    return result, elapsed
+
+CASES = [("deadband", {}),
+         ("swinging_door", {"accel_compression": "swinging_door"}),
+         ("aggregate_1s", {"accel_aggregate": 1, "aggregate_variance": "True"}),
+         ("aggregate_60s", {"accel_aggregate": 60, "aggregate_variance": "True"}),
+         ("features_alongside", {"accel_features": "alongside"}),
+         ("features_and_aggregate", {"accel_features": "alongside", "accel_aggregate": 60})]
+
+def run(devices, seconds, blockSeconds):
+    streams = [samples(seconds, d) for d in range(devices)]
+    total = devices*seconds*RATE
+    results = {"devices": devices, "rate_hz": RATE, "samples": total, "block_samples": blockSeconds*RATE}
+    failures = []
+    numpy = uwe_filters.numpy
+    for name, appConfig in CASES:
+        # Small posts, so that flushes happen part way through blocks
+        appConfig = dict(appConfig, flush_max_points=300)
+        for vectors in ([numpy, None] if numpy is not None else [None]):
+            uwe_filters.numpy = vectors
+            expected, messageTime = perMessage(devices, streams, appConfig)
+            got, blockTime = blocks(devices, streams, appConfig, blockSeconds*RATE)
+            uwe_filters.numpy = numpy
+            key = name if vectors is not None or numpy is None else name + "_pure_python"
+            if got != expected:
+                failures.append(key)
+            results[key] = {"points": expected[3],
+                            "per_message_samples_per_sec": round(total/messageTime),
+                            "block_samples_per_sec": round(total/blockTime),
+                            "speedup": round(messageTime/blockTime, 1)}
+    results["numpy"] = numpy is not None
+    results["failures"] = failures
+    return results
+
+def crossover(devices, seconds):
+    """
+    Block time with NumPy and in plain Python for a range of block sizes,
+    for the stages that have a NumPy form; the NUMPY_MIN_ thresholds in
+    uwe_filters are set from where NumPy starts to win.
+    """
+    streams = [samples(seconds, d) for d in range(devices)]
+    names = ("NUMPY_MIN_SAMPLES", "NUMPY_MIN_WINDOW", "NUMPY_MIN_DEADBAND")
+    saved = [getattr(uwe_filters, n) for n in names]
+    results = {}
+    # The thresholds each case depends on; the others are left as they are
+    for name, varied in (("deadband", names[2:]), ("aggregate_1s", names[:1]), ("features_alongside", names[:2])):
+        appConfig = dict(dict(CASES)[name], flush_max_points=300)
+        results[name] = {}
+        for size in (10, 25, 50, 100, 250, 1000, 5000):
+            times = {}
+            for label, threshold in (("python_ms", 10**9), ("numpy_ms", 1)):
+                for n in varied:
+                    setattr(uwe_filters, n, threshold)
+                times[label] = round(min(blocks(devices, streams, appConfig, size)[1] for i in range(3))*1e3, 1)
+            results[name][size] = times
+        for n, v in zip(names, saved):
+            setattr(uwe_filters, n, v)
+    return results
+
+if __name__ == '__main__':
+    if "--crossover" in sys.argv:
+        if uwe_filters.numpy is None:
+            print("NumPy is not installed")
+            sys.exit(1)
+        print(json.dumps({"benchmark": "batch_crossover", "results": crossover(10, 60)}, indent=2))
+        sys.exit(0)
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    blockSeconds = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    result = run(devices, seconds, blockSeconds)
+    print(json.dumps({"benchmark": "batch", "results": result}, indent=2))
+    sys.exit(1 if result["failures"] else 0)
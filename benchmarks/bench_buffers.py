@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# bench_buffers.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Memory and throughput of the per-device upload buffer: the old list of
+SenML dicts against the columnar SeriesBuffer layout.
+Usage: python benchmarks/bench_buffers.py [readings]
+"""
+import sys
+import time
+import json
+import tracemalloc
+import fakecb
+fakecb.install()
+from uwe_buffer import SeriesBuffer, bufferRecords
+
+def storeDicts(s, deviceID, timeStamp, a):
+    values = [
+              {"n":"accel_x", "v":a[0], "t":timeStamp},
+              {"n":"accel_y", "v":a[1], "t":timeStamp},
+              {"n":"accel_z", "v":a[2], "t":timeStamp}
+             ]
+    if deviceID not in s:
+        s[deviceID] = values
+    else:
+        s[deviceID].extend(values)
+
+def storeColumns(s, deviceID, timeStamp, a):
+    if deviceID not in s:
+        s[deviceID] = {}
+    buffers = s[deviceID]
+    for name, v in (("accel_x", a[0]), ("accel_y", a[1]), ("accel_z", a[2])):
+        if name not in buffers:
+            buffers[name] = SeriesBuffer(name)
+        buffers[name].append(timeStamp, v)
+
+def flushDicts(s):
+    return [json.dumps({"e": v}) for v in s.values()]
+
+def flushColumns(s):
+    return [json.dumps({"e": bufferRecords(b)}) for b in s.values()]
+
+def measure(store, flush, readings, devices):
+    samples = [(0.01*(i % 97), -0.02*(i % 13), 1.0 + 0.001*i) for i in range(1000)]
+    tracemalloc.start()
+    s = {}
+    for i in range(readings):
+        store(s, "dev" + str(i % devices), 1400000000.0 + i, samples[i % 1000])
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    s = {}
+    start = time.time()
+    for i in range(readings):
+        store(s, "dev" + str(i % devices), 1400000000.0 + i, samples[i % 1000])
+    storeTime = time.time() - start
+    start = time.time()
+    flush(s)
+    flushTime = time.time() - start
+    return {"bytes_held": held,
+            "bytes_per_reading": round(float(held)/readings, 1),
+            "store_readings_per_sec": int(readings/storeTime),
+            "flush_readings_per_sec": int(readings/flushTime)}
+
+if __name__ == '__main__':
+    readings = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(json.dumps({"benchmark": "buffers",
+                      "readings": readings,
+                      "list_of_dicts": measure(storeDicts, flushDicts, readings, 50),
+                      "columnar": measure(storeColumns, flushColumns, readings, 50)}, indent=2))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# bench_compression.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Points kept and worst reconstruction error for the min_change deadband
+against swinging-door compression, on synthetic signals and on the
+accelerometer traffic from bench_payload. Exits non-zero if swinging door
+ever exceeds its error bound.
+Usage: python benchmarks/bench_compression.py
+"""
+import sys
+import json
+import math
+import random
+import fakecb
+fakecb.install()
+from uwe_filters import SwingingDoor
+import bench_payload
+
+def signals():
+    random.seed(2)
+    n = 5000
+    yield "slow_drift", 0.2, [(float(i), 20.0 + i*0.0005 + random.gauss(0, 0.02)) for i in range(n)]
+    yield "sine", 0.05, [(float(i), math.sin(i/200.0)) for i in range(n)]
+    yield "steps", 1.0, [(float(i), 100.0*((i // 500) % 3) + random.gauss(0, 0.1)) for i in range(n)]
+    yield "random_walk", 0.5, list(zip(map(float, range(n)), _walk(n)))
+    samples = list(bench_payload.synthetic(3600))
+    for axis in ("x", "y", "z"):
+        yield "accel_" + axis, 0.02, [(s["t"], s[axis]) for s in samples]
+
+def _walk(n):
+    v = 0.0
+    for i in range(n):
+        v += random.gauss(0, 0.1)
+        yield v
+
+def deadband(series, minChange):
+    kept = []
+    previous = None
+    for t, v in series:
+        if previous is None or abs(v - previous) >= minChange:
+            kept.append((t, v))
+            previous = v
+    return kept
+
+def swingingDoor(series, maxError):
+    door = SwingingDoor(maxError)
+    kept = []
+    for t, v in series:
+        p = door.update(t, v)
+        if p is not None:
+            kept.append(p)
+    p = door.flush()
+    if p is not None:
+        kept.append(p)
+    return kept
+
+def holdError(series, kept):
+    """ Error when each kept value is held until the next one """
+    err = 0.0
+    k = 0
+    for t, v in series:
+        while k + 1 < len(kept) and kept[k+1][0] <= t:
+            k += 1
+        err = max(err, abs(v - kept[k][1]))
+    return err
+
+def interpolationError(series, kept):
+    """ Error when kept points are joined by straight lines """
+    err = 0.0
+    k = 0
+    for t, v in series:
+        while k + 1 < len(kept) and kept[k+1][0] < t:
+            k += 1
+        if k + 1 < len(kept):
+            (t0, v0), (t1, v1) = kept[k], kept[k+1]
+            est = v0 + (v1 - v0)*(t - t0)/(t1 - t0) if t1 > t0 else v0
+        else:
+            est = kept[k][1]
+        err = max(err, abs(v - est))
+    return err
+
+if __name__ == '__main__':
+    results = []
+    ok = True
+    for name, bound, series in signals():
+        db = deadband(series, bound)
+        sd = swingingDoor(series, bound)
+        sdError = interpolationError(series, sd)
+        ok = ok and sdError <= bound*(1 + 1e-9)
+        results.append({"signal": name,
+                        "samples": len(series),
+                        "bound": bound,
+                        "deadband_points": len(db),
+                        "deadband_max_error": round(holdError(series, db), 4),
+                        "swinging_door_points": len(sd),
+                        "swinging_door_max_error": round(sdError, 4),
+                        "swinging_door_ratio": round(float(len(series))/len(sd), 1)})
+    print(json.dumps({"benchmark": "compression", "within_bound": ok, "results": results}, indent=2))
+    sys.exit(0 if ok else 1)
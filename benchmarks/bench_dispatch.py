@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# bench_dispatch.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Per-message cost of App.onAdaptorData as the number of devices grows.
+The DataManager is replaced by a no-op so only dispatch and filtering are timed.
+Usage: python benchmarks/bench_dispatch.py [messages]
+"""
+import sys
+import time
+import json
+import fakecb
+fakecb.install()
+import uwe_app_a
+
+class NullDataManager(object):
+    def __init__(self):
+        self.stored = 0
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+def makeApp(devices):
+    app = uwe_app_a.App([])
+    adaptors = [{"id": "ADT" + str(d), "name": "SensorTag",
+                 "friendly_name": "tag " + str(d)} for d in range(devices)]
+    app.onConfigureMessage({"adaptors": adaptors})
+    app.dm = NullDataManager()
+    for a in adaptors:
+        app.onAdaptorService({"id": a["id"],
+                              "service": [{"characteristic": "acceleration", "interval": 1.0},
+                                          {"characteristic": "binary_sensor", "interval": 0},
+                                          {"characteristic": "connected", "interval": 0}]})
+    return app
+
+def run(devices, messages):
+    app = makeApp(devices)
+    msgs = []
+    for m in range(1000):
+        # Worst case for the old linear scan: the last device configured
+        d = devices - 1 - (m % min(devices, 10))
+        msgs.append({"id": "ADT" + str(d), "characteristic": "acceleration",
+                     "timeStamp": float(m), "data": {"x": m % 3, "y": 0.0, "z": 1.0}})
+    start = time.time()
+    for i in range(messages):
+        app.onAdaptorData(msgs[i % 1000])
+    elapsed = time.time() - start
+    return elapsed / messages * 1e6
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    results = []
+    for devices in (1, 10, 50, 100, 250, 500):
+        results.append({"devices": devices, "us_per_message": round(run(devices, messages), 3)})
+    print(json.dumps({"benchmark": "dispatch", "results": results}, indent=2))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# bench_features.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Cost and point reduction of accelerometer motion features against raw
+points and the min_change deadband, at 10 Hz from many devices. Only the
+stages are timed; points go to a counter rather than a DataManager.
+Usage: python benchmarks/bench_features.py [devices] [seconds]
+"""
+import sys
+import json
+import math
+import time
+import random
+import fakecb
+fakecb.install()
+from uwe_filters import MotionFeatures
+
+RATE = 10
+
+class CountingDataManager(object):
+    def __init__(self):
+        self.points = 0
+
+    def storeValue(self, deviceID, name, timeStamp, v):
+        self.points += 1
+
+def samples(seconds):
+    """ Still, with short bursts of movement, at RATE Hz """
+    random.seed(4)
+    t = 1430000000.0
+    for i in range(seconds*RATE):
+        moving = (i // (60*RATE)) % 5 == 0
+        amp = 0.4 if moving else 0.0
+        yield t + float(i)/RATE, (amp*math.sin(i/30.0) + random.gauss(0, 0.01),
+                                  amp*math.cos(i/50.0) + random.gauss(0, 0.01),
+                                  1.0 + random.gauss(0, 0.01))
+
+def deadband(dm, deviceID, stream, minChange):
+    previous = [0.0, 0.0, 0.0]
+    for t, a in stream:
+        if any(abs(a[i] - previous[i]) > minChange for i in range(3)):
+            for n, v in zip(("accel_x", "accel_y", "accel_z"), a):
+                dm.storeValue(deviceID, n, t, v)
+            previous = a
+
+def features(dm, deviceID, stream, minChange):
+    stage = MotionFeatures("accel", 10.0, 5.0, 2.5*minChange, minChange)
+    for t, a in stream:
+        stage.update(dm, deviceID, t, a)
+
+def run(devices, seconds):
+    stream = list(samples(seconds))
+    results = {"devices": devices, "seconds": seconds, "rate_hz": RATE,
+               "samples": devices*len(stream), "raw_points": 3*devices*len(stream)}
+    for name, fn in (("deadband", deadband), ("features", features)):
+        dm = CountingDataManager()
+        start = time.time()
+        for d in range(devices):
+            fn(dm, "dev" + str(d), stream, 0.02)
+        elapsed = time.time() - start
+        results[name] = {"points": dm.points,
+                         "reduction_vs_raw": round(results["raw_points"]/float(dm.points), 1),
+                         "us_per_sample": round(elapsed/results["samples"]*1e6, 3),
+                         "cpu_fraction_at_rate": round(elapsed/seconds, 4)}
+    return results
+
+if __name__ == '__main__':
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    print(json.dumps({"benchmark": "features", "results": run(devices, seconds)}, indent=2))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# bench_ingest.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Stress test of the thread-to-reactor ingest queue. Many producer threads,
+standing in for cbcommslib, call App.onAdaptorData as fast as they can
+while the reactor runs. Every temperature reading passes its filter, so
+each message that was not dropped must be stored exactly once, in order.
+Runs once with the configured queue and once with a small queue that
+producers do not wait on, so that drops happen and are counted. Reports
+messages/sec, reactor wakeups, drain batches and the queue counters; exits
+non-zero if a check fails.
+Usage: python benchmarks/bench_ingest.py [threads] [messages_per_thread]
+"""
+import sys
+import json
+import time
+import fakecb
+fakecb.install()
+from twisted.internet import reactor, defer, threads
+import uwe_app_a
+
+def scenario(name, producers, messages, appConfig):
+    uwe_app_a.config.update(journal='False', snapshot='False', sinks='', temperature='True',
+                            temp_min_change=0, history_size=messages)
+    uwe_app_a.config.update(appConfig)
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(p) for p in range(producers)]
+    app.onConfigureMessage({"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i}
+                                         for i in ids]})
+    for i in ids:
+        app.onAdaptorService({"id": i, "service": [{"characteristic": "temperature", "interval": 1.0}]})
+
+    def produce(adtID):
+        for m in range(messages):
+            app.onAdaptorData({"id": adtID, "characteristic": "temperature",
+                               "timeStamp": 1000.0 + m, "data": float(m)})
+
+    start = time.time()
+    d = defer.DeferredList([threads.deferToThread(produce, i) for i in ids])
+    d.addCallback(lambda _: wait(app))
+
+    def wait(app):
+        # Let the reactor drain whatever is still queued
+        done = defer.Deferred()
+        def check():
+            if app.ingest.queue:
+                reactor.callLater(0.01, check)
+            else:
+                done.callback(None)
+        check()
+        return done
+
+    def report(_):
+        elapsed = time.time() - start
+        ingest = app.ingest
+        produced = producers*messages
+        processed = sum(app.received.values())
+        failures = []
+        if processed + ingest.dropped != produced:
+            failures.append("%s processed + %s dropped != %s produced" % (processed, ingest.dropped, produced))
+        if app.dm.stored != processed:
+            failures.append("%s stored != %s processed" % (app.dm.stored, processed))
+        for i in ids:
+            ring = app.dm.history.devices.get("tag_" + i, {}).get("temperature")
+            times = ring.range(float("-inf"), float("inf")) if ring else []
+            if any(b[0] <= a[0] for a, b in zip(times, times[1:])):
+                failures.append("readings of %s out of order" % i)
+        app.dm.stop()
+        return {"scenario": name,
+                "threads": producers,
+                "produced": produced,
+                "processed": processed,
+                "dropped": ingest.dropped,
+                "blocked": ingest.blocked,
+                "wakeups": ingest.wakeups,
+                "drains": ingest.drains,
+                "messages_per_drain": round(processed/float(max(1, ingest.drains)), 1),
+                "messages_per_sec": round(produced/elapsed),
+                "failures": failures}
+    return d.addCallback(report)
+
+@defer.inlineCallbacks
+def main(producers, messages, results):
+    reactor.suggestThreadPoolSize(producers)
+    try:
+        results.append((yield scenario("default", producers, messages, {})))
+        results.append((yield scenario("small_queue", producers, messages,
+                                       {"ingest_max_queue": 256, "ingest_batch": 64, "ingest_block": 0.0})))
+    finally:
+        reactor.stop()
+
+if __name__ == '__main__':
+    producers = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    results = []
+    reactor.callWhenRunning(main, producers, messages, results)
+    reactor.run()
+    print(json.dumps({"benchmark": "ingest", "results": results}, indent=2))
+    sys.exit(1 if len(results) != 2 or [r for r in results if r["failures"]] else 0)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# bench_outage.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Upload behaviour through a Geras outage. The stand-in fails, hangs or
+responds slowly for the first outage seconds and then recovers. Reports
+how many requests were attempted during the outage and whether every
+reading arrived exactly once afterwards. In quiet mode a few door events
+are journalled during the outage and none follow it; the journal must
+still drain once Geras is back.
+Usage: python benchmarks/bench_outage.py [fail|hang|slow|quiet] [outage seconds]
+"""
+import sys
+import json
+import shutil
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor
+import uwe_app_a
+import geras_standin
+
+def run(mode, outage, devices=5, rate=2.0, seconds=20):
+    standin, port = geras_standin.listen(mode=mode, delay=outage)
+    uwe_app_a.config.update(upload_timeout=2.0, backoff_initial=1.0,
+                            geras_url="http://127.0.0.1:%d/series/" % port.getHost().port)
+    dm = uwe_app_a.DataManager("BID1")
+    sent = [0]
+    def readings(i):
+        for d in range(devices):
+            dm.storeTemp("dev" + str(d), 1430000000.0 + i, float(i))
+            sent[0] += 1
+    for i in range(int(seconds*rate)):
+        reactor.callLater(i/rate, readings, i)
+    result = {"mode": mode, "outage_seconds": outage}
+    def recover():
+        result["attempts_during_outage"] = standin.attempts
+        result["breaker_opened"] = dm.bulkLane.breaker.opened
+        standin.mode = "ok"
+    reactor.callLater(outage, recover)
+    def finish():
+        unique = set()
+        for t, path, values in standin.received:
+            for v in values:
+                unique.add((path, v["n"], v["t"]))
+        result["readings"] = sent[0]
+        result["received"] = standin.records
+        result["unique_received"] = len(unique)
+        result["requests_total"] = standin.attempts
+        result["uploader"] = dm.bulkLane.uploader.stats.summary()
+        reactor.stop()
+    reactor.callLater(seconds + outage + 10, finish)
+    reactor.run()
+    return result
+
+def quiet(outage, events=3):
+    standin, port = geras_standin.listen(mode="fail")
+    uwe_app_a.config.update(upload_timeout=1.0, backoff_initial=0.5, backoff_max=2.0, flush_max_age=1.0,
+                            journal_file=configDir + "outage.journal", journal_commit_interval=0.1,
+                            journal_drain_interval=0.2,
+                            geras_url="http://127.0.0.1:%d/series/" % port.getHost().port)
+    dm = uwe_app_a.DataManager("BID1")
+    for i in range(events):
+        reactor.callLater(i*1.5, dm.storeBinary, "dev0", 1430000000.0 + i, 1)
+    result = {"mode": "quiet", "outage_seconds": outage, "events": events}
+    def recover():
+        result["journal_batches_at_recovery"] = len(dm.journal)
+        standin.mode = "ok"
+    reactor.callLater(outage, recover)
+    def finish():
+        result.update(received=standin.records, journal_batches=len(dm.journal),
+                      breaker=dm.eventLane.breaker.state)
+        reactor.stop()
+    reactor.callLater(outage + 10, finish)
+    reactor.run()
+    return result
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else "fail"
+    outage = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    result = quiet(outage) if mode == "quiet" else run(mode, outage)
+    shutil.rmtree(configDir, ignore_errors=True)
+    print(json.dumps({"benchmark": "outage", "results": result}, indent=2))
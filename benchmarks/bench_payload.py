@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# bench_payload.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Upload payload bytes for accelerometer traffic: legacy SenML against
+compact SenML, with and without gzip, at several batch sizes.
+Traffic is a SensorTag at 1 Hz, mostly still with bursts of motion,
+passed through the accel_min_change deadband, or read from a recording
+of JSON lines {"t":..., "x":..., "y":..., "z":...} given as argument.
+Usage: python benchmarks/bench_payload.py [recording]
+"""
+import sys
+import json
+import math
+import random
+import fakecb
+fakecb.install()
+import uwe_senml
+
+def synthetic(seconds):
+    random.seed(1)
+    t = 1430000000.0
+    for i in range(seconds):
+        moving = (i // 60) % 5 == 0
+        amp = 0.4 if moving else 0.0
+        yield {"t": t + i + random.random()*0.01,
+               "x": round(amp*math.sin(i/3.0) + random.gauss(0, 0.01), 6),
+               "y": round(amp*math.cos(i/5.0) + random.gauss(0, 0.01), 6),
+               "z": round(1.0 + random.gauss(0, 0.01), 6)}
+
+def deadband(samples, minChange):
+    previous = [0.0, 0.0, 0.0]
+    records = []
+    for s in samples:
+        a = [s["x"], s["y"], s["z"]]
+        if any(abs(a[i] - previous[i]) > minChange for i in range(3)):
+            for i, n in enumerate(("accel_x", "accel_y", "accel_z")):
+                records.append({"n": n, "v": a[i], "t": s["t"]})
+            previous = a
+    return records
+
+def payloadBytes(records, batch, encoder):
+    total = 0
+    for i in range(0, len(records), batch):
+        body, headers = encoder.encode(records[i:i+batch])
+        total += len(body)
+    return total
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        samples = [json.loads(l) for l in open(sys.argv[1])]
+    else:
+        samples = list(synthetic(3600))
+    records = deadband(samples, 0.02)
+    encoders = {"legacy": uwe_senml.Encoder("legacy"),
+                "legacy_gzip": uwe_senml.Encoder("legacy", True),
+                "compact": uwe_senml.Encoder("compact"),
+                "compact_gzip": uwe_senml.Encoder("compact", True)}
+    results = []
+    for batch in (3, 30, 300, 3000):
+        row = {"records_per_post": batch}
+        for name, encoder in encoders.items():
+            row[name] = payloadBytes(records, batch, encoder)
+        row["compact_gzip_ratio"] = round(float(row["legacy"])/row["compact_gzip"], 2)
+        results.append(row)
+    print(json.dumps({"benchmark": "payload", "samples": len(samples),
+                      "records": len(records), "results": results}, indent=2))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# bench_profile.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Cost of on-demand profiling. A fleet of accelerometers and temperature
+sensors is driven through App as fast as the reactor allows, uploading to
+the Geras stand-in through the pool uploader's threads and to the file
+sink. Runs with profiling never started, after it has been started and
+stopped (nothing may be left installed), and with each part on, started
+and stopped by concentrator messages. Reports the best messages/sec of
+three runs and the overhead against the first, and checks the profile files: folded
+stacks of the reactor thread, and reports that time every stage or list
+allocation sites. Exits non-zero if a check fails.
+Usage: python benchmarks/bench_profile.py [messages] [devices]
+"""
+import os
+import sys
+import json
+import math
+import time
+import subprocess
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor, defer
+import uwe_app_a
+import uwe_profile
+import geras_standin
+
+REPORT_INTERVAL = 2.0
+STAGES = ("dispatch", "filter", "store", "serialize", "upload")
+
+def left(app):
+    """ Anything profiling left installed """
+    dm = app.dm
+    found = []
+    if app.ingest.process != app.processAdaptorData:
+        found.append("dispatch")
+    if [h for h in app.handlers.values() if hasattr(h, "untimed")]:
+        found.append("filter")
+    if "storeValue" in dm.__dict__ or "storeRows" in dm.__dict__:
+        found.append("store")
+    if [e for e in [dm.encoder] + [sink.encoder for sink in dm.sinks] if "encode" in e.__dict__]:
+        found.append("serialize")
+    if [lane for lane in dm.lanes if "post" in lane.uploader.__dict__]:
+        found.append("upload")
+    if app.profiler.sampler is not None or [t for t in uwe_profile.threading.enumerate() if t.name == "uwe_profile"]:
+        found.append("sampler")
+    if uwe_profile.tracemalloc is not None and uwe_profile.tracemalloc.is_tracing():
+        found.append("tracemalloc")
+    return found
+
+def control(app, action, **kwargs):
+    req = dict(kwargs, resp="profile", action=action, ref=action)
+    app.onConcMessage(req)
+    return app.sent[-1][1]["body"]["profiling"]
+
+@defer.inlineCallbacks
+def scenario(name, messages, devices, port, profile=None, startStop=False):
+    path = configDir + name + ".profile"
+    uwe_app_a.config.update(sinks="geras,file", uploader="pool", journal='False', snapshot='False',
+                            temperature='True', temp_min_change=0.05, file_sink_dir=configDir + name,
+                            geras_url="http://127.0.0.1:%d/series/" % port, profile_file=path,
+                            profile_report_interval=REPORT_INTERVAL)
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(d) for d in range(devices)]
+    app.onConfigureMessage({"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i}
+                                         for i in ids]})
+    for i in ids:
+        app.onAdaptorService({"id": i, "service": [{"characteristic": c, "interval": 1.0}
+                                                   for c in ("acceleration", "temperature")]})
+    result = {"scenario": name, "messages": messages}
+    if startStop:
+        control(app, "start", cpu=True, memory=True, stages=True)
+        control(app, "stop")
+        result["left_installed"] = left(app)
+    if profile is not None:
+        result["status"] = control(app, "start", **profile)
+    start = time.time()
+    sent = 0
+    while sent < messages:
+        for n in range(sent, min(messages, sent + 2000)):
+            d = n % devices
+            t = 1430000000.0 + n//devices*0.1
+            if n % 5:
+                app.onAdaptorData({"id": ids[d], "characteristic": "acceleration", "timeStamp": t,
+                                   "data": {"x": 0.3*math.sin(n/7.0), "y": (n % 11)*0.01, "z": 1.0}})
+            else:
+                app.onAdaptorData({"id": ids[d], "characteristic": "temperature", "timeStamp": t,
+                                   "data": 20.0 + math.sin(n/50.0)})
+        sent = min(messages, sent + 2000)
+        # Let flushes, uploads and reports run in between
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        yield d
+    elapsed = time.time() - start
+    result["messages_per_sec"] = round(messages/elapsed)
+    if profile is not None:
+        status = control(app, "stop")
+        result["reports"] = status["reports"]
+        result["left_installed"] = left(app)
+        result.update(readProfile(path))
+    app.dm.stop()
+    app.dm.bulkLane.uploader.stop()
+    app.dm.eventLane.uploader.stop()
+    return result
+
+def readProfile(path):
+    threads = set()
+    stacks = 0
+    with open(path + ".folded") as f:
+        for line in f:
+            stack, count = line.rsplit(" ", 1)
+            int(count)
+            threads.add(stack.split(";", 1)[0])
+            stacks += 1
+    stages = dict((s, 0) for s in STAGES)
+    sites = 0
+    with open(path + ".jsonl") as f:
+        for line in f:
+            report = json.loads(line)
+            for s, v in report.get("stages", {}).items():
+                stages[s] += v["count"]
+            sites = max(sites, len(report.get("memory", {}).get("top", [])))
+    return {"threads": sorted(threads), "stacks": stacks, "stage_counts": stages, "memory_sites": sites}
+
+def run(name, messages, devices, profile, startStop, results):
+    @defer.inlineCallbacks
+    def go():
+        standin, port = geras_standin.listen()
+        try:
+            results.append((yield scenario(name, messages, devices, port.getHost().port, profile, startStop)))
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(go)
+    reactor.run()
+
+def child(args):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"] + args)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+# tracemalloc is much slower, so the memory run is shorter
+RUNS = [("off", None, False, 1),
+        ("after_stop", None, True, 1),
+        ("cpu", {"cpu": True, "memory": False, "stages": False}, False, 1),
+        ("stages", {"cpu": False, "memory": False, "stages": True}, False, 1),
+        ("cpu_and_stages", {"cpu": True, "memory": False, "stages": True}, False, 1),
+        ("memory", {"cpu": False, "memory": True, "stages": False}, False, 10)]
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        name, messages, devices = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        results = []
+        for n, profile, startStop, divisor in RUNS:
+            if n == name:
+                run(name, messages//divisor, devices, profile, startStop, results)
+        print(json.dumps(results[0]))
+        sys.exit(0)
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    results = []
+    failures = []
+    # Each run in a process of its own, so that one does not slow the next
+    for name, profile, startStop, divisor in RUNS:
+        # Best of three, as throughput on a shared box varies from run to run
+        r = max([child([name, str(messages), str(devices)]) for i in range(1 if profile and profile["memory"] else 3)],
+                key=lambda r: r["messages_per_sec"])
+        results.append(r)
+        if name == "off":
+            base = r["messages_per_sec"]
+            continue
+        r["overhead_pct"] = round((base/float(r["messages_per_sec"]) - 1)*100, 1)
+        if r["left_installed"]:
+            failures.append("%s left %s installed" % (name, r["left_installed"]))
+        if profile and profile["cpu"] and "reactor" not in r["threads"]:
+            failures.append("%s has no reactor stacks" % name)
+        if profile and profile["stages"] and [s for s in STAGES if not r["stage_counts"][s]]:
+            failures.append("%s stages %s" % (name, r["stage_counts"]))
+        if profile and profile["memory"] and uwe_profile.tracemalloc and not r["memory_sites"]:
+            failures.append("%s has no allocation sites" % name)
+    print(json.dumps({"benchmark": "profile", "results": results, "failures": failures}, indent=2))
+    sys.exit(1 if failures else 0)
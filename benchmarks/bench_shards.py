@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# bench_shards.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Sharded ingest. Throughput of a fleet of accelerometers, with the swinging
+door and motion features on, in one process and with 1, 2 and 4 worker
+shards; uploads are off so that only filtering and routing are measured.
+Then a restart check: with Geras down, readings of 2 shards spill to their
+journals, one worker is killed, readings keep arriving while it is down,
+and once Geras is back every reading must arrive exactly once. Last, history
+and profile requests must each get one answer covering both shards.
+Each run is a separate process, as a reactor cannot be restarted.
+Usage: python benchmarks/bench_shards.py [messages]
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor, task
+import uwe_app_a
+import uwe_shards
+import geras_standin
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+uwe_shards.WORKER_COMMAND = [sys.executable, os.path.join(HERE, "shard_worker.py")]
+
+def fleet(app, ids, characteristic):
+    app.onConfigureMessage({"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i}
+                                         for i in ids]})
+    for i in ids:
+        app.onAdaptorService({"id": i, "service": [{"characteristic": characteristic, "interval": 1.0}]})
+
+def received(app, characteristic):
+    if app.router:
+        return app.router.snapshot()["received"].get(characteristic, 0)
+    return app.received[characteristic]
+
+def whenTrue(condition, then, timeout, every=0.05):
+    deadline = time.time() + timeout
+    def check():
+        if condition() or time.time() > deadline:
+            then()
+        else:
+            reactor.callLater(every, check)
+    check()
+
+def scale(shards, messages, devices=64):
+    uwe_app_a.config.update(shards=shards, shard_report_interval=0.1, sinks='', journal='False',
+                            snapshot='False', accel_compression='swinging_door', accel_features='alongside')
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(d) for d in range(devices)]
+    fleet(app, ids, "acceleration")
+    result = {"shards": shards, "messages": messages}
+
+    def feed():
+        start = time.time()
+        sent = [0]
+        def chunk():
+            for n in range(sent[0], min(messages, sent[0] + 2000)):
+                app.onAdaptorData({"id": ids[n % devices], "characteristic": "acceleration",
+                                   "timeStamp": 1430000000.0 + n//devices*0.01,
+                                   "data": {"x": (n % 7)*0.01, "y": 0.0, "z": 1.0}})
+            sent[0] = min(messages, sent[0] + 2000)
+            if sent[0] < messages:
+                reactor.callLater(0, chunk)
+        chunk()
+        def done():
+            elapsed = time.time() - start
+            result["received"] = received(app, "acceleration")
+            result["seconds"] = round(elapsed, 3)
+            result["messages_per_sec"] = round(result["received"]/elapsed)
+            reactor.stop()
+        whenTrue(lambda: received(app, "acceleration") >= messages, done, 120, 0.01)
+    if shards:
+        whenTrue(lambda: len(app.router.reports) == shards, feed, 30)
+    else:
+        reactor.callLater(0, feed)
+    reactor.run()
+    return result
+
+def restart(devices=8, rate=10.0):
+    standin, port = geras_standin.listen(mode="fail")
+    uwe_app_a.config.update(shards=2, shard_report_interval=0.1, temperature='True', temp_min_change=0,
+                            accel='False', binary='False', connected='False', snapshot='False',
+                            journal_file=configDir + "bench.journal", flush_max_age=1.0,
+                            upload_timeout=1.0, backoff_initial=0.5, backoff_max=2.0,
+                            geras_url="http://127.0.0.1:%d/series/" % port.getHost().port)
+    app = uwe_app_a.App([])
+    router = app.router
+    ids = ["ADT" + str(d) for d in range(devices)]
+    fleet(app, ids, "temperature")
+    assignment = [router.shard(i) for i in ids]
+    sent = [0]
+    result = {}
+    def readings(seconds):
+        loop = task.LoopingCall(send)
+        loop.start(1.0/rate, now=False)
+        reactor.callLater(seconds, loop.stop)
+    def send():
+        for i in ids:
+            app.onAdaptorData({"id": i, "characteristic": "temperature",
+                               "timeStamp": 1430000000.0 + sent[0], "data": float(sent[0])})
+            sent[0] += 1
+
+    def gauges(shard):
+        return router.reports.get(shard, {}).get("gauges", {})
+    def spilled():
+        g = gauges(0)
+        return g.get("buffer_points") == 0 and g.get("journal_batches", 0) > 0
+    def kill():
+        result["journal_batches_before_kill"] = gauges(0).get("journal_batches")
+        router.workers[0].transport.signalProcess("KILL")
+        # Readings keep coming while the worker is down and restarting
+        readings(1.0)
+        whenTrue(lambda: router.metrics.counters["shard_restarts"] == 1 and 0 in router.reports
+                 and router.reports[0]["uptime"] < 1.0, recover, 30)
+    def recover():
+        # Adaptors added: the existing ones must stay on their shards
+        fleet(app, ids + ["ADT" + str(d) for d in range(devices, devices + 8)], "temperature")
+        result["assignment_stable"] = [router.shard(i) for i in ids] == assignment
+        standin.mode = "ok"
+        # Journals drain once new readings have closed each shard's breaker again
+        readings(2.0)
+        reactor.callLater(2.5, whenTrue, lambda: unique()[1] >= sent[0], finish, 30)
+    def unique():
+        seen = set()
+        total = 0
+        for t, path, values in standin.received:
+            for v in values:
+                seen.add((path, v["n"], v["t"]))
+                total += 1
+        return total, len(seen)
+    def finish():
+        total, seen = unique()
+        result.update(readings=sent[0], received=total, unique=seen,
+                      restarts=router.metrics.counters["shard_restarts"],
+                      shards_reporting=sorted(router.reports))
+        reactor.stop()
+    def begin():
+        readings(3.0)
+        reactor.callLater(3.0, whenTrue, spilled, kill, 30)
+    whenTrue(lambda: len(router.reports) == 2, begin, 30)
+    reactor.run()
+    return result
+
+def replies(devices=8):
+    """ History and profile requests get one answer from the router, whatever the number of shards """
+    uwe_app_a.config.update(shards=2, shard_report_interval=0.1, temperature='True', temp_min_change=0,
+                            accel='False', binary='False', connected='False', snapshot='False',
+                            sinks='', journal='False')
+    app = uwe_app_a.App([])
+    router = app.router
+    ids = ["ADT" + str(d) for d in range(devices)]
+    fleet(app, ids, "temperature")
+    result = {}
+    def answers(kind):
+        return [m["body"] for dest, m in app.sent if dest == "conc" and m["body"]["msg"] == kind]
+    def send():
+        for i in ids:
+            app.onAdaptorData({"id": i, "characteristic": "temperature",
+                               "timeStamp": 1430000000.0, "data": 20.0})
+        whenTrue(lambda: received(app, "temperature") >= devices, ask, 30)
+    def ask():
+        app.sent = []
+        app.onConcMessage({"resp": "history", "ref": 1})
+        app.onConcMessage({"resp": "history", "ref": 2, "device": app.idToName[ids[0]]})
+        app.onConcMessage({"resp": "profile", "ref": 3})
+        whenTrue(lambda: not router.queries, finish, 30)
+    def finish():
+        history = answers("history")
+        profile = answers("profile")
+        byRef = dict((h["ref"], h) for h in history)
+        result.update(history_answers=len(history), profile_answers=len(profile),
+                      all_devices=len(byRef[1]["devices"]) if 1 in byRef else 0,
+                      one_device=len(byRef[2]["devices"]) if 2 in byRef else 0,
+                      profile_shards=sorted(profile[0]["profiling"]["shards"]) if profile else [],
+                      timeouts=router.metrics.counters.get("shard_reply_timeouts", 0))
+        reactor.stop()
+    whenTrue(lambda: len(router.reports) == 2, send, 30)
+    reactor.run()
+    return result
+
+def child(args):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"] + args)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        if sys.argv[2] == "scale":
+            result = scale(int(sys.argv[3]), int(sys.argv[4]))
+        elif sys.argv[2] == "replies":
+            result = replies()
+        else:
+            result = restart()
+        print(json.dumps(result))
+        sys.exit(0)
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    results = {"cpus": os.cpu_count() if hasattr(os, "cpu_count") else None, "scaling": []}
+    for shards in (0, 1, 2, 4):
+        results["scaling"].append(child(["scale", str(shards), str(messages)]))
+    base = results["scaling"][0]["messages_per_sec"]
+    for r in results["scaling"]:
+        r["vs_one_process"] = round(r["messages_per_sec"]/float(base), 2)
+    results["restart"] = r = child(["restart"])
+    ok = r.get("unique") == r.get("readings") and r.get("restarts") == 1 and r.get("assignment_stable")
+    results["replies"] = r = child(["replies"])
+    ok = ok and r == {"history_answers": 2, "profile_answers": 1, "all_devices": 8, "one_device": 1,
+                      "profile_shards": ["shard0", "shard1"], "timeouts": 0}
+    print(json.dumps({"benchmark": "shards", "results": results}, indent=2))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# bench_sinks.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Fan-out to Geras, the file sink and a broker, all offline. Geras fails for
+the first outage seconds and the broker hangs for the first broker_outage
+seconds. Reports, per output, how many readings arrived and how many of
+them were unique. It also reports how many times batches were encoded
+compared with the number of batches. Exits non-zero if any output lost or
+duplicated readings. In formats mode uploads are compact and gzipped and
+the broker only accepts plain SenML: it must fall back by itself, with
+Geras and the file sink left on compact.
+Usage: python benchmarks/bench_sinks.py [outage] [broker_outage]
+       python benchmarks/bench_sinks.py formats
+"""
+import sys
+import json
+import shutil
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor
+import uwe_app_a
+import uwe_senml
+import uwe_sinks
+import geras_standin
+
+def unique(received):
+    seen = set()
+    total = 0
+    for t, path, values in received:
+        device = path.rstrip("/").split("/")[-1]
+        for v in values:
+            seen.add((device, v["n"], v["t"]))
+            total += 1
+    return total, len(seen)
+
+def run(outage, brokerOutage, devices=10, rate=2.0, seconds=15):
+    geras, gerasPort = geras_standin.listen(mode="fail")
+    broker, brokerPort = geras_standin.listen(mode="hang")
+    uwe_app_a.config.update(sinks="geras,file,broker", upload_timeout=2.0, backoff_initial=1.0,
+                            sink_delay=0.5, journal_file=configDir + "bench.journal",
+                            file_sink_dir=configDir + "archive",
+                            geras_url="http://127.0.0.1:%d/series/" % gerasPort.getHost().port,
+                            broker_url="http://127.0.0.1:%d/" % brokerPort.getHost().port)
+    # Geras and each sink have an encoder; count them all
+    encodes = [0]
+    encode = uwe_senml.Encoder.encode
+    def countingEncode(encoder, values):
+        encodes[0] += 1
+        return encode(encoder, values)
+    uwe_senml.Encoder.encode = countingEncode
+    dm = uwe_app_a.DataManager("BID1")
+    sent = [0]
+    def readings(i):
+        for d in range(devices):
+            dm.storeTemp("dev" + str(d), 1430000000.0 + i, float(i))
+            sent[0] += 1
+    for i in range(int(seconds*rate)):
+        reactor.callLater(i/rate, readings, i)
+    def gerasUp():
+        geras.mode = "ok"
+    def brokerUp():
+        broker.mode = "ok"
+        for request in broker.hung:
+            broker.finishSlow(request)
+    reactor.callLater(outage, gerasUp)
+    reactor.callLater(brokerOutage, brokerUp)
+    result = {"readings": 0}
+    def finish():
+        dm.stop()
+        archived = []
+        for header, body in uwe_sinks.readArchive(configDir + "archive"):
+            archived.append((0, "/" + header["d"], uwe_senml.decode(body, header["ce"] or None)))
+        result["readings"] = sent[0]
+        result["geras"] = unique(geras.received)
+        result["file"] = unique(archived)
+        result["broker"] = unique(broker.received)
+        result["geras_requests"] = geras.requests
+        result["geras_attempts"] = geras.attempts
+        result["encodes"] = encodes[0]
+        result["counters"] = dict((k, v) for k, v in dm.metrics.counters.items() if k.startswith("sink_"))
+        reactor.stop()
+    reactor.callLater(seconds + max(outage, brokerOutage) + 10, finish)
+    reactor.run()
+    return result
+
+def formats(devices=10, rate=2.0, seconds=5):
+    geras, gerasPort = geras_standin.listen()
+    broker, brokerPort = geras_standin.listen(acceptCompact=False, acceptGzip=False)
+    uwe_app_a.config.update(sinks="geras,file,broker", senml_format="compact", gzip='True', gzip_min_bytes=0,
+                            sink_delay=0.5, journal='False', file_sink_dir=configDir + "archive",
+                            geras_url="http://127.0.0.1:%d/series/" % gerasPort.getHost().port,
+                            broker_url="http://127.0.0.1:%d/" % brokerPort.getHost().port)
+    dm = uwe_app_a.DataManager("BID1")
+    sent = [0]
+    def readings(i):
+        for d in range(devices):
+            dm.storeTemp("dev" + str(d), 1430000000.0 + i, float(i))
+            sent[0] += 1
+    for i in range(int(seconds*rate)):
+        reactor.callLater(i/rate, readings, i)
+    result = {}
+    def finish():
+        dm.stop()
+        archived = []
+        for header, body in uwe_sinks.readArchive(configDir + "archive"):
+            archived.append((0, "/" + header["d"], uwe_senml.decode(body, header["ce"] or None)))
+        result.update(readings=sent[0], geras=unique(geras.received), file=unique(archived),
+                      broker=unique(broker.received),
+                      formats=dict((name, [encoder.format, encoder.gzip]) for name, encoder in
+                                   [("geras", dm.encoder)] + [(sink.name, sink.encoder) for sink in dm.sinks]),
+                      counters=dict((k, v) for k, v in dm.metrics.counters.items() if k.startswith("sink_")))
+        reactor.stop()
+    reactor.callLater(seconds + 5, finish)
+    reactor.run()
+    return result
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "formats":
+        result = formats()
+    else:
+        outage = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+        brokerOutage = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+        result = run(outage, brokerOutage)
+    shutil.rmtree(configDir, ignore_errors=True)
+    ok = all(result[k] == (result["readings"], result["readings"]) for k in ("geras", "file", "broker"))
+    if "formats" in result:
+        ok = ok and result["formats"] == {"geras": ["compact", True], "file": ["compact", True],
+                                          "broker": ["legacy", False]}
+    print(json.dumps({"benchmark": "sinks", "results": result}, indent=2))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# bench_soak.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Memory soak through a long disconnection. A fleet of accelerometers
+streams into DataManager at 1 Hz of simulated time while the upload
+endpoint is down, with no journal, so everything has to be held in
+memory_budget. Resident memory and buffered bytes are sampled every
+simulated hour; they should level off once the budget is reached.
+Usage: python benchmarks/bench_soak.py [devices] [hours] [memory_budget]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import fakecb
+configDir = fakecb.install()
+import uwe_app_a
+
+def rss():
+    """ Current resident set size, kB """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1])*resource.getpagesize()//1024
+
+def run(devices, hours, budget):
+    uwe_app_a.config.update(journal='False', memory_budget=budget)
+    dm = uwe_app_a.DataManager("BID1")
+    # Endpoint down for the whole run
+    for lane in dm.lanes:
+        lane.breaker.state = "open"
+        lane.breaker.openUntil = float("inf")
+    ids = ["dev" + str(d) for d in range(devices)]
+    t0 = 1430000000.0
+    samples = []
+    start = time.time()
+    for hour in range(hours):
+        for s in range(3600):
+            t = t0 + hour*3600 + s
+            a = (s % 7*0.01, s % 5*0.01, 1.0)
+            for deviceID in ids:
+                dm.storeAccel(deviceID, t, a)
+            if s % 60 == 0:
+                for deviceID in ids:
+                    dm.storeConnected(deviceID, t, True)
+        samples.append({"hour": hour + 1, "rss_kb": rss(), "buffer_bytes": dm.bufferBytes})
+    return {"devices": devices,
+            "hours": hours,
+            "memory_budget": budget,
+            "points_offered": devices*hours*(3600*3 + 60),
+            "seconds": round(time.time() - start, 1),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "shed": dict((k, v) for k, v in dm.metrics.counters.items() if k.startswith("shed_") or k.startswith("memory_")),
+            "samples": samples}
+
+if __name__ == '__main__':
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+    budget = int(sys.argv[3]) if len(sys.argv) > 3 else uwe_app_a.config["memory_budget"]
+    print(json.dumps({"benchmark": "soak", "results": run(devices, hours, budget)}, indent=2))
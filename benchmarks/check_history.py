@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# check_history.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Local history queries through the concentrator channel. A fleet streams
+into the app, overrunning every series' ring several times; then latest,
+last n and time range requests are checked against the readings that were
+stored, and timed. Then adaptors come and go, and are renamed, through
+configure messages: only the current ones may be answered for, and their
+series must not use up history_max_series. Prints the timings, the reply
+sizes and any failures, and exits non-zero if a check fails.
+Usage: python benchmarks/check_history.py [devices] [readings]
+"""
+import sys
+import json
+import time
+import fakecb
+fakecb.install()
+import uwe_app_a
+import uwe_senml
+
+def run(devices, readings):
+    failures = []
+    def check(ok, what):
+        if not ok:
+            failures.append(what)
+    uwe_app_a.config.update(journal='False', temp_min_change=0, sinks='')
+    app = uwe_app_a.App([])
+    app.dm = uwe_app_a.DataManager(app.bridge_id, app.metrics)
+    dm = app.dm
+    size = uwe_app_a.config["history_size"]
+    start = time.time()
+    for i in range(readings):
+        for d in range(devices):
+            dm.storeTemp("dev" + str(d), 1000.0 + i, float(i))
+    storeTime = time.time() - start
+
+    def ask(**req):
+        req["resp"] = "history"
+        app.sent = []
+        start = time.time()
+        app.onConcMessage(req)
+        elapsed = time.time() - start
+        body = app.sent[-1][1]["body"]
+        size = len(json.dumps(body, separators=(",", ":")))
+        decoded = {}
+        for d, pack in body["devices"].items():
+            decoded[d] = [(r["t"], r["v"]) for r in uwe_senml.decode(json.dumps(pack).encode("utf-8"))]
+        return decoded, elapsed, size
+
+    last = 1000.0 + readings - 1
+    timings = {}
+    found, timings["latest_all_ms"], latestBytes = ask()
+    check(len(found) == devices, "latest: %s devices" % len(found))
+    check(all(v == [(last, last - 1000.0)] for v in found.values()), "latest: wrong reading")
+    found, timings["last_ms"], lastBytes = ask(device="dev3", series=["temperature"], last=50)
+    check(found["dev3"] == [(t, t - 1000.0) for t in range(int(last) - 49, int(last) + 1)], "last 50 wrong")
+    found, timings["range_ms"], rangeBytes = ask(device="dev3", start=last - 99, end=last - 9)
+    check(found["dev3"] == [(t, t - 1000.0) for t in range(int(last) - 99, int(last) - 9)], "range wrong")
+    found, _, _ = ask(device="dev3", start=0, end=last + 1)
+    check(len(found["dev3"]) == min(size, readings), "ring holds %s readings" % len(found["dev3"]))
+    found, _, _ = ask(device="nosuch")
+    check(found == {"nosuch": []}, "unknown device")
+    dm.stop()
+    return {"devices": devices,
+            "readings_per_device": readings,
+            "history_size": size,
+            "store_us_per_reading": round(storeTime/(devices*readings)*1e6, 3),
+            "query_ms": dict((k, round(v*1000, 3)) for k, v in timings.items()),
+            "reply_bytes": {"latest_all": latestBytes, "last_50": lastBytes, "range_90": rangeBytes},
+            "failures": failures}
+
+def churn(rounds=20):
+    """ Each round one adaptor is added and the oldest removed or renamed; a ring is kept for two series at most """
+    failures = []
+    uwe_app_a.config.update(journal='False', temperature='True', temp_min_change=0, sinks='', history_max_series=2)
+    app = uwe_app_a.App([])
+    names = {}
+    for r in range(rounds):
+        adtID = "ADT" + str(r)
+        names[adtID] = "tag " + str(r)
+        if r >= 2:
+            old = "ADT" + str(r - 2)
+            if r % 2:
+                del names[old]
+            else:
+                names[old] = "renamed " + str(r)
+        app.onConfigureMessage({"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": n}
+                                             for i, n in names.items()]})
+        app.onAdaptorService({"id": adtID, "service": [{"characteristic": "temperature", "interval": 1.0}]})
+        app.processAdaptorData({"id": adtID, "characteristic": "temperature",
+                                "timeStamp": 1000.0 + r, "data": float(r)})
+        app.sent = []
+        app.onConcMessage({"resp": "history"})
+        answered = sorted(app.sent[-1][1]["body"]["devices"])
+        expected = sorted(app.idToName[i] for i in ("ADT" + str(r - 1), adtID) if i in app.idToName)
+        if answered != expected:
+            failures.append("churn round %s: answered for %s, expected %s" % (r, answered, expected))
+    if app.dm.history.refused:
+        failures.append("churn: %s readings refused" % app.dm.history.refused)
+    app.dm.stop()
+    return failures
+
+if __name__ == '__main__':
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    readings = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    result = run(devices, readings)
+    result["failures"].extend(churn())
+    print(json.dumps({"benchmark": "history", "results": result}, indent=2))
+    sys.exit(1 if result["failures"] else 0)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# check_reconfigure.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Checks that reconfiguring the app is applied as a difference. A fleet is
+configured and streams data; then more adaptors are added, every adaptor
+announces its services again, some adaptors are removed and one is renamed.
+Buffered data, sensor state and the DataManager must survive, with no
+duplicate handlers or services, and service requests must only go to the
+adaptors that asked or changed, and what the stages of removed or renamed
+adaptors hold back must be stored. Prints the timings and any failures, and
+exits non-zero if a check fails.
+Usage: python benchmarks/check_reconfigure.py [adaptors] [added]
+"""
+import sys
+import json
+import time
+import fakecb
+fakecb.install()
+import uwe_app_a
+
+SERVICES = [{"characteristic": "acceleration", "interval": 1.0},
+            {"characteristic": "binary_sensor", "interval": 0},
+            {"characteristic": "connected", "interval": 0}]
+
+def adaptors(ids):
+    return {"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i} for i in ids]}
+
+def serviceRequests(app):
+    return [dest for dest, msg in app.sent if msg.get("request") == "service"]
+
+def run(n, added):
+    failures = []
+    def check(ok, what):
+        if not ok:
+            failures.append(what)
+    uwe_app_a.config.update(journal='False', accel='True', binary='True', connected='True')
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(i) for i in range(n)]
+    app.onConfigureMessage(adaptors(ids))
+    for i in ids:
+        app.onAdaptorService({"id": i, "service": SERVICES})
+    for i in ids:
+        app.onAdaptorData({"id": i, "characteristic": "acceleration", "timeStamp": 100.0,
+                           "data": {"x": 0.5, "y": 0.0, "z": 1.0}})
+        app.onAdaptorData({"id": i, "characteristic": "binary_sensor", "timeStamp": 100.0, "data": "on"})
+    dm = app.dm
+    points = dm.bulkLane.points.copy()
+    handlers = len(app.handlers)
+    app.sent = []
+
+    # Add adaptors; the existing ones announce their services again
+    newIDs = ["ADT" + str(i) for i in range(n, n + added)]
+    start = time.time()
+    app.onConfigureMessage(adaptors(ids + newIDs))
+    configureTime = time.time() - start
+    start = time.time()
+    for i in ids + newIDs:
+        app.onAdaptorService({"id": i, "service": SERVICES})
+    serviceTime = time.time() - start
+    check(app.dm is dm, "DataManager replaced")
+    check(dm.bulkLane.points == points, "buffered points changed")
+    check(all(app.sensors[(i, "binary_sensor")][0].previous == 1 for i in ids), "binary state lost")
+    check(len(app.handlers) == handlers + 3*added, "handler count %s" % len(app.handlers))
+    check(len(app.devServices) == n + added, "devServices count %s" % len(app.devServices))
+    check(len(app.accel) == n + added, "accelerometer objects %s" % len(app.accel))
+    check(sorted(serviceRequests(app)) == sorted(ids + newIDs), "service requests not one per announcing adaptor")
+
+    # A repeated "on" must not be stored again: the state survived
+    stored = dm.stored
+    app.onAdaptorData({"id": ids[0], "characteristic": "binary_sensor", "timeStamp": 101.0, "data": "on"})
+    check(dm.stored == stored, "binary transition re-sent after reconfigure")
+
+    # Remove some adaptors and rename one; nobody else is asked for services
+    app.sent = []
+    removed = ids[:10]
+    kept = ids[10:] + newIDs
+    renamed = adaptors(kept)
+    renamed["adaptors"][0]["friendly_name"] = "renamed tag"
+    app.onConfigureMessage(renamed)
+    check(serviceRequests(app) == [kept[0]], "service requests after remove/rename: %s" % serviceRequests(app))
+    check(not [k for k in app.handlers if k[0] in removed], "handlers left for removed adaptors")
+    check(len(app.devServices) == len(kept), "devServices after removal %s" % len(app.devServices))
+    check(app.sensors[(kept[0], "acceleration")][0].id == "renamed_tag", "renamed adaptor still uses its old name")
+    check(all(d in dm.bulkLane.s for d in ["tag_" + i for i in removed]), "buffers of removed adaptors dropped")
+    dm.stop()
+    return {"adaptors": n,
+            "added": added,
+            "configure_ms": round(configureTime*1000, 2),
+            "services_ms": round(serviceTime*1000, 2),
+            "failures": failures}
+
+# Stage config, characteristic, a value at sample n, a series, and its last
+# timestamp once the samples at 100-129 s have been flushed
+HELD_BACK = [("aggregate", {"temperature": "True", "temp_aggregate": 60}, "temperature",
+              lambda n: 20.0 + 0.1*n, "temperature_mean", 120.0),
+             ("swinging_door", {"accel_compression": "swinging_door"}, "acceleration",
+              lambda n: {"x": 0.01*n, "y": 0.0, "z": 1.0}, "accel_x", 129.0),
+             ("auto_deadband", {"accel_compression": "auto"}, "acceleration",
+              lambda n: {"x": 0.001*(n % 2), "y": 0.0, "z": 1.0}, "accel_x", 129.0),
+             ("features", {"accel_features": "replace"}, "acceleration",
+              lambda n: {"x": 0.01*n, "y": 0.0, "z": 1.0}, "accel_vm", 130.0)]
+
+def heldBack():
+    """ What stages hold back is stored when an adaptor is removed or renamed """
+    failures = []
+    for name, appConfig, characteristic, value, series, last in HELD_BACK:
+        saved = dict((k, uwe_app_a.config[k]) for k in appConfig)
+        uwe_app_a.config.update(appConfig)
+        app = uwe_app_a.App([])
+        ids = ["ADT0", "ADT1"]
+        app.onConfigureMessage(adaptors(ids))
+        for i in ids:
+            app.onAdaptorService({"id": i, "service": [{"characteristic": characteristic, "interval": 1.0}]})
+        for n in range(30):
+            for i in ids:
+                app.onAdaptorData({"id": i, "characteristic": characteristic, "timeStamp": 100.0 + n,
+                                   "data": value(n)})
+        # The first is removed and the second renamed
+        renamed = adaptors(ids[1:])
+        renamed["adaptors"][0]["friendly_name"] = "renamed tag"
+        app.onConfigureMessage(renamed)
+        for i in ids:
+            buffers = app.dm.bulkLane.s.get("tag_" + i, {})
+            if series not in buffers or buffers[series].t[-1] != last:
+                failures.append("%s: %s of tag_%s not flushed" % (name, series, i))
+        app.dm.stop()
+        uwe_app_a.config.update(saved)
+    return failures
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    added = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    result = run(n, added)
+    result["failures"] += heldBack()
+    print(json.dumps({"benchmark": "reconfigure", "results": result}, indent=2))
+    sys.exit(1 if result["failures"] else 0)
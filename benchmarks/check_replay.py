@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# check_replay.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Record and replay. An app records a few seconds of temperature, binary and
+accelerometer messages sent from a thread, as cbcommslib would; the
+recording must hold every message, and only those, through an adaptor
+added and one renamed, and survive a member cut short. It is
+then replayed as fast as possible and at twice real time, which must give
+the same archive; with a coarser temperature deadband, compared with the
+first run, which must show only the temperature series as changed; and to
+the Geras stand-in, which must receive what was archived. Last, a synthetic
+recording of days of slow sensors is replayed as fast as possible to time
+a backfill. Each run is a separate process, as the reactor's clock is
+replaced. Exits non-zero if a check fails.
+Usage: python benchmarks/check_replay.py [backfill_days] [backfill_devices]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import subprocess
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor, threads
+import uwe_replay
+from uwe_senml import compress
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# The same in every replay, so that runs can be compared
+REPLAY_CONFIG = ["temperature=True", "binary=True", "connected=False", "temp_min_change=0.2",
+                 "flush_max_age=3.0", "journal=False"]
+
+def adaptors(ids):
+    return {"adaptors": [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i} for i in ids]}
+
+def service(i):
+    return {"id": i, "service": [{"characteristic": c, "interval": 0.05}
+                                 for c in ("temperature", "acceleration", "binary_sensor")]}
+
+def record(path, seconds, devices):
+    import uwe_app_a
+    uwe_app_a.config.update(record='True', record_file=path, record_flush_interval=0.2, temperature='True',
+                            binary='True', connected='False', journal='False', snapshot='False', sinks='')
+    app = uwe_app_a.App([])
+    ids = ["ADT" + str(d) for d in range(devices)]
+    sent = {"configure": 0, "service": 0, "data": 0}
+
+    def reconfigure(ids):
+        app.onConfigureMessage(adaptors(ids))
+        sent["configure"] += 1
+        for i in ids:
+            app.onAdaptorService(service(i))
+            sent["service"] += 1
+    def produce():
+        random.seed(1)
+        start = time.time()
+        n = 0
+        while time.time() - start < seconds:
+            for d, i in enumerate(ids):
+                t = time.time()
+                app.onAdaptorData({"id": i, "characteristic": "temperature", "timeStamp": t,
+                                   "data": 20.0 + d + math.sin(n/15.0) + random.gauss(0, 0.05)})
+                app.onAdaptorData({"id": i, "characteristic": "acceleration", "timeStamp": t,
+                                   "data": {"x": 0.2*math.sin(n/5.0), "y": random.gauss(0, 0.01), "z": 1.0}})
+                sent["data"] += 2
+                if n % 40 == d:
+                    app.onAdaptorData({"id": i, "characteristic": "binary_sensor", "timeStamp": t,
+                                       "data": "on" if n % 80 < 40 else "off"})
+                    sent["data"] += 1
+            n += 1
+            time.sleep(0.02)
+    def rename():
+        # The app services a renamed adaptor again itself, which must not be recorded
+        config = adaptors(ids + ["ADT" + str(devices)])
+        config["adaptors"][0]["friendly_name"] = "renamed tag"
+        app.onConfigureMessage(config)
+        sent["configure"] += 1
+    reconfigure(ids)
+    # One more adaptor half way through, and one renamed after that
+    reactor.callLater(seconds/2.0, reconfigure, ids + ["ADT" + str(devices)])
+    reactor.callLater(seconds*0.75, rename)
+    threads.deferToThread(produce).addBoth(lambda _: reactor.stop())
+    reactor.run()
+    return {"sent": sent, "recorded": app.recorder.recorded, "dropped": app.recorder.dropped}
+
+def geras(path, output):
+    import geras_standin
+    result = {}
+    def run():
+        standin, port = geras_standin.listen()
+        appConfig = dict((c.split("=")[0], uwe_replay.parseValue(c.split("=")[1])) for c in REPLAY_CONFIG)
+        appConfig.update(sinks="geras,file", geras_url="http://127.0.0.1:%d/series/" % port.getHost().port)
+        d = uwe_replay.replay([path], output, 0, appConfig)
+        def done(r):
+            result.update(points=r["points"], geras_records=standin.records, upload_status=r["upload_status"])
+        d.addCallback(done)
+        d.addBoth(lambda _: reactor.callLater(0, reactor.stop))
+    # replay() must be called before the reactor runs, and the stand-in needs it running
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return result
+
+def backfill(path, days, devices):
+    """ Temperature and humidity from each device every minute, and a battery reading every hour """
+    start = 1430000000.0
+    ids = ["ADT" + str(d) for d in range(devices)]
+    lines = [uwe_replay.encodeRecord(start, "configure", adaptors(ids))]
+    for i in ids:
+        lines.append(uwe_replay.encodeRecord(start, "service", {"id": i, "service": [
+            {"characteristic": c, "interval": 60} for c in ("temperature", "humidity", "battery")]}))
+    random.seed(2)
+    for m in range(days*24*60):
+        t = start + 60.0*(m + 1)
+        for d, i in enumerate(ids):
+            ts = t + d*0.01
+            lines.append(uwe_replay.encodeRecord(ts, "data", {"id": i, "characteristic": "temperature", "timeStamp": ts,
+                                                              "data": 20.0 + 3*math.sin(m/240.0) + random.gauss(0, 0.1)}))
+            lines.append(uwe_replay.encodeRecord(ts, "data", {"id": i, "characteristic": "humidity", "timeStamp": ts,
+                                                              "data": 50.0 + 10*math.sin(m/600.0)}))
+            if m % 60 == 0:
+                lines.append(uwe_replay.encodeRecord(ts, "data", {"id": i, "characteristic": "battery",
+                                                                  "timeStamp": ts, "data": 100 - m//1440}))
+        if len(lines) >= 20000:
+            uwe_replay.appendRecording(path, lines)
+            lines = []
+    uwe_replay.appendRecording(path, lines)
+
+def child(args):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"] + args)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+def replayRun(args):
+    out = subprocess.check_output([sys.executable, os.path.join(HERE, "replay.py")] + args)
+    with open(os.path.join(args[args.index("--output") + 1], "replay.json")) as f:
+        return json.load(f)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        if sys.argv[2] == "record":
+            result = record(sys.argv[3], 3.0, 4)
+        else:
+            result = geras(sys.argv[3], sys.argv[4])
+        print(json.dumps(result))
+        sys.exit(0)
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    failures = []
+    results = {}
+    rec = os.path.join(configDir, "uwe_app.rec")
+    recorded = results["record"] = child(["record", rec])
+    records = list(uwe_replay.readRecording(rec))
+    kinds = dict((k, sum(1 for r in records if r[1] == k)) for k in ("configure", "service", "data"))
+    if kinds != recorded["sent"] or recorded["dropped"]:
+        failures.append("recorded %s, sent %s" % (kinds, recorded["sent"]))
+    cut = rec + ".cut"
+    shutil.copy(rec, cut)
+    with open(cut, "ab") as f:
+        member = compress(b'[1,"data",{}]\n'*1000)
+        f.write(member[:len(member)//2])
+    if len(list(uwe_replay.readRecording(cut))) != len(records):
+        failures.append("records lost after a member cut short")
+
+    config = []
+    for c in REPLAY_CONFIG:
+        config += ["--config", c]
+    fast = replayRun([rec, "--output", os.path.join(configDir, "fast")] + config)
+    paced = replayRun([rec, "--output", os.path.join(configDir, "paced"), "--speed", "2"] + config)
+    coarse = replayRun([rec, "--output", os.path.join(configDir, "coarse"), "--compare",
+                        os.path.join(configDir, "fast", "replay.json")] + config + ["--config", "temp_min_change=1.0"])
+    if fast["series"] != paced["series"] or fast["batches"] != paced["batches"]:
+        failures.append("output differs with speed")
+    if fast["messages"] != kinds:
+        failures.append("replayed %s of %s" % (fast["messages"], kinds))
+    changed = coarse["diff"]["changed"]
+    if not changed or [s for s in changed if not s.endswith("/temperature")] or \
+       coarse["diff"]["added"] or coarse["diff"]["removed"]:
+        failures.append("unexpected diff %s" % coarse["diff"])
+    uploaded = child(["geras", rec, os.path.join(configDir, "geras")])
+    if uploaded["geras_records"] != uploaded["points"] or uploaded["points"] != fast["points"]:
+        failures.append("geras %s, archived %s" % (uploaded["geras_records"], uploaded["points"]))
+    for name, r in (("fast", fast), ("paced", paced), ("coarse", coarse)):
+        results[name] = dict((k, v) for k, v in r.items() if k not in ("series", "diff"))
+    results["diff"] = coarse["diff"]
+    results["geras"] = uploaded
+
+    path = os.path.join(configDir, "backfill.rec")
+    backfill(path, days, devices)
+    r = replayRun([path, "--output", os.path.join(configDir, "backfill"), "--config", "temperature=True",
+                   "--config", "humidity=True", "--config", "battery=True", "--config", "journal=False"])
+    results["backfill"] = dict((k, v) for k, v in r.items() if k != "series")
+    results["backfill"].update(days=days, devices=devices, recording_bytes=os.path.getsize(path))
+    results["failures"] = failures
+    print(json.dumps({"benchmark": "replay", "results": results}, indent=2))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# fakecb.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Minimal stand-ins for cbcommslib and cbconfig so that uwe_app_a can be
+imported and driven on a plain Linux box, away from a bridge.
+Call install() before importing uwe_app_a.
+"""
+import sys
+import os
+import types
+import logging
+import tempfile
+
+class FakeCbApp(object):
+    """ Records everything the app sends instead of talking to a manager. """
+    def __init__(self, argv):
+        self.id = "AID1"
+        self.bridge_id = "BID1"
+        self.sent = []
+        self.managerSent = []
+
+    def sendMessage(self, msg, dest):
+        self.sent.append((dest, msg))
+
+    def sendManagerMessage(self, msg):
+        self.managerSent.append(msg)
+
+def install(configDir=None):
+    """ Put fake cbcommslib and cbconfig modules in sys.modules. """
+    if configDir is None:
+        configDir = tempfile.mkdtemp(prefix="uwe_bench_")
+    if not configDir.endswith("/"):
+        configDir += "/"
+    cbcommslib = types.ModuleType("cbcommslib")
+    cbcommslib.CbApp = FakeCbApp
+    cbconfig = types.ModuleType("cbconfig")
+    cbconfig.CB_LOGFILE = os.path.join(configDir, "uwe_app.log")
+    cbconfig.CB_LOGGING_LEVEL = logging.WARNING
+    cbconfig.CB_CONFIG_DIR = configDir
+    sys.modules["cbcommslib"] = cbcommslib
+    sys.modules["cbconfig"] = cbconfig
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(here)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    return configDir
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# geras_standin.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Local stand-in for geras.1248.io/series/... that accepts legacy or compact
+SenML, optionally gzipped, and counts what it receives.
+mode can be changed at any time to make it misbehave:
+  ok    answer 200 straight away
+  fail  answer 503
+  hang  never answer
+  slow  answer 200 after delay seconds
+Usage: python benchmarks/geras_standin.py [port] [mode] [delay]
+"""
+import sys
+import json
+import logging
+import fakecb
+fakecb.install()
+from twisted.internet import reactor
+from twisted.web import server, resource
+import uwe_senml
+
+class GerasStandin(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, acceptCompact=True, acceptGzip=True, mode="ok", delay=5.0):
+        resource.Resource.__init__(self)
+        self.acceptCompact = acceptCompact
+        self.acceptGzip = acceptGzip
+        self.mode = mode
+        self.delay = delay
+        self.hung = []
+        self.attempts = 0
+        self.requests = 0
+        self.bytes = 0
+        self.records = 0
+        self.series = {}
+        self.received = []
+
+    def render_POST(self, request):
+        self.attempts += 1
+        if self.mode == "fail":
+            request.setResponseCode(503)
+            return b''
+        if self.mode == "hang":
+            self.hung.append(request)
+            return server.NOT_DONE_YET
+        if self.mode == "slow":
+            reactor.callLater(self.delay, self.finishSlow, request)
+            return server.NOT_DONE_YET
+        return self.accept(request)
+
+    def finishSlow(self, request):
+        if request.finished or request._disconnected:
+            return
+        request.write(self.accept(request))
+        request.finish()
+
+    def accept(self, request):
+        body = request.content.read()
+        encoding = request.getHeader('content-encoding')
+        contentType = request.getHeader('content-type') or ''
+        if (encoding == 'gzip' and not self.acceptGzip) or \
+           (contentType.startswith('application/senml') and not self.acceptCompact):
+            request.setResponseCode(415)
+            return b''
+        try:
+            values = uwe_senml.decode(body, encoding)
+        except Exception as ex:
+            logging.warning("GerasStandin cannot decode body: %s", str(ex))
+            request.setResponseCode(400)
+            return b''
+        self.requests += 1
+        self.bytes += len(body)
+        self.records += len(values)
+        path = request.path.decode('ascii')
+        for v in values:
+            name = path + "/" + v["n"] if not path.endswith("/") else path + v["n"]
+            self.series[name] = self.series.get(name, 0) + 1
+        self.received.append((reactor.seconds(), path, values))
+        return b''
+
+    def summary(self):
+        return {"attempts": self.attempts,
+                "requests": self.requests,
+                "bytes": self.bytes,
+                "records": self.records,
+                "series": len(self.series)}
+
+def listen(port=0, **kwargs):
+    """ Start a stand-in on the running reactor; returns (resource, listening port) """
+    standin = GerasStandin(**kwargs)
+    site = server.Site(standin)
+    site.noisy = False
+    return standin, reactor.listenTCP(port, site, interface="127.0.0.1")
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    mode = sys.argv[2] if len(sys.argv) > 2 else "ok"
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+    standin, p = listen(port, mode=mode, delay=delay)
+    def report():
+        print(json.dumps(standin.summary()))
+        reactor.callLater(10, report)
+    reactor.callLater(10, report)
+    reactor.run()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# harness.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+End-to-end load test for uwe_app_a.App, offline.
+A simulated fleet of adaptors is configured and serviced through the
+normal App entry points and then streams onAdaptorData messages at the
+given rates; uploads go to a local Geras stand-in.
+Results are printed (and optionally written) as JSON:
+messages/sec, reading-to-POST latency overall and per upload lane,
+upload requests and bytes,
+peak RSS and CPU time.
+
+Usage: python benchmarks/harness.py [--devices N] [--duration S]
+           [--rate characteristic=HZ ...] [--config key=value ...]
+           [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import fakecb
+configDir = fakecb.install()
+from twisted.internet import reactor, task
+import uwe_app_a
+import geras_standin
+
+# Which config switch enables each characteristic
+ENABLE = {
+    "acceleration": "accel",
+    "temperature": "temperature",
+    "ir_temperature": "irtemperature",
+    "humidity": "humidity",
+    "buttons": "buttons",
+    "gyro": "gyro",
+    "magnetometer": "magnet",
+    "binary_sensor": "binary",
+    "luminance": "luminance",
+    "power": "power",
+    "battery": "battery",
+    "connected": "connected"
+}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p/100.0*(len(values) - 1))))
+    return values[k]
+
+def latencySummary(latencies):
+    def r(v):
+        return round(v, 4) if v is not None else None
+    return {"count": len(latencies),
+            "p50": r(percentile(latencies, 50)),
+            "p90": r(percentile(latencies, 90)),
+            "p99": r(percentile(latencies, 99)),
+            "max": r(max(latencies) if latencies else None)}
+
+class Fleet:
+    """ N simulated adaptors, each offering every characteristic in rates """
+    def __init__(self, app, devices, rates):
+        self.app = app
+        self.rates = rates
+        self.ids = ["ADT" + str(d) for d in range(devices)]
+        self.state = {}
+        self.messages = 0
+        self.busy = 0.0
+        self.loops = []
+        random.seed(3)
+
+    def configure(self):
+        adaptors = [{"id": i, "name": "SensorTag", "friendly_name": "tag " + i} for i in self.ids]
+        self.app.onConfigureMessage({"adaptors": adaptors})
+        services = [{"characteristic": c, "interval": 1.0} for c in self.rates]
+        for i in self.ids:
+            self.app.onAdaptorService({"id": i, "service": services})
+
+    def data(self, deviceID, characteristic):
+        """ Plausible readings: random walks for analogue values, rare flips for binary """
+        key = (deviceID, characteristic)
+        v = self.state.get(key, 0.0) + random.gauss(0, 0.05)
+        self.state[key] = v
+        if characteristic in ("acceleration", "gyro", "magnetometer"):
+            return {"x": v, "y": -v/2, "z": 1.0 + v/10}
+        if characteristic == "binary_sensor":
+            return "on" if v > 0 else "off"
+        if characteristic == "connected":
+            return v > -0.5
+        if characteristic == "buttons":
+            return {"leftButton": int(v > 0.3), "rightButton": int(v < -0.3)}
+        return 20.0 + v
+
+    def send(self, characteristic):
+        start = time.time()
+        now = reactor.seconds()
+        for deviceID in self.ids:
+            self.app.onAdaptorData({"id": deviceID,
+                                    "characteristic": characteristic,
+                                    "timeStamp": now,
+                                    "data": self.data(deviceID, characteristic)})
+        self.messages += len(self.ids)
+        self.busy += time.time() - start
+
+    def start(self):
+        for characteristic, rate in self.rates.items():
+            loop = task.LoopingCall(self.send, characteristic)
+            loop.start(1.0/rate, now=False)
+            self.loops.append(loop)
+
+    def stop(self):
+        for loop in self.loops:
+            loop.stop()
+
+def run(devices=10, duration=30.0, rates=None, appConfig=None, drain=5.0):
+    rates = rates or {"acceleration": 1.0, "binary_sensor": 0.1, "connected": 0.01}
+    standin, port = geras_standin.listen()
+    uwe_app_a.config["geras_url"] = "http://127.0.0.1:%d/series/" % port.getHost().port
+    uwe_app_a.config["journal_file"] = os.path.join(configDir, "bench.journal")
+    for c in ENABLE.values():
+        uwe_app_a.config[c] = 'False'
+    for c in rates:
+        uwe_app_a.config[ENABLE[c]] = 'True'
+    uwe_app_a.config.update(appConfig or {})
+    app = uwe_app_a.App([])
+    fleet = Fleet(app, devices, rates)
+    fleet.configure()
+    cpuStart = os.times()
+    wallStart = time.time()
+    fleet.start()
+    reactor.callLater(duration, fleet.stop)
+    reactor.callLater(duration + drain, reactor.stop)
+    reactor.run()
+    wall = time.time() - wallStart
+    cpu = os.times()
+    latencies = []
+    byLane = {"event": [], "bulk": []}
+    for received, path, values in standin.received:
+        for v in values:
+            latency = received - v["t"]
+            latencies.append(latency)
+            # Bulk posts name records U_<device>/<series>
+            lane = "event" if v["n"].split("/")[-1] in uwe_app_a.EVENT_SERIES else "bulk"
+            byLane[lane].append(latency)
+    return {"devices": devices,
+            "duration": duration,
+            "rates": rates,
+            "messages": fleet.messages,
+            "messages_per_sec_offered": round(fleet.messages/duration, 1),
+            "messages_per_sec_processed": round(fleet.messages/fleet.busy, 1) if fleet.busy else None,
+            "latency": latencySummary(latencies),
+            "latency_by_lane": dict((lane, latencySummary(l)) for lane, l in byLane.items()),
+            "upload_requests": standin.requests,
+            "upload_attempts": standin.attempts,
+            "upload_bytes": standin.bytes,
+            "upload_records": standin.records,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "cpu_user": round(cpu[0] - cpuStart[0], 3),
+            "cpu_system": round(cpu[1] - cpuStart[1], 3),
+            "cpu_fraction": round((cpu[0] + cpu[1] - cpuStart[0] - cpuStart[1])/wall, 4)}
+
+def parseValue(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="uwe_app load test")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--rate", action="append", default=[], help="characteristic=messages per second")
+    parser.add_argument("--config", action="append", default=[], help="app config key=value")
+    parser.add_argument("--output", help="also write results to this file")
+    args = parser.parse_args()
+    rates = dict((r.split("=")[0], float(r.split("=")[1])) for r in args.rate) or None
+    appConfig = dict((c.split("=", 1)[0], parseValue(c.split("=", 1)[1])) for c in args.config)
+    results = {"benchmark": "harness",
+               "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               "config": appConfig,
+               "results": run(args.devices, args.duration, rates, appConfig)}
+    out = json.dumps(results, indent=2)
+    print(out)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
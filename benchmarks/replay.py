@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# replay.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+uwe_replay with fakecb in place of cbcommslib and cbconfig, to replay a
+recording away from a bridge.
+Usage: python benchmarks/replay.py recording... --output dir [--speed x] [--config key=value]... [--compare replay.json]
+"""
+import sys
+import fakecb
+fakecb.install()
+import uwe_replay
+
+if __name__ == '__main__':
+    sys.exit(uwe_replay.main(sys.argv[1:]))
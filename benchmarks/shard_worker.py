@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# shard_worker.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+uwe_shards worker with fakecb in place of cbcommslib and cbconfig, for the
+benchmarks. Usage: python benchmarks/shard_worker.py <shard>
+"""
+import sys
+import fakecb
+fakecb.install()
+from twisted.internet import reactor
+import uwe_shards
+
+if __name__ == '__main__':
+    uwe_shards.WorkerProcess(int(sys.argv[1]))
+    reactor.run()
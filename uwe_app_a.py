@@ -11,167 +11,898 @@ import time
 import logging
 from cbcommslib import CbApp
 from cbconfig import *
-import requests
 import json
-from twisted.internet import reactor
+import base64
+from twisted.internet import reactor, task
+from uwe_upload import makeUploader, Backoff, CircuitBreaker, RetryBudget
+from uwe_journal import Journal
+from uwe_buffer import SeriesBuffer, bufferRecords
+from uwe_senml import Encoder, compactRecords
+from uwe_filters import SeriesCompressor, SeriesAggregator, AutoDeadband, MotionFeatures, deadbandRows, \
+                        blockArrays
+from uwe_metrics import Metrics, threadPoolGauge, listenHTTP as listenMetrics
+from uwe_polling import PollingController
+from uwe_sinks import Batch, FileSink, BrokerSink
+from uwe_history import History
+from uwe_ingest import IngestQueue
+from uwe_shards import ShardRouter
+from uwe_replay import Recorder
+from uwe_profile import Profiler
 
 # Default values:
 config = {
     'temperature': 'False',
+    'temp_mode': 'on_change',
+    'temp_aggregate': 0,
+    'temp_compression': 'deadband',
     'temp_min_change': 0.2,
     'irtemperature': 'False',
+    'irtemp_mode': 'on_change',
+    'irtemp_aggregate': 0,
+    'irtemp_compression': 'deadband',
     'irtemp_min_change': 0.5,
     'humidity': 'False',
+    'humidity_aggregate': 0,
+    'humidity_compression': 'deadband',
     'humidity_min_change': 0.2,
     'buttons': 'False',
     'accel': 'True',
+    'accel_aggregate': 0,
+    'accel_compression': 'deadband',
     'accel_min_change': 0.02,
     'accel_polling_interval': 1.0,
+    'accel_features': 'off',
     'gyro': 'False',
+    'gyro_aggregate': 0,
+    'gyro_compression': 'deadband',
     'gyro_min_change': 0.5,
     "gyro_polling_interval": 3.0,
+    'gyro_features': 'off',
     'magnet': 'False',
+    'magnet_aggregate': 0,
+    'magnet_compression': 'deadband',
     'magnet_min_change': 1.5,
     'magnet_polling_interval': 3.0,
     'binary': 'True',
     'luminance': 'False',
+    'luminance_aggregate': 0,
+    'luminance_compression': 'deadband',
     'luminance_min_change': 1.0,
     'power': 'False',
+    'power_aggregate': 0,
+    'power_compression': 'deadband',
     'power_min_change': 1.0,
     'battery': 'False',
+    'battery_aggregate': 0,
+    'battery_compression': 'deadband',
     'battery_min_change': 1.0,
     'connected': 'True',
     'slow_polling_interval': 600.0,
+    'motion_window': 10.0,
+    'motion_hop': 5.0,
+    'adaptive_polling': 'False',
+    'polling_check_interval': 60.0,
+    'polling_max_interval': 60.0,
+    'polling_quiet_ratio': 0.02,
+    'polling_busy_ratio': 0.1,
+    'polling_quiet_checks': 3,
+    'polling_min_samples': 20,
+    'auto_thresholds': 'False',
+    'auto_points_per_minute': 600,
+    'auto_threshold_floor': 0.25,
+    'auto_threshold_ceiling': 20.0,
+    'auto_threshold_check': 10.0,
+    'auto_noise_alpha': 0.05,
+    'aggregate_lateness': 5.0,
+    'aggregate_variance': 'False',
     'send_delay': 1.0,
+    'flush_tick': 0.25,
+    'flush_min_points': 1,
+    'flush_max_age': 10.0,
+    'flush_max_points': 500,
+    'flush_max_bytes': 20000,
+    'bulk_upload': 'False',
+    'event_send_delay': 0.1,
+    'event_latency_target': 1.0,
+    'event_max_points': 50,
+    'event_upload_max_concurrent': 2,
+    'event_upload_timeout': 5.0,
+    'memory_budget': 8000000,
+    'memory_low_water': 0.8,
+    'memory_policy': 'spill,downsample,priority,oldest',
+    'memory_max_gap': 60.0,
+    'memory_low_priority': 'magnet,gyro',
+    'snapshot': 'True',
+    'snapshot_file': '',
+    'snapshot_interval': 300.0,
+    'snapshot_max_age': 3600.0,
+    'senml_format': 'legacy',
+    'gzip': 'False',
+    'gzip_min_bytes': 512,
+    'value_precision': 4,
+    'time_precision': 3,
+    'uploader': 'agent',
+    'upload_max_concurrent': 4,
+    'upload_timeout': 10.0,
+    'breaker_failures': 3,
+    'backoff_initial': 2.0,
+    'backoff_max': 300.0,
+    'backoff_jitter': 0.5,
+    'retry_budget_ratio': 0.2,
+    'retry_budget_min': 1.0,
+    'journal': 'True',
+    'journal_file': '',
+    'journal_max_bytes': 50000000,
+    'journal_eviction': 'oldest',
+    'journal_commit_interval': 2.0,
+    'journal_drain_interval': 1.0,
+    'journal_drain_batches': 10,
+    'shards': 0,
+    'shard_report_interval': 5.0,
+    'shard_max_pending': 10000,
+    'shard_reply_timeout': 10.0,
+    'record': 'False',
+    'record_file': '',
+    'record_flush_interval': 5.0,
+    'record_max_bytes': 200000000,
+    'profile_file': '',
+    'profile_max_bytes': 1000000,
+    'profile_files': 3,
+    'profile_interval': 0.01,
+    'profile_max_depth': 48,
+    'profile_max_stacks': 5000,
+    'profile_memory_frames': 1,
+    'profile_top': 20,
+    'profile_report_interval': 30.0,
+    'profile_max_duration': 600.0,
+    'ingest_max_queue': 10000,
+    'ingest_batch': 500,
+    'ingest_block': 0.5,
+    'history': 'True',
+    'history_size': 256,
+    'history_max_series': 2000,
+    'metrics_interval': 0,
+    'metrics_port': 0,
+    'metrics_interface': '127.0.0.1',
+    'sinks': 'geras',
+    'sink_max_batches': 50,
+    'sink_delay': 1.0,
+    'sink_max_bytes': 5000000,
+    'file_sink_dir': '',
+    'file_sink_segment_bytes': 1000000,
+    'file_sink_segments': 20,
+    'file_sink_compress': 'True',
+    'broker_url': 'http://127.0.0.1:8081/',
+    'geras_url': 'http://geras.1248.io/series/',
     'geras_key': 'ea2f0e06ff8123b7f46f77a3a451731a'
 }
 
+# Approximate size of one buffered point once encoded as a SenML record
+BYTES_PER_POINT = 45
+
+def splitValues(values, deviceID):
+    """
+    Records of one upload by device. Bulk uploads (deviceID "") name their
+    records U_<deviceID>/<series>.
+    """
+    if deviceID:
+        return {deviceID: values}
+    byDevice = {}
+    for v in values:
+        path, name = v["n"].split("/", 1)
+        byDevice.setdefault(path[2:], []).append({"n": name, "v": v["v"], "t": v["t"]})
+    return byDevice
+
+# Series that carry discrete state changes; they go out through the event lane
+EVENT_SERIES = ("binary", "connected", "left_button", "right_button")
+
+class Lane:
+    """
+    One upload queue with its own buffers, flush policy, connections and
+    retry state, so that a backlog in one lane cannot hold up another.
+    """
+    def __init__(self, name, sendDelay, maxAge, minPoints, maxPoints, maxBytes, latencyTarget, uploader):
+        self.name = name
+        self.sendDelay = sendDelay
+        self.maxAge = maxAge
+        self.minPoints = minPoints
+        self.maxPoints = maxPoints
+        self.maxBytes = maxBytes
+        # Seconds from first buffered point to a successful post; 0 for none
+        self.latencyTarget = latencyTarget
+        self.uploader = uploader
+        self.breaker = CircuitBreaker(config["breaker_failures"],
+                                      Backoff(config["backoff_initial"], config["backoff_max"], config["backoff_jitter"]))
+        self.budget = RetryBudget(config["retry_budget_ratio"], config["retry_budget_min"])
+        self.s = {}
+        self.firstStored = {}
+        self.points = {}
+        self.bytes = {}
+        # Journal batches merged into the current buffers, removed once sent
+        self.pendingIds = {}
+        self.drainCursor = 0
+        self.flushCall = None
+
+# Buffer key prefix for points that are being sent again, so that the sinks do not get them twice
+RETRY_KEY = "~"
+
+def makeEncoder():
+    """ An encoder for the configured SenML format; Geras and each sink have their own, as each may downgrade it """
+    return Encoder(config["senml_format"], config["gzip"] == 'True',
+                   config["value_precision"], config["time_precision"], config["gzip_min_bytes"])
+
+def makeSinks(names, bridge_id, metrics):
+    """ The extra outputs named in config["sinks"]; geras is handled by DataManager itself """
+    sinks = []
+    for name in names:
+        args = (makeEncoder(), config["sink_max_batches"], config["sink_delay"], config["sink_max_bytes"],
+                Backoff(config["backoff_initial"], config["backoff_max"], config["backoff_jitter"]), metrics)
+        if name == "file":
+            directory = config["file_sink_dir"] or CB_CONFIG_DIR + "archive"
+            sinks.append(FileSink(directory, config["file_sink_segment_bytes"], config["file_sink_segments"],
+                                  config["file_sink_compress"] == 'True', *args))
+        elif name == "broker":
+            sinks.append(BrokerSink(config["broker_url"], bridge_id,
+                                    makeUploader(dict(config, upload_max_concurrent=1)), *args))
+        elif name != "geras":
+            logging.warning("%s Unknown sink: %s", ModuleName, name)
+    return sinks
+
 class DataManager:
     """ Managers data storage for all sensors """
-    def __init__(self, bridge_id):
-        self.baseurl = "http://geras.1248.io/series/" + bridge_id + "/"
-        self.s={}
-        self.waiting=[]
-
-    def sendValuesThread(self, values, deviceID):
-        url = self.baseurl + "U_" + deviceID
-        status = 0
-        logging.debug("%s sendValues, device: %s length: %s", ModuleName, deviceID, str(len(values)))
-        headers = {'Content-Type': 'application/json'}
-        try:
-            r = requests.post(url, auth=(config["geras_key"], ''), data=json.dumps({"e": values}), headers=headers)
-            status = r.status_code
-            success = True
-        except:
-            success = False
-        if status !=200 or not success:
-            logging.debug("%s sendValues failed, status: %s", ModuleName, status)
-            # On error, store the values that weren't sent ready to be sent again
-            reactor.callFromThread(self.storeValues, values, deviceID)
-
-    def sendValues(self, deviceID):
-        values = self.s[deviceID]
-        # Call in thread as it may take a second or two
-        self.waiting.remove(deviceID)
-        del self.s[deviceID]
-        reactor.callInThread(self.sendValuesThread, values, deviceID)
-
-    def storeValues(self, values, deviceID):
-        if not deviceID in self.s:
-            self.s[deviceID] = values
+    def __init__(self, bridge_id, metrics=None):
+        self.baseurl = config["geras_url"] + bridge_id + "/"
+        # Total points ever stored; lets callers tell whether a reading passed its filter
+        self.stored = 0
+        # Of those, the points that were new rather than stored again to be resent
+        self.fresh = 0
+        # Bytes held in all lanes' buffers, kept below memory_budget by the memory_policy steps
+        self.bufferBytes = 0
+        self.memoryBudget = config["memory_budget"]
+        shedSteps = {"spill": self.shedSpill,
+                     "downsample": self.shedDownsample,
+                     "priority": self.shedPriority,
+                     "oldest": self.shedOldest}
+        self.memoryPolicy = []
+        for step in config["memory_policy"].split(","):
+            step = step.strip()
+            if step in shedSteps:
+                self.memoryPolicy.append(shedSteps[step])
+            elif step:
+                logging.warning("%s Unknown memory_policy step: %s", ModuleName, step)
+        self.lowPriority = [p.strip() for p in config["memory_low_priority"].split(",") if p.strip()]
+        self.metrics = metrics or Metrics()
+        self.auth = {'Authorization': 'Basic ' + base64.b64encode((config["geras_key"] + ':').encode('ascii')).decode('ascii')}
+        # Geras's own; the sinks have theirs
+        self.encoder = makeEncoder()
+        # Events are sent in small batches as soon as they arrive; continuous series are batched up
+        self.eventLane = Lane("event", config["event_send_delay"], config["flush_max_age"], 1,
+                              config["event_max_points"], config["flush_max_bytes"],
+                              config["event_latency_target"], makeUploader(config, "event_"))
+        self.bulkLane = Lane("bulk", config["send_delay"], config["flush_max_age"], config["flush_min_points"],
+                             config["flush_max_points"], config["flush_max_bytes"], 0, makeUploader(config))
+        self.lanes = (self.eventLane, self.bulkLane)
+        self.laneOf = dict((name, self.eventLane) for name in EVENT_SERIES)
+        sinks = [n.strip() for n in config["sinks"].split(",")]
+        self.geras = "geras" in sinks
+        # Extra outputs, sent the same batches as Geras
+        self.sinks = makeSinks(sinks, bridge_id, self.metrics)
+        # Recent readings, answered locally to history requests from the concentrator
+        self.history = None
+        if config["history"] == 'True':
+            self.history = History(config["history_size"], config["history_max_series"])
+        self.journal = None
+        if config["journal"] == 'True' and self.geras:
+            journalFile = config["journal_file"] or CB_CONFIG_DIR + "uwe_app.journal"
+            try:
+                self.journal = Journal(journalFile, config["journal_max_bytes"],
+                                       config["journal_eviction"], config["journal_commit_interval"])
+            except Exception as ex:
+                logging.warning("%s Cannot open journal %s, unsent data kept in memory only", ModuleName, journalFile)
+                logging.warning("%s Exception: %s %s", ModuleName, type(ex), str(ex.args))
+        # One periodic tick decides which devices are due, rather than a timer per device
+        self.flushLoop = task.LoopingCall(self.flushTick)
+        self.flushLoop.start(config["flush_tick"], now=False)
+        if self.journal is not None:
+            self.drainLoop = task.LoopingCall(self.drainJournal)
+            self.drainLoop.start(config["journal_drain_interval"], now=False)
+        self.shutdownTrigger = reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        self.metrics.gauge("buffer_devices", lambda: sum(len(lane.s) for lane in self.lanes))
+        self.metrics.gauge("buffer_points", lambda: sum(sum(lane.points.values()) for lane in self.lanes))
+        self.metrics.gauge("buffer_bytes", lambda: self.bufferBytes)
+        self.metrics.gauge("buffer_bytes_by_device", self.bytesByDevice)
+        self.metrics.gauge("buffer_bytes_by_series", self.bytesBySeries)
+        self.metrics.gauge("uploads_in_flight", lambda: dict((lane.name, lane.uploader.stats.inFlight) for lane in self.lanes))
+        self.metrics.gauge("breaker", lambda: dict((lane.name, lane.breaker.state) for lane in self.lanes))
+        if self.history is not None:
+            self.metrics.gauge("history", lambda: {"series": self.history.series,
+                                                   "bytes": self.history.nbytes(),
+                                                   "refused": self.history.refused})
+        if self.journal is not None:
+            self.metrics.gauge("journal_batches", lambda: len(self.journal) if self.journal else 0)
+            self.metrics.gauge("journal_bytes", lambda: self.journal.bytes if self.journal else 0)
+            self.metrics.gauge("journal_evicted", lambda: self.journal.evictedBatches if self.journal else 0)
+
+    def stop(self):
+        """ Move anything still buffered into the journal so it survives a restart """
+        if not self.flushLoop.running:
+            return
+        self.flushLoop.stop()
+        reactor.removeSystemEventTrigger(self.shutdownTrigger)
+        for lane in self.lanes:
+            if lane.flushCall is not None and lane.flushCall.active():
+                lane.flushCall.cancel()
+            lane.flushCall = None
+        if self.journal is not None:
+            self.drainLoop.stop()
+        if self.journal is not None or self.sinks:
+            for lane in self.lanes:
+                for deviceID in list(lane.s.keys()):
+                    values, ids, first, fresh = self.takeValues(lane, deviceID)
+                    self.fanOut(deviceID, fresh)
+                    if self.journal is not None:
+                        self.toJournal(lane, values, deviceID, ids)
+        for sink in self.sinks:
+            sink.stop()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def url(self, deviceID):
+        """ Per-device series URL, or the bridge URL for a bulk post (deviceID "") """
+        if deviceID:
+            return self.baseurl + "U_" + deviceID
+        return self.baseurl
+
+    def onSent(self, lane, status, latency, values, deviceID, ids, first):
+        if status == 200:
+            lane.breaker.record(True)
+            if ids:
+                self.journal.remove(ids)
+            if lane.latencyTarget and reactor.seconds() - first > lane.latencyTarget:
+                self.metrics.incr(lane.name + "_over_target")
+            return
+        if 400 <= status < 500 and status not in (408, 429):
+            # The endpoint is up but will never accept this batch
+            logging.warning("%s Upload rejected with status %s, dropping %s values", ModuleName, status, len(values))
+            lane.breaker.record(True)
+            if ids:
+                self.journal.remove(ids)
+            return
+        logging.debug("%s sendValues failed, lane: %s status: %s", ModuleName, lane.name, status)
+        lane.breaker.record(False)
+        if self.journal is not None:
+            for d, v in splitValues(values, deviceID).items():
+                self.journal.append(d, v, lane.name)
+            if ids:
+                self.journal.commit()
+                self.journal.remove(ids)
+        else:
+            # On error, store the values that weren't sent so they go with the next batch
+            for d, v in splitValues(values, deviceID).items():
+                self.storeValues(v, d, lane)
+
+    def toJournal(self, lane, values, deviceID, ids):
+        """ Replace the journal batches in ids with values """
+        self.journal.append(deviceID, values, lane.name)
+        if ids:
+            self.journal.commit()
+            self.journal.remove(ids)
+
+    def drainJournal(self):
+        """
+        Merge journalled batches, oldest first, into the buffers so that they go
+        out with the next flush rather than as extra requests. While a lane's circuit
+        is not closed, only one batch is taken, as the probe, and only if nothing is
+        buffered in the lane to probe with. The retry budget limits the rate.
+        """
+        if not len(self.journal):
+            return
+        for lane in self.lanes:
+            if lane.breaker.state == "closed":
+                self.drainLane(lane, config["journal_drain_batches"])
+            elif not lane.firstStored and lane.breaker.probeDue():
+                # No new readings would open the circuit again, however long the endpoint has been back
+                if self.drainLane(lane, 1):
+                    self.flushLane(lane, True)
+
+    def drainLane(self, lane, batches):
+        """ Merge up to batches journal batches of a lane into its buffers; returns how many were """
+        drained = 0
+        for batchID, deviceID, values in self.journal.peek(batches, lane.drainCursor, lane.name):
+            if not lane.budget.withdraw():
+                break
+            lane.drainCursor = batchID
+            self.storeValues(values, deviceID, lane)
+            lane.pendingIds.setdefault(deviceID, []).append(batchID)
+            drained += 1
+        return drained
+
+    def flushTick(self):
+        for lane in self.lanes:
+            self.flushLane(lane)
+
+    def onLaneTimer(self, lane):
+        lane.flushCall = None
+        self.flushLane(lane, True)
+
+    def flushLane(self, lane, force=False):
+        """
+        Flush devices whose buffers have waited the lane's send delay and hold at
+        least its minimum points, or have waited flush_max_age whatever their size.
+        force flushes every device in the lane.
+        """
+        now = reactor.seconds()
+        due = []
+        for deviceID, first in lane.firstStored.items():
+            age = now - first
+            if force or age >= lane.maxAge or \
+               (age >= lane.sendDelay and lane.points[deviceID] >= lane.minPoints):
+                due.append(deviceID)
+        if not due:
+            return
+        if not lane.breaker.allow():
+            for deviceID in due:
+                if self.journal is not None and now - lane.firstStored[deviceID] >= lane.maxAge:
+                    # Endpoint unhealthy: keep old buffers on disk rather than in memory
+                    values, ids, first, fresh = self.takeValues(lane, deviceID)
+                    self.fanOut(deviceID, fresh)
+                    self.toJournal(lane, values, deviceID, ids)
+                elif self.sinks:
+                    # The sinks need not wait for Geras
+                    self.releaseToSinks(lane, deviceID)
+            return
+        if lane.breaker.state == "half_open":
+            # A single probe
+            due = due[:1]
+        # One batch that cannot be sent must not stop the flush loop for every other device
+        if config["bulk_upload"] == 'True':
+            try:
+                self.sendBulk(lane, due)
+            except Exception as ex:
+                self.sendFailed(lane, ", ".join(due), ex)
         else:
-            self.s[deviceID].append(values)
-        if not deviceID in self.waiting:
-            reactor.callLater(config["send_delay"], self.sendValues, deviceID)
-            self.waiting.append(deviceID)
+            for deviceID in due:
+                try:
+                    self.sendValues(lane, deviceID)
+                except Exception as ex:
+                    self.sendFailed(lane, deviceID, ex)
+
+    def sendFailed(self, lane, deviceID, ex):
+        logging.warning("%s Cannot send %s batch of %s: %s %s", ModuleName, lane.name, deviceID, type(ex), str(ex.args))
+        self.metrics.incr("send_errors")
+
+    def takeValues(self, lane, deviceID, prefix=""):
+        """
+        Empty a device's buffers in a lane; returns its records, the journal ids
+        they include, when the first of them was buffered and the records that
+        are new to the sinks. Those are the same list unless some are being sent again.
+        """
+        buffers = lane.s.pop(deviceID)
+        first = lane.firstStored.pop(deviceID)
+        del lane.points[deviceID]
+        self.bufferBytes -= lane.bytes.pop(deviceID)
+        ids = lane.pendingIds.pop(deviceID, [])
+        values = bufferRecords(buffers, prefix)
+        fresh = values
+        if self.sinks and [k for k in buffers if k.startswith(RETRY_KEY)]:
+            fresh = bufferRecords(dict((k, b) for k, b in buffers.items() if not k.startswith(RETRY_KEY)), prefix)
+        return values, ids, first, fresh
+
+    def sendValues(self, lane, deviceID):
+        if deviceID not in lane.s:
+            # Buffer was handed to the journal by stop()
+            return
+        values, ids, first, fresh = self.takeValues(lane, deviceID)
+        logging.debug("%s sendValues, lane: %s device: %s length: %s", ModuleName, lane.name, deviceID, str(len(values)))
+        self.post(lane, values, deviceID, ids, first, fresh)
+
+    def sendBulk(self, lane, deviceIDs):
+        """ Send several devices' series in one request """
+        values = []
+        ids = []
+        fresh = []
+        first = reactor.seconds()
+        for deviceID in deviceIDs:
+            v, i, f, fr = self.takeValues(lane, deviceID, "U_" + deviceID + "/")
+            values.extend(v)
+            ids.extend(i)
+            fresh.extend(fr)
+            first = min(first, f)
+        logging.debug("%s sendBulk, lane: %s devices: %s length: %s", ModuleName, lane.name, len(deviceIDs), str(len(values)))
+        self.post(lane, values, "", ids, first, values if len(fresh) == len(values) else fresh)
+
+    def post(self, lane, values, deviceID, ids, first, fresh):
+        """ Send to Geras and the sinks; outputs with the same encoding share it unless some values are retries """
+        batch = Batch(deviceID, values)
+        if self.sinks and fresh:
+            self.sinkPut(batch if fresh is values else Batch(deviceID, fresh))
+        if not self.geras:
+            return
+        lane.budget.deposit()
+        self.upload(lane, values, deviceID,
+                    lambda status, latency: self.onSent(lane, status, latency, values, deviceID, ids, first),
+                    batch.encoded(self.encoder))
+
+    def fanOut(self, deviceID, values):
+        """ Values leaving the buffers other than by a post still go to the sinks """
+        if self.sinks and values:
+            self.sinkPut(Batch(deviceID, values))
+
+    def releaseToSinks(self, lane, deviceID):
+        """ Send a device's new points to the sinks now, keeping them for Geras as retries """
+        buffers = lane.s[deviceID]
+        fresh = [k for k in buffers if not k.startswith(RETRY_KEY)]
+        if not fresh:
+            return
+        self.fanOut(deviceID, bufferRecords(dict((k, buffers[k]) for k in fresh)))
+        for k in fresh:
+            b = buffers.pop(k)
+            r = buffers.get(RETRY_KEY + k)
+            if r is None:
+                buffers[RETRY_KEY + k] = b
+            else:
+                r.t.extend(b.t)
+                r.v.extend(b.v)
+
+    def sinkPut(self, batch):
+        for sink in self.sinks:
+            sink.put(batch)
+
+    def upload(self, lane, values, deviceID, callback, encoded=None):
+        body, headers = encoded or self.encoder.encode(values)
+        # The encoded headers may be shared with the sinks
+        headers = dict(headers)
+        headers.update(self.auth)
+        def done(status, latency):
+            self.metrics.upload(status, latency, lane.name)
+            # The server does not understand compact SenML or gzip
+            if status == 415 and self.encoder.downgrade():
+                logging.info("%s Upload format not accepted, falling back to plain SenML", ModuleName)
+                self.upload(lane, values, deviceID, callback)
+            else:
+                callback(status, latency)
+        lane.uploader.post(self.url(deviceID), body, headers, done)
+
+    def storeValues(self, values, deviceID, lane=None):
+        """ Add a list of SenML records, as returned by a failed upload """
+        for v in values:
+            self.storeValue(deviceID, v["n"], v["t"], v["v"], lane, True)
+
+    def storeValue(self, deviceID, name, timeStamp, v, lane=None, retry=False):
+        if lane is None:
+            lane = self.laneOf.get(name, self.bulkLane)
+        if not deviceID in lane.s:
+            lane.s[deviceID] = {}
+            lane.firstStored[deviceID] = reactor.seconds()
+            lane.points[deviceID] = 0
+            lane.bytes[deviceID] = 0
+            # A lane with a latency target does not wait for the next flush tick
+            if lane.latencyTarget and lane.flushCall is None:
+                lane.flushCall = reactor.callLater(lane.sendDelay, self.onLaneTimer, lane)
+        buffers = lane.s[deviceID]
+        key = RETRY_KEY + name if retry and self.sinks else name
+        if not key in buffers:
+            buffers[key] = SeriesBuffer(name)
+        b = buffers[key]
+        b.append(timeStamp, v)
+        if not retry:
+            self.fresh += 1
+            if self.history is not None:
+                self.history.append(deviceID, name, timeStamp, v)
+        lane.points[deviceID] += 1
+        lane.bytes[deviceID] += b.pointBytes
+        self.bufferBytes += b.pointBytes
+        self.stored += 1
+        # Flush early rather than let one device build up a large post, unless the endpoint is down
+        if (lane.points[deviceID] >= lane.maxPoints or \
+            lane.points[deviceID]*BYTES_PER_POINT >= lane.maxBytes) and lane.breaker.state == "closed":
+            self.sendValues(lane, deviceID)
+        elif self.bufferBytes > self.memoryBudget:
+            self.relieveMemory()
+
+    def storeRows(self, deviceID, names, timeStamps, columns):
+        """
+        The same as storeValue() for each name of each row in turn, with
+        columns holding one sequence per name. Rows are appended in bulk up
+        to the point where a lane flush or memory relief could happen, and
+        from there one value at a time, so buffers and uploads come out the same.
+        """
+        lane = self.laneOf.get(names[0], self.bulkLane)
+        width = len(names)
+        n = len(timeStamps)
+        i = 0
+        while i < n:
+            rows = 0
+            buffers = lane.s.get(deviceID)
+            if buffers is not None and all(name in buffers for name in names):
+                rows = n - i
+                if lane.breaker.state == "closed":
+                    flushAt = int(min(lane.maxPoints, -(-lane.maxBytes//BYTES_PER_POINT)))
+                    rows = min(rows, (flushAt - 1 - lane.points[deviceID])//width)
+                rowBytes = sum(buffers[name].pointBytes for name in names)
+                rows = min(rows, int((self.memoryBudget - self.bufferBytes)//rowBytes))
+            if rows <= 0:
+                for c in range(width):
+                    self.storeValue(deviceID, names[c], timeStamps[i], columns[c][i], lane)
+                i += 1
+                continue
+            times = timeStamps[i:i + rows]
+            for c in range(width):
+                values = columns[c][i:i + rows]
+                buffers[names[c]].extend(times, values)
+                if self.history is not None:
+                    self.history.extend(deviceID, names[c], times, values)
+            lane.points[deviceID] += rows*width
+            lane.bytes[deviceID] += rows*rowBytes
+            self.bufferBytes += rows*rowBytes
+            self.stored += rows*width
+            self.fresh += rows*width
+            i += rows
+
+    def bytesByDevice(self):
+        byDevice = {}
+        for lane in self.lanes:
+            for deviceID, n in lane.bytes.items():
+                byDevice[deviceID] = byDevice.get(deviceID, 0) + n
+        return byDevice
+
+    def bytesBySeries(self):
+        bySeries = {}
+        for lane in self.lanes:
+            for buffers in lane.s.values():
+                for b in buffers.values():
+                    bySeries[b.name] = bySeries.get(b.name, 0) + b.nbytes()
+        return bySeries
+
+    def relieveMemory(self):
+        """
+        Buffers are over memory_budget: apply the memory_policy steps in turn
+        until they are back under memory_low_water of the budget.
+        """
+        target = self.memoryBudget*config["memory_low_water"]
+        for step in self.memoryPolicy:
+            if self.bufferBytes <= target:
+                break
+            step(target)
+        if self.bufferBytes > self.memoryBudget:
+            self.metrics.incr("memory_over_budget")
+
+    def byAge(self):
+        """ (lane, deviceID) of every buffer, oldest first """
+        return sorted([(first, lane.name, deviceID, lane) for lane in self.lanes
+                       for deviceID, first in lane.firstStored.items()])
+
+    def dropDevice(self, lane, deviceID):
+        """ Discard a device's buffers in a lane; journal batches they include are read again later """
+        points = lane.points[deviceID]
+        values, ids, first, fresh = self.takeValues(lane, deviceID)
+        if ids:
+            lane.drainCursor = min(lane.drainCursor, min(ids) - 1)
+        return points
+
+    def shedSpill(self, target):
+        """ Move the oldest buffers to the journal; nothing is lost """
+        if self.journal is None:
+            return
+        for first, name, deviceID, lane in self.byAge():
+            if self.bufferBytes <= target:
+                break
+            points = lane.points[deviceID]
+            values, ids, first, fresh = self.takeValues(lane, deviceID)
+            self.fanOut(deviceID, fresh)
+            self.toJournal(lane, values, deviceID, ids)
+            self.metrics.incr("shed_spilled_points", points)
+
+    def shedDownsample(self, target):
+        """ Thin out the older half of every bulk series, down to one point per memory_max_gap """
+        lane = self.bulkLane
+        for deviceID, buffers in lane.s.items():
+            for b in buffers.values():
+                dropped = b.downsample(config["memory_max_gap"])
+                if dropped:
+                    lane.points[deviceID] -= dropped
+                    lane.bytes[deviceID] -= dropped*b.pointBytes
+                    self.bufferBytes -= dropped*b.pointBytes
+                    self.metrics.incr("shed_downsampled_points", dropped)
+
+    def shedPriority(self, target):
+        """ Drop whole bulk series named in memory_low_priority, in the order given """
+        lane = self.bulkLane
+        for prefix in self.lowPriority:
+            if self.bufferBytes <= target:
+                break
+            for deviceID in list(lane.s.keys()):
+                buffers = lane.s[deviceID]
+                for name in [k for k, b in buffers.items() if b.name.startswith(prefix)]:
+                    b = buffers[name]
+                    if len(buffers) == 1:
+                        self.metrics.incr("shed_priority_points", self.dropDevice(lane, deviceID))
+                        break
+                    del buffers[name]
+                    lane.points[deviceID] -= len(b)
+                    lane.bytes[deviceID] -= b.nbytes()
+                    self.bufferBytes -= b.nbytes()
+                    self.metrics.incr("shed_priority_points", len(b))
+
+    def shedOldest(self, target):
+        """ Drop the oldest buffers outright """
+        for first, name, deviceID, lane in self.byAge():
+            if self.bufferBytes <= target:
+                break
+            self.metrics.incr("shed_oldest_points", self.dropDevice(lane, deviceID))
 
     def storeAccel(self, deviceID, timeStamp, a):
-        values = [
-                  {"n":"accel_x", "v":a[0], "t":timeStamp},
-                  {"n":"accel_y", "v":a[1], "t":timeStamp},
-                  {"n":"accel_z", "v":a[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "accel_x", timeStamp, a[0])
+        self.storeValue(deviceID, "accel_y", timeStamp, a[1])
+        self.storeValue(deviceID, "accel_z", timeStamp, a[2])
 
     def storeTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "temperature", timeStamp, temp)
 
     def storeIrTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"ir_temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "ir_temperature", timeStamp, temp)
 
     def storeHumidity(self, deviceID, timeStamp, h):
-        values = [
-                  {"n":"humidity", "v":h, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "humidity", timeStamp, h)
 
     def storeButtons(self, deviceID, timeStamp, buttons):
-        values = [
-                  {"n":"left_button", "v":buttons["leftButton"], "t":timeStamp},
-                  {"n":"right_button", "v":buttons["rightButton"], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "left_button", timeStamp, buttons["leftButton"])
+        self.storeValue(deviceID, "right_button", timeStamp, buttons["rightButton"])
 
     def storeGyro(self, deviceID, timeStamp, gyro):
-        values = [
-                  {"n":"gyro_x", "v":gyro[0], "t":timeStamp},
-                  {"n":"gyro_y", "v":gyro[1], "t":timeStamp},
-                  {"n":"gyro_z", "v":gyro[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "gyro_x", timeStamp, gyro[0])
+        self.storeValue(deviceID, "gyro_y", timeStamp, gyro[1])
+        self.storeValue(deviceID, "gyro_z", timeStamp, gyro[2])
 
     def storeMagnet(self, deviceID, timeStamp, magnet):
-        values = [
-                  {"n":"magnet_x", "v":magnet[0], "t":timeStamp},
-                  {"n":"magnet_y", "v":magnet[1], "t":timeStamp},
-                  {"n":"magnet_z", "v":magnet[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "magnet_x", timeStamp, magnet[0])
+        self.storeValue(deviceID, "magnet_y", timeStamp, magnet[1])
+        self.storeValue(deviceID, "magnet_z", timeStamp, magnet[2])
 
     def storeBinary(self, deviceID, timeStamp, b):
-        values = [
-                  {"n":"binary", "v":b, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "binary", timeStamp, b)
 
     def storeLuminance(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"luminance", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "luminance", timeStamp, v)
 
     def storePower(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"power", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "power", timeStamp, v)
 
     def storeBattery(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"battery", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "battery", timeStamp, v)
 
     def storeConnected(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"connected", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+        self.storeValue(deviceID, "connected", timeStamp, v)
+
+def sensorState(obj):
+    """ A sensor object's filter state, as saved in the snapshot """
+    state = dict((a, getattr(obj, a)) for a in obj.stateAttrs)
+    for s in ("stage", "features"):
+        stage = getattr(obj, s, None)
+        if stage:
+            state[s] = [type(stage).__name__, stage.snapshot()]
+    return state
+
+def restoreSensor(obj, state):
+    for a in obj.stateAttrs:
+        if a in state:
+            setattr(obj, a, state[a])
+    for s in ("stage", "features"):
+        stage = getattr(obj, s, None)
+        # Only if the sensor still uses the same kind of stage
+        if stage and s in state and state[s][0] == type(stage).__name__:
+            stage.restore(state[s][1])
+
+def makeStage(prefix, names, interval=0):
+    """
+    Processing stage that replaces a sensor's deadband, or None to keep it:
+    - a windowed aggregator if config[prefix + "_aggregate"] (or interval) is
+      a window length in seconds;
+    - a swinging-door compressor if config[prefix + "_compression"] asks for
+      one. The error bound is the sensor's existing min_change.
+    - an auto-tuned deadband if config[prefix + "_compression"] is auto, or
+      auto_thresholds is set. Its threshold stays between auto_threshold_floor
+      and auto_threshold_ceiling times min_change.
+    """
+    interval = config[prefix + "_aggregate"] or interval
+    if interval:
+        return SeriesAggregator(names, interval, config["aggregate_lateness"],
+                                config["aggregate_variance"] == 'True')
+    if config[prefix + "_compression"] == "swinging_door":
+        return SeriesCompressor(names, config[prefix + "_min_change"])
+    if config[prefix + "_compression"] == "auto" or config["auto_thresholds"] == 'True':
+        minChange = config[prefix + "_min_change"]
+        return AutoDeadband(names, minChange*config["auto_threshold_floor"],
+                            minChange*config["auto_threshold_ceiling"], config["auto_noise_alpha"])
+    return None
+
+def makeFeatures(prefix):
+    """
+    Motion features stage if config[prefix + "_features"] is replace (features
+    only) or alongside (features and the usual points), else None. A sample
+    counts as activity beyond 2.5 times min_change from the window mean, and
+    the sensor is moving while the spread is above min_change.
+    """
+    if config[prefix + "_features"] not in ("replace", "alongside"):
+        return None
+    minChange = config[prefix + "_min_change"]
+    return MotionFeatures(prefix, config["motion_window"], config["motion_hop"], 2.5*minChange, minChange)
+
+def processAxesBlock(obj, prefix, names, timeStamps, columns):
+    """
+    A block of samples from a 3-axis sensor, columns holding the x, y and z
+    sequences, through the sensor's features, stage or deadband. Stores what
+    one message per sample would have stored, in the same order. The block
+    is split where the features emit; each part goes through the deadband or
+    the aggregator as a whole, and through other stages row by row.
+    Returns the number of samples that stored anything.
+    """
+    dm = obj.dm
+    features = getattr(obj, "features", None)
+    replace = features is not None and config[prefix + "_features"] == "replace"
+    n = len(timeStamps)
+    arrays = None
+    if not replace and isinstance(obj.stage, SeriesAggregator):
+        arrays = blockArrays(timeStamps, columns)
+    passed = set()
+    start = 0
+    while start < n:
+        end = n
+        if features:
+            stored = dm.stored
+            features.update(dm, obj.id, timeStamps[start], [c[start] for c in columns])
+            if dm.stored != stored:
+                passed.add(start)
+            end = features.nextEmit(arrays[0] if arrays else timeStamps, start + 1)
+            features.extend(timeStamps, columns, start + 1, end)
+        if not replace:
+            passed.update(i + start for i in processAxesRows(obj, prefix, names, timeStamps, columns,
+                                                            arrays, start, end))
+        start = end
+    return len(passed)
+
+def processAxesRows(obj, prefix, names, timeStamps, columns, arrays, start, end):
+    """ Rows start to end of a block through the stage or deadband; returns the indices, from start, that stored """
+    dm = obj.dm
+    whole = start == 0 and end == len(timeStamps)
+    if not obj.stage:
+        cols = columns if whole else [c[start:end] for c in columns]
+        rows = deadbandRows(obj.previous, cols, config[prefix + "_min_change"])
+        if rows:
+            dm.storeRows(obj.id, names, [timeStamps[start + i] for i in rows], [[c[i] for i in rows] for c in cols])
+            obj.previous = [c[rows[-1]] for c in cols]
+        return rows
+    if arrays is not None and isinstance(obj.stage, SeriesAggregator):
+        return obj.stage.updateBlock(dm, obj.id, arrays[0][start:end], arrays[1][:, start:end])
+    rows = []
+    for i in range(start, end):
+        stored = dm.stored
+        obj.stage.update(dm, obj.id, timeStamps[i], [c[i] for c in columns])
+        if dm.stored != stored:
+            rows.append(i - start)
+    return rows
 
 class Accelerometer:
+    # Filter state that is kept across restarts, see sensorState()
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.previous = [0.0, 0.0, 0.0]
         self.id = id
+        self.stage = makeStage("accel", ("accel_x", "accel_y", "accel_z"))
+        self.features = makeFeatures("accel")
 
     def processAccel(self, resp):
         accel = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
         timeStamp = resp["timeStamp"]
+        if self.features:
+            self.features.update(self.dm, self.id, timeStamp, accel)
+            if config["accel_features"] == "replace":
+                return
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, accel)
+            return
         event = False
         for a in range(3):
             if abs(accel[a] - self.previous[a]) > config["accel_min_change"]:
@@ -181,26 +912,27 @@ class Accelerometer:
             self.dm.storeAccel(self.id, timeStamp, accel)
             self.previous = accel
 
+    def processBlock(self, timeStamps, columns):
+        return processAxesBlock(self, "accel", ("accel_x", "accel_y", "accel_z"), timeStamps, columns)
+
 class TemperatureMeasure():
     """ Either send temp every minute or when it changes. """
+    stateAttrs = ("powerTemp",)
+
     def __init__(self, id):
         # self.mode is either regular or on_change
-        self.mode = "on_change"
+        self.mode = config["temp_mode"]
         self.minChange = 0.2
         self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
         self.powerTemp = 0.0
+        # Regular mode sends a summary of each minute
+        self.stage = makeStage("temp", ("temperature",), 60 if self.mode == "regular" else 0)
 
     def processTemp (self, resp):
         timeStamp = resp["timeStamp"] 
         temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [temp])
         else:
             if abs(temp-self.powerTemp) >= config["temp_min_change"]:
                 self.dm.storeTemp(self.id, timeStamp, temp) 
@@ -208,30 +940,30 @@ class TemperatureMeasure():
 
 class IrTemperatureMeasure():
     """ Either send temp every minute or when it changes. """
+    stateAttrs = ("powerTemp",)
+
     def __init__(self, id):
         # self.mode is either regular or on_change
-        self.mode = "on_change"
+        self.mode = config["irtemp_mode"]
         self.minChange = 0.2
         self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
         self.powerTemp = 0.0
+        # Regular mode sends a summary of each minute
+        self.stage = makeStage("irtemp", ("ir_temperature",), 60 if self.mode == "regular" else 0)
 
     def processIrTemp (self, resp):
         timeStamp = resp["timeStamp"] 
         temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeIrTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [temp])
         else:
             if abs(temp-self.powerTemp) >= config["irtemp_min_change"]:
                 self.dm.storeIrTemp(self.id, timeStamp, temp) 
                 self.powerTemp = temp
 
 class Buttons():
+    stateAttrs = ()
+
     def __init__(self, id):
         self.id = id
 
@@ -241,13 +973,24 @@ class Buttons():
         self.dm.storeButtons(self.id, timeStamp, buttons)
 
 class Gyro():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
         self.previous = [0.0, 0.0, 0.0]
+        self.stage = makeStage("gyro", ("gyro_x", "gyro_y", "gyro_z"))
+        self.features = makeFeatures("gyro")
 
     def processGyro(self, resp):
         gyro = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
         timeStamp = resp["timeStamp"] 
+        if self.features:
+            self.features.update(self.dm, self.id, timeStamp, gyro)
+            if config["gyro_features"] == "replace":
+                return
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, gyro)
+            return
         event = False
         for a in range(3):
             if abs(gyro[a] - self.previous[a]) > config["gyro_min_change"]:
@@ -257,14 +1000,23 @@ class Gyro():
             self.dm.storeGyro(self.id, timeStamp, gyro)
             self.previous = gyro
 
+    def processBlock(self, timeStamps, columns):
+        return processAxesBlock(self, "gyro", ("gyro_x", "gyro_y", "gyro_z"), timeStamps, columns)
+
 class Magnet():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
         self.previous = [0.0, 0.0, 0.0]
+        self.stage = makeStage("magnet", ("magnet_x", "magnet_y", "magnet_z"))
 
     def processMagnet(self, resp):
         mag = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
         timeStamp = resp["timeStamp"] 
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, mag)
+            return
         event = False
         for a in range(3):
             if abs(mag[a] - self.previous[a]) > config["magnet_min_change"]:
@@ -274,23 +1026,35 @@ class Magnet():
             self.dm.storeMagnet(self.id, timeStamp, mag)
             self.previous = mag
 
+    def processBlock(self, timeStamps, columns):
+        return processAxesBlock(self, "magnet", ("magnet_x", "magnet_y", "magnet_z"), timeStamps, columns)
+
 class Humid():
     """ Either send temp every minute or when it changes. """
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
         self.previous = 0.0
+        self.stage = makeStage("humidity", ("humidity",))
 
     def processHumidity (self, resp):
         h = resp["data"]
         timeStamp = resp["timeStamp"] 
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [h])
+            return
         if abs(h-self.previous) >= config["humidity_min_change"]:
             self.dm.storeHumidity(self.id, timeStamp, h) 
             self.previous = h
 
 class Binary():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
-        self.previous = 0
+        # None until the first reading, or restored from the snapshot
+        self.previous = None
 
     def processBinary(self, resp):
         timeStamp = resp["timeStamp"] 
@@ -300,54 +1064,77 @@ class Binary():
         else:
             bi = 0
         if bi != self.previous:
-            self.dm.storeBinary(self.id, timeStamp-1.0, self.previous)
+            if self.previous is not None:
+                self.dm.storeBinary(self.id, timeStamp-1.0, self.previous)
             self.dm.storeBinary(self.id, timeStamp, bi)
             self.previous = bi
 
 class Luminance():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
         self.previous = 0
+        self.stage = makeStage("luminance", ("luminance",))
 
     def processLuminance(self, resp):
         v = resp["data"]
         timeStamp = resp["timeStamp"] 
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [v])
+            return
         if abs(v-self.previous) >= config["luminance_min_change"]:
             self.dm.storeLuminance(self.id, timeStamp, v) 
             self.previous = v
 
 class Power():
+    stateAttrs = ("previous", "previousTime")
+
     def __init__(self, id):
         self.id = id
         self.previous = 0
-        self.previousTime = time.time()
+        self.stage = makeStage("power", ("power",))
+        # None until the first reading, or restored from the snapshot
+        self.previousTime = None
 
     def processPower(self, resp):
         v = resp["data"]
         timeStamp = resp["timeStamp"] 
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [v])
+            return
         if abs(v-self.previous) >= config["power_min_change"]:
-            if timeStamp - self.previousTime > 2:
+            if self.previousTime is not None and timeStamp - self.previousTime > 2:
                 self.dm.storePower(self.id, timeStamp-1.0, self.previous)
             self.dm.storePower(self.id, timeStamp, v) 
             self.previous = v
             self.previousTime = timeStamp
 
 class Battery():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
         self.previous = 0
+        self.stage = makeStage("battery", ("battery",))
 
     def processBattery(self, resp):
         v = resp["data"]
         timeStamp = resp["timeStamp"] 
+        if self.stage:
+            self.stage.update(self.dm, self.id, timeStamp, [v])
+            return
         if abs(v-self.previous) >= config["battery_min_change"]:
             self.dm.storeBattery(self.id, timeStamp, v) 
             self.previous = v
 
 class Connected():
+    stateAttrs = ("previous",)
+
     def __init__(self, id):
         self.id = id
-        self.previous = 0
+        # None until the first reading, or restored from the snapshot
+        self.previous = None
 
     def processConnected(self, resp):
         v = resp["data"]
@@ -357,7 +1144,8 @@ class Connected():
         else:
             b = 0
         if b != self.previous:
-            self.dm.storeConnected(self.id, timeStamp-1.0, self.previous)
+            if self.previous is not None:
+                self.dm.storeConnected(self.id, timeStamp-1.0, self.previous)
             self.dm.storeConnected(self.id, timeStamp, b) 
             self.previous = b
 
@@ -383,6 +1171,11 @@ class App(CbApp):
             elif c.lower in ("false", "f", "0"):
                 config[c] = False
         logging.debug('%s Config: %s', ModuleName, config)
+        self.setup()
+        #CbApp.__init__ MUST be called
+        CbApp.__init__(self, argv)
+
+    def setup(self):
         self.accel = []
         self.gyro = []
         self.magnet = []
@@ -398,8 +1191,62 @@ class App(CbApp):
         self.devices = []
         self.devServices = [] 
         self.idToName = {} 
-        #CbApp.__init__ MUST be called
-        CbApp.__init__(self, argv)
+        self.handlers = {}
+        # (adaptor id, characteristic): (sensor object, the list it is in)
+        self.sensors = {}
+        # Last service request sent to each adaptor, and the adaptive polling state of its series
+        self.serviceReqs = {}
+        self.polling = {}
+        self.dm = None
+        self.metrics = Metrics()
+        self.metrics.gauge("threadpool", threadPoolGauge)
+        # Bound here to keep onAdaptorData cheap
+        self.received = self.metrics.received
+        self.emitted = self.metrics.emitted
+        self.router = None
+        if config["shards"]:
+            # Sensors and DataManagers run in worker processes; this one only routes to them
+            self.router = ShardRouter(self, config)
+        # Adaptor messages arrive on cbcommslib threads and are processed on the reactor
+        self.ingest = IngestQueue(self.router.route if self.router else self.processAdaptorData,
+                                  config["ingest_max_queue"], config["ingest_batch"], config["ingest_block"],
+                                  self.metrics)
+        self.recorder = None
+        if config["record"] == 'True':
+            # What arrives from the manager and adaptors, for uwe_replay
+            self.recorder = Recorder(config["record_file"] or CB_CONFIG_DIR + "uwe_app.rec",
+                                     config["record_flush_interval"], config["record_max_bytes"], self.metrics)
+        # Off until the concentrator asks for a profile
+        self.profiler = Profiler(self, config, config["profile_file"] or CB_CONFIG_DIR + "uwe_app.profile")
+        self.metrics.gauge("profiling", self.profiler.running)
+        if config["metrics_interval"]:
+            self.metricsLoop = task.LoopingCall(self.sendMetrics)
+            self.metricsLoop.start(config["metrics_interval"], now=False)
+        if config["metrics_port"]:
+            listenMetrics(self.router or self.metrics, config["metrics_port"], config["metrics_interface"])
+        # Sensor filter state from the last run, applied as each sensor is created
+        self.restored = {}
+        if self.router:
+            return
+        if config["snapshot"] == 'True':
+            self.snapshotFile = config["snapshot_file"] or CB_CONFIG_DIR + "uwe_app.snapshot"
+            self.loadSnapshot()
+            self.snapshotLoop = task.LoopingCall(self.saveSnapshot)
+            self.snapshotLoop.start(config["snapshot_interval"], now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.saveSnapshot)
+        if config["auto_thresholds"] == 'True' or \
+           [k for k in config if k.endswith("_compression") and config[k] == "auto"]:
+            # Shared by every auto deadband; tuneThresholds() moves it to meet the points budget
+            self.thresholdScale = 3.0
+            self.tuneStored = 0
+            self.tuneTime = reactor.seconds()
+            self.tuneLoop = task.LoopingCall(self.tuneThresholds)
+            self.tuneLoop.start(config["auto_threshold_check"], now=False)
+            self.metrics.gauge("threshold_scale", lambda: round(self.thresholdScale, 3))
+        if config["adaptive_polling"] == 'True':
+            self.pollingLoop = task.LoopingCall(self.checkPolling)
+            self.pollingLoop.start(config["polling_check_interval"], now=False)
+            self.metrics.gauge("polling_slowed", lambda: sum(1 for c in self.polling.values() if c.interval != c.base))
 
     def setState(self, action):
         if action == "clear_error":
@@ -427,176 +1274,438 @@ class App(CbApp):
                        }
                   }
             self.sendMessage(msg, "conc")
+        elif resp["resp"] == "metrics":
+            self.sendMetrics()
+        elif resp["resp"] == "history":
+            if self.router:
+                self.router.history(resp)
+            else:
+                self.sendHistory(resp)
+        elif resp["resp"] == "profile":
+            if self.router:
+                # Each worker profiles itself; the router answers once for all of them
+                self.router.profile(resp)
+            else:
+                self.sendProfile(resp)
         else:
             msg = {"appID": self.id,
                    "msg": "error",
                    "message": "unrecognised response from concentrator"}
             self.sendMessage(msg, "conc")
 
+    def sendMetrics(self):
+        msg = {
+           "msg": "req",
+           "verb": "post",
+           "channel": int(self.id[3:]),
+           "body": {
+                    "msg": "metrics",
+                    "appID": self.id,
+                    "metrics": (self.router or self.metrics).snapshot()
+                   }
+              }
+        self.sendMessage(msg, "conc")
+
+    def historyDevices(self, req):
+        """
+        The readings for a history request: the latest reading of each series by default,
+        the "last" n readings, or those from "start" up to "end", for "device"
+        and "series" if given. Each device's readings are a compact SenML pack.
+        """
+        history = self.dm.history if self.dm else None
+        if history is None:
+            return {}
+        found = history.query(req.get("device"), req.get("series"), req.get("last"),
+                              req.get("start"), req.get("end"))
+        return dict((d, compactRecords(records, config["value_precision"], config["time_precision"]))
+                    for d, records in found.items())
+
+    def sendHistory(self, req, devices=None):
+        """ Answers a history request, with devices if the shards have already found them """
+        if devices is None:
+            devices = self.historyDevices(req)
+        msg = {
+           "msg": "req",
+           "verb": "post",
+           "channel": int(self.id[3:]),
+           "body": {
+                    "msg": "history",
+                    "appID": self.id,
+                    "ref": req.get("ref"),
+                    "devices": devices
+                   }
+              }
+        self.sendMessage(msg, "conc")
+
+    def sendProfile(self, req, profiling=None):
+        """ Starts, stops or reports on profiling, as req["action"] says, and answers with its status """
+        if profiling is None:
+            profiling = self.profiler.control(req)
+        msg = {
+           "msg": "req",
+           "verb": "post",
+           "channel": int(self.id[3:]),
+           "body": {
+                    "msg": "profile",
+                    "appID": self.id,
+                    "ref": req.get("ref"),
+                    "profiling": profiling
+                   }
+              }
+        self.sendMessage(msg, "conc")
+
     def onAdaptorData(self, message):
         """
-        This method is called in a thread by cbcommslib so it will not cause
-        problems if it takes some time to complete (other than to itself).
+        This method is called in a thread by cbcommslib. The message is queued
+        for processAdaptorData on the reactor thread, which owns the sensor
+        filters and the DataManager.
+        """
+        if self.recorder:
+            self.recorder.record("data", message)
+        self.ingest.put(message)
+
+    def onAdaptorBlock(self, message):
         """
+        A block of samples of one characteristic, buffered by the adaptor:
+        "timeStamps" is a list and "data" either a list or, for 3-axis
+        sensors, a dict of lists. Processed as one message per sample would be.
+        """
+        if self.recorder:
+            self.recorder.record("data", message)
+        self.ingest.put(message)
+
+    def processAdaptorData(self, message):
         #logging.debug("%s onadaptorData, message: %s", ModuleName, message)
-        if message["characteristic"] == "acceleration":
-            for a in self.accel:
-                if a.id == self.idToName[message["id"]]: 
-                    a.processAccel(message)
-                    break
-        elif message["characteristic"] == "temperature":
-            for t in self.temp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processTemp(message)
-                    break
-        elif message["characteristic"] == "ir_temperature":
-            for t in self.irTemp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processIrTemp(message)
-                    break
-        elif message["characteristic"] == "gyro":
-            for g in self.gyro:
-                if g.id == self.idToName[message["id"]]:
-                    g.processGyro(message)
-                    break
-        elif message["characteristic"] == "magnetometer":
-            for g in self.magnet:
-                if g.id == self.idToName[message["id"]]:
-                    g.processMagnet(message)
-                    break
-        elif message["characteristic"] == "buttons":
-            for b in self.buttons:
-                if b.id == self.idToName[message["id"]]:
-                    b.processButtons(message)
-                    break
-        elif message["characteristic"] == "humidity":
-            for b in self.humidity:
-                if b.id == self.idToName[message["id"]]:
-                    b.processHumidity(message)
-                    break
-        elif message["characteristic"] == "binary_sensor":
-            for b in self.binary:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBinary(message)
-                    break
-        elif message["characteristic"] == "power":
-            for b in self.power:
-                if b.id == self.idToName[message["id"]]:
-                    b.processPower(message)
-                    break
-        elif message["characteristic"] == "battery":
-            for b in self.battery:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBattery(message)
-                    break
-        elif message["characteristic"] == "connected":
-            for b in self.connected:
-                if b.id == self.idToName[message["id"]]:
-                    b.processConnected(message)
-                    break
-        elif message["characteristic"] == "luminance":
-            for b in self.luminance:
-                if b.id == self.idToName[message["id"]]:
-                    b.processLuminance(message)
-                    break
-
-    def onAdaptorService(self, message):
+        if "timeStamps" in message:
+            self.processAdaptorBlock(message)
+            return
+        characteristic = message["characteristic"]
+        self.received[characteristic] += 1
+        # One lookup per message: the handler table is filled by onAdaptorService
+        key = (message["id"], characteristic)
+        handler = self.handlers.get(key)
+        if handler:
+            dm = self.dm
+            stored = dm.stored
+            handler(message)
+            passed = dm.stored != stored
+            if passed:
+                self.emitted[characteristic] += 1
+            controller = self.polling.get(key)
+            if controller is not None:
+                controller.sample(passed)
+        else:
+            self.metrics.counters["unhandled"] += 1
+
+    def processAdaptorBlock(self, message):
+        characteristic = message["characteristic"]
+        timeStamps = message["timeStamps"]
+        data = message["data"]
+        key = (message["id"], characteristic)
+        entry = self.sensors.get(key) if key in self.handlers else None
+        processBlock = getattr(entry[0], "processBlock", None) if entry else None
+        if processBlock is None:
+            # No block form for this sensor: one message per sample
+            for i in range(len(timeStamps)):
+                sample = dict((k, v[i]) for k, v in data.items()) if isinstance(data, dict) else data[i]
+                self.processAdaptorData({"id": message["id"], "characteristic": characteristic,
+                                         "timeStamp": timeStamps[i], "data": sample})
+            return
+        self.received[characteristic] += len(timeStamps)
+        passed = processBlock(timeStamps, [data["x"], data["y"], data["z"]])
+        self.emitted[characteristic] += passed
+        controller = self.polling.get(key)
+        if controller is not None:
+            controller.samples(len(timeStamps), passed)
+
+    def onAdaptorService(self, message, record=True):
+        """ record is False when the app services an adaptor again itself, as replay will too """
         #logging.debug("%s onAdaptorService, message: %s", ModuleName, message)
+        if self.recorder and record:
+            self.recorder.record("service", message)
+        # An adaptor may announce its services more than once; keep only the latest
+        self.devServices = [d for d in self.devServices if d["id"] != message["id"]]
         self.devServices.append(message)
+        if self.router:
+            # The shard's worker sends the service request
+            self.router.service(message)
+            self.setState("running")
+            return
         serviceReq = []
         for p in message["service"]:
             # Based on services offered & whether we want to enable them
             if p["characteristic"] == "temperature":
                 if config["temperature"] == 'True':
-                    self.temp.append(TemperatureMeasure((self.idToName[message["id"]])))
-                    self.temp[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "temperature", TemperatureMeasure, self.temp)
+                    self.handlers[(message["id"], "temperature")] = obj.processTemp
                     serviceReq.append({"characteristic": "temperature",
                                        "interval": config["slow_polling_interval"]})
             elif p["characteristic"] == "ir_temperature":
                 if config["irtemperature"] == 'True':
-                    self.irTemp.append(IrTemperatureMeasure(self.idToName[message["id"]]))
-                    self.irTemp[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "ir_temperature", IrTemperatureMeasure, self.irTemp)
+                    self.handlers[(message["id"], "ir_temperature")] = obj.processIrTemp
                     serviceReq.append({"characteristic": "ir_temperature",
                                        "interval": config["slow_polling_interval"]})
             elif p["characteristic"] == "acceleration":
                 if config["accel"] == 'True':
-                    self.accel.append(Accelerometer((self.idToName[message["id"]])))
+                    obj = self.sensor(message["id"], "acceleration", Accelerometer, self.accel)
+                    self.handlers[(message["id"], "acceleration")] = obj.processAccel
                     serviceReq.append({"characteristic": "acceleration",
                                        "interval": config["accel_polling_interval"]})
-                    self.accel[-1].dm = self.dm
             elif p["characteristic"] == "gyro":
                 if config["gyro"] == 'True':
-                    self.gyro.append(Gyro(self.idToName[message["id"]]))
-                    self.gyro[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "gyro", Gyro, self.gyro)
+                    self.handlers[(message["id"], "gyro")] = obj.processGyro
                     serviceReq.append({"characteristic": "gyro",
                                        "interval": config["gyro_polling_interval"]})
             elif p["characteristic"] == "magnetometer":
                 if config["magnet"] == 'True': 
-                    self.magnet.append(Magnet(self.idToName[message["id"]]))
-                    self.magnet[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "magnetometer", Magnet, self.magnet)
+                    self.handlers[(message["id"], "magnetometer")] = obj.processMagnet
                     serviceReq.append({"characteristic": "magnetometer",
                                        "interval": config["magnet_polling_interval"]})
             elif p["characteristic"] == "buttons":
                 if config["buttons"] == 'True':
-                    self.buttons.append(Buttons(self.idToName[message["id"]]))
-                    self.buttons[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "buttons", Buttons, self.buttons)
+                    self.handlers[(message["id"], "buttons")] = obj.processButtons
                     serviceReq.append({"characteristic": "buttons",
                                        "interval": 0})
             elif p["characteristic"] == "humidity":
                 if config["humidity"] == 'True':
-                    self.humidity.append(Humid(self.idToName[message["id"]]))
-                    self.humidity[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "humidity", Humid, self.humidity)
+                    self.handlers[(message["id"], "humidity")] = obj.processHumidity
                     serviceReq.append({"characteristic": "humidity",
                                        "interval": config["slow_polling_interval"]})
             elif p["characteristic"] == "binary_sensor":
                 if config["binary"] == 'True':
-                    self.binary.append(Binary(self.idToName[message["id"]]))
-                    self.binary[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "binary_sensor", Binary, self.binary)
+                    self.handlers[(message["id"], "binary_sensor")] = obj.processBinary
                     serviceReq.append({"characteristic": "binary_sensor",
                                        "interval": 0})
             elif p["characteristic"] == "power":
                 if config["power"] == 'True':
-                    self.power.append(Power(self.idToName[message["id"]]))
-                    self.power[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "power", Power, self.power)
+                    self.handlers[(message["id"], "power")] = obj.processPower
                     serviceReq.append({"characteristic": "power",
                                        "interval": 0})
             elif p["characteristic"] == "battery":
                 if config["battery"] == 'True':
-                    self.battery.append(Battery(self.idToName[message["id"]]))
-                    self.battery[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "battery", Battery, self.battery)
+                    self.handlers[(message["id"], "battery")] = obj.processBattery
                     serviceReq.append({"characteristic": "battery",
                                        "interval": 0})
             elif p["characteristic"] == "connected":
                 if config["connected"] == 'True':
-                    self.connected.append(Connected(self.idToName[message["id"]]))
-                    self.connected[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "connected", Connected, self.connected)
+                    self.handlers[(message["id"], "connected")] = obj.processConnected
                     serviceReq.append({"characteristic": "connected",
                                        "interval": 0})
             elif p["characteristic"] == "luminance":
                 if config["luminance"] == 'True':
-                    self.luminance.append(Luminance(self.idToName[message["id"]]))
-                    self.luminance[-1].dm = self.dm
+                    obj = self.sensor(message["id"], "luminance", Luminance, self.luminance)
+                    self.handlers[(message["id"], "luminance")] = obj.processLuminance
                     serviceReq.append({"characteristic": "luminance",
                                        "interval": 0})
+        # Characteristics no longer offered or enabled
+        enabled = [r["characteristic"] for r in serviceReq]
+        for key in [k for k in self.sensors if k[0] == message["id"] and k[1] not in enabled]:
+            self.removeSensor(key)
+        self.serviceReqs[message["id"]] = serviceReq
+        if config["adaptive_polling"] == 'True':
+            # Announcing services again starts every series at its configured interval
+            for r in serviceReq:
+                key = (message["id"], r["characteristic"])
+                obj = self.sensors[key][0] if key in self.sensors else None
+                # What a stage or features store says how often they emit, not how active the sensor is,
+                # and they are configured for the sample rate they were given
+                staged = getattr(obj, "stage", None) or getattr(obj, "features", None)
+                if 0 < r["interval"] < config["polling_max_interval"] and not staged:
+                    self.polling[key] = PollingController(r["interval"], config["polling_max_interval"],
+                                                          config["polling_quiet_ratio"], config["polling_busy_ratio"],
+                                                          config["polling_quiet_checks"], config["polling_min_samples"])
+                else:
+                    self.polling.pop(key, None)
         msg = {"id": self.id,
                "request": "service",
                "service": serviceReq}
         self.sendMessage(msg, message["id"])
         self.setState("running")
 
+    def sensor(self, adtID, characteristic, cls, sensors):
+        """ The adaptor's existing object for characteristic, so that its state survives, or a new one """
+        key = (adtID, characteristic)
+        if key not in self.sensors:
+            obj = cls(self.idToName[adtID])
+            obj.dm = self.dm
+            state = self.restored.pop(adtID + "/" + characteristic, None)
+            if state is not None:
+                try:
+                    restoreSensor(obj, state)
+                except Exception as ex:
+                    logging.warning("%s Cannot restore %s %s: %s", ModuleName, adtID, characteristic, str(ex))
+            sensors.append(obj)
+            self.sensors[key] = (obj, sensors)
+        return self.sensors[key][0]
+
+    def loadSnapshot(self):
+        try:
+            with open(self.snapshotFile, 'r') as f:
+                snapshot = json.load(f)
+        except Exception as ex:
+            logging.info("%s No sensor snapshot loaded: %s", ModuleName, str(ex))
+            return
+        age = time.time() - snapshot["saved"]
+        if age > config["snapshot_max_age"]:
+            logging.info("%s Sensor snapshot is %.0f s old, ignored", ModuleName, age)
+            return
+        self.restored = snapshot["sensors"]
+        self.restoredSaved = snapshot["saved"]
+        logging.info("%s Restoring filter state of %s sensors", ModuleName, len(self.restored))
+
+    def saveSnapshot(self):
+        """ Write the filter state of every sensor, atomically """
+        sensors = {}
+        # Sensors from the last run whose adaptors have not come back yet, until they expire
+        if self.restored and time.time() - self.restoredSaved <= config["snapshot_max_age"]:
+            sensors.update(self.restored)
+        else:
+            self.restored = {}
+        for (adtID, characteristic), (obj, l) in self.sensors.items():
+            sensors[adtID + "/" + characteristic] = sensorState(obj)
+        try:
+            with open(self.snapshotFile + ".tmp", 'w') as f:
+                json.dump({"saved": time.time(), "sensors": sensors}, f, separators=(",", ":"))
+            os.rename(self.snapshotFile + ".tmp", self.snapshotFile)
+        except Exception as ex:
+            logging.warning("%s Cannot save sensor snapshot: %s %s", ModuleName, type(ex), str(ex.args))
+
+    def tuneThresholds(self):
+        """
+        Scale every auto deadband so that the bridge stores about
+        auto_points_per_minute points. Nothing changes while the rate is
+        between 80% and 100% of the budget.
+        """
+        if self.dm is None:
+            return
+        now = reactor.seconds()
+        if now <= self.tuneTime:
+            return
+        # Points resent from the journal or after a failed upload are not counted
+        rate = (self.dm.fresh - self.tuneStored)*60.0/(now - self.tuneTime)
+        self.tuneStored = self.dm.fresh
+        self.tuneTime = now
+        ratio = rate/config["auto_points_per_minute"]
+        if ratio > 1.0 or ratio < 0.8:
+            step = min(2.0, max(0.5, ratio**0.5))
+            self.thresholdScale = min(200.0, max(0.5, self.thresholdScale*step))
+        for obj, sensors in self.sensors.values():
+            stage = getattr(obj, "stage", None)
+            if isinstance(stage, AutoDeadband):
+                stage.scale = self.thresholdScale
+
+    def checkPolling(self):
+        """ Ask adaptors whose series have gone quiet, or become active again, for a new interval """
+        changed = {}
+        for (adtID, characteristic), controller in self.polling.items():
+            interval = controller.check()
+            if interval is not None:
+                changed.setdefault(adtID, {})[characteristic] = interval
+        for adtID, intervals in changed.items():
+            serviceReq = self.serviceReqs[adtID]
+            for r in serviceReq:
+                if r["characteristic"] in intervals:
+                    r["interval"] = intervals[r["characteristic"]]
+            logging.debug("%s Polling intervals for %s: %s", ModuleName, adtID, intervals)
+            self.metrics.incr("polling_changes", len(intervals))
+            msg = {"id": self.id,
+                   "request": "service",
+                   "service": serviceReq}
+            self.sendMessage(msg, adtID)
+
+    def removeSensor(self, key):
+        obj, sensors = self.sensors.pop(key)
+        # Store what the sensor's stages hold back, such as open windows, or it goes with them
+        for s in ("features", "stage"):
+            stage = getattr(obj, s, None)
+            if stage and hasattr(stage, "flush"):
+                stage.flush(self.dm, obj.id)
+        sensors.remove(obj)
+        self.handlers.pop(key, None)
+        self.polling.pop(key, None)
+
+    def removeSensors(self, adtID):
+        """ For an adaptor removed or renamed: its sensors, once they have stored what they held, and its history """
+        for key in [k for k in self.sensors if k[0] == adtID]:
+            self.removeSensor(key)
+        if self.dm is not None and self.dm.history is not None:
+            self.dm.history.remove(self.idToName[adtID])
+
     def onConfigureMessage(self, config):
-        """ Config is based on what sensors are available """
+        """
+        Config is based on what sensors are available. It is sent again whenever
+        adaptors are added or removed, so only the difference is applied: sensors,
+        filter state and buffered data of unchanged adaptors are kept.
+        """
+        if self.recorder:
+            self.recorder.record("configure", config)
+        names = {}
+        for adaptor in config["adaptors"]:
+            names[adaptor["id"]] = adaptor["friendly_name"].replace(" ", "_")
+        if self.router:
+            self.devices = [a["id"] for a in config["adaptors"]]
+            self.idToName = names
+            self.devServices = [d for d in self.devServices if d["id"] in names]
+            self.router.configure(config)
+            self.setState("running" if self.state == "running" else "starting")
+            return
+        if self.dm is None:
+            self.dm = DataManager(self.bridge_id, self.metrics)
+        for adtID in [a for a in self.devices if a not in names]:
+            logging.debug("%s Configure app. Adaptor removed: %s", ModuleName, adtID)
+            self.removeSensors(adtID)
+            self.devServices = [d for d in self.devServices if d["id"] != adtID]
+            self.serviceReqs.pop(adtID, None)
+            self.devices.remove(adtID)
+            del self.idToName[adtID]
         for adaptor in config["adaptors"]:
             adtID = adaptor["id"]
             if adtID not in self.devices:
-                # Because configure may be re-called if devices are added
-                name = adaptor["name"]
-                friendly_name = adaptor["friendly_name"]
-                logging.debug("%s Configure app. Adaptor name: %s", ModuleName, name)
-                self.idToName[adtID] = friendly_name.replace(" ", "_")
+                logging.debug("%s Configure app. Adaptor name: %s", ModuleName, adaptor["name"])
+                self.idToName[adtID] = names[adtID]
                 self.devices.append(adtID)
-        self.dm = DataManager(self.bridge_id)
-        self.setState("starting")
+            elif self.idToName[adtID] != names[adtID]:
+                # Renamed: its series go under the new name, so its sensors start afresh
+                logging.debug("%s Configure app. Adaptor renamed: %s", ModuleName, names[adtID])
+                self.removeSensors(adtID)
+                self.idToName[adtID] = names[adtID]
+                for message in [d for d in self.devServices if d["id"] == adtID]:
+                    self.onAdaptorService(message, record=False)
+        if self.state == "running":
+            # Still streaming from the adaptors that were kept
+            self.setState("running")
+        else:
+            self.setState("starting")
+
+class ShardApp(App):
+    """
+    The sensors and DataManager for one shard of the adaptors, in a worker
+    process run by ShardRouter. What it would send to the manager, adaptors
+    or concentrator goes back to the router, through send().
+    """
+    def __init__(self, appID, bridgeID, send):
+        self.appClass = "monitor"
+        self.state = "stopped"
+        self.status = "ok"
+        self.id = appID
+        self.bridge_id = bridgeID
+        self.send = send
+        self.setup()
+
+    def sendMessage(self, msg, dest):
+        self.send({"op": "message", "msg": msg, "dest": dest})
+
+    def sendManagerMessage(self, msg):
+        self.send({"op": "manager", "msg": msg})
 
 if __name__ == '__main__':
     App(sys.argv)
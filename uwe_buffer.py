@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# uwe_buffer.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Compact per-series buffers. Timestamps and values are held in parallel
+arrays and the series name is stored once; SenML records are only built
+when a buffer is flushed.
+"""
+from array import array
+
+# Series whose values are always whole numbers
+INTEGER_SERIES = ("binary", "connected", "left_button", "right_button")
+
+class SeriesBuffer:
+    __slots__ = ("name", "t", "v", "pointBytes")
+
+    def __init__(self, name):
+        self.name = name
+        self.t = array('d')
+        if name in INTEGER_SERIES:
+            self.v = array('i')
+        else:
+            self.v = array('d')
+        self.pointBytes = self.t.itemsize + self.v.itemsize
+
+    def append(self, timeStamp, value):
+        self.t.append(timeStamp)
+        self.v.append(value)
+
+    def extend(self, timeStamps, values):
+        self.t.extend(timeStamps)
+        self.v.extend(values)
+
+    def __len__(self):
+        return len(self.t)
+
+    def nbytes(self):
+        return len(self.t)*self.t.itemsize + len(self.v)*self.v.itemsize
+
+    def downsample(self, maxGap):
+        """
+        Drop every other point in the older half of the buffer, except where that
+        would leave more than maxGap seconds between the points either side.
+        Returns the number of points dropped.
+        """
+        t, v = self.t, self.v
+        half = len(t)//2
+        keepT = array('d')
+        keepV = array(v.typecode)
+        last = None
+        for i in range(half):
+            if i % 2 and last is not None and t[i + 1] - last <= maxGap:
+                continue
+            keepT.append(t[i])
+            keepV.append(v[i])
+            last = t[i]
+        dropped = half - len(keepT)
+        if dropped:
+            self.t = keepT + t[half:]
+            self.v = keepV + v[half:]
+        return dropped
+
+    def records(self, prefix=""):
+        """ The buffer as a list of SenML records, names prefixed with prefix """
+        n = prefix + self.name
+        return [{"n": n, "v": v, "t": t} for t, v in zip(self.t, self.v)]
+
+def bufferRecords(buffers, prefix=""):
+    """ Flatten a dict of name: SeriesBuffer into SenML records """
+    values = []
+    for b in buffers.values():
+        values.extend(b.records(prefix))
+    return values
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+# uwe_filters.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Streaming per-series stages that sensor classes can use in place of the
+simple min_change deadband.
+"""
+import math
+import bisect
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below these lengths plain Python is quicker than converting to arrays, as
+# measured by benchmarks/bench_batch.py --crossover. Blocks through the
+# aggregator or features gain from 10-25 samples, and feature windows from
+# about 30. Each deadband decision depends on the last sample stored, so it
+# gains only on long, quiet blocks, and loses on blocks with any movement
+# in them at every size measured, up to 5000 samples.
+NUMPY_MIN_SAMPLES = 16
+NUMPY_MIN_WINDOW = 32
+NUMPY_MIN_DEADBAND = 10000
+
+def blockArrays(timeStamps, columns):
+    """ A block as NumPy arrays of its times and of its columns, or None if it is too short or NumPy is missing """
+    if numpy is None or len(timeStamps) < NUMPY_MIN_SAMPLES:
+        return None
+    return numpy.asarray(timeStamps, dtype=float), numpy.asarray(columns, dtype=float)
+
+def deadbandRows(previous, columns, minChange):
+    """
+    Indices of the samples in a block from a 3-axis sensor that the
+    min_change deadband stores: those where any axis differs by more than
+    minChange from the last one stored, starting from previous. columns
+    holds the x, y and z sequences.
+    """
+    if numpy is None or len(columns[0]) < NUMPY_MIN_DEADBAND:
+        rows = []
+        rx, ry, rz = previous
+        i = 0
+        for x, y, z in zip(*columns):
+            if abs(x - rx) > minChange or abs(y - ry) > minChange or abs(z - rz) > minChange:
+                rows.append(i)
+                rx, ry, rz = x, y, z
+            i += 1
+        return rows
+    block = numpy.array(columns, dtype=float)
+    # Once a sample is stored, the next one is too if it differs from it by more than minChange
+    jumps = (numpy.abs(numpy.diff(block, axis=1)) > minChange).any(axis=0).tolist()
+    ref = numpy.array(previous, dtype=float).reshape(-1, 1)
+    n = block.shape[1]
+    rows = []
+    i = 0
+    # Search ahead in growing steps: a quiet stretch costs a few array operations
+    step = 256
+    while i < n:
+        hit = (numpy.abs(block[:, i:i + step] - ref) > minChange).any(axis=0)
+        first = int(hit.argmax())
+        if not hit[first]:
+            i += step
+            step = min(step*2, 65536)
+            continue
+        i += first
+        rows.append(i)
+        while i + 1 < n and jumps[i]:
+            i += 1
+            rows.append(i)
+        ref = block[:, i:i + 1]
+        i += 1
+        step = 256
+    return rows
+
+class SwingingDoor:
+    """
+    Swinging-door compression. Every sample lies within maxError of the
+    straight line joining the archived points either side of it. O(1) per
+    sample. update() returns the point to archive, or None.
+    The newest sample is held back until the door closes; flush() returns it.
+    """
+    __slots__ = ("maxError", "anchor", "last", "slopeLow", "slopeHigh")
+
+    def __init__(self, maxError):
+        self.maxError = maxError
+        self.anchor = None
+        self.last = None
+
+    def update(self, t, v):
+        if self.anchor is None:
+            self.anchor = (t, v)
+            return self.anchor
+        t0, v0 = self.anchor
+        dt = t - t0
+        if dt <= 0:
+            # Repeated timestamp: nothing to interpolate over
+            return None
+        slope = (v - v0)/dt
+        if self.last is None or self.slopeLow <= slope <= self.slopeHigh:
+            # A line from the anchor to this sample stays within the door
+            low = (v - v0 - self.maxError)/dt
+            high = (v - v0 + self.maxError)/dt
+            if self.last is None:
+                self.slopeLow, self.slopeHigh = low, high
+            else:
+                self.slopeLow = max(self.slopeLow, low)
+                self.slopeHigh = min(self.slopeHigh, high)
+            self.last = (t, v)
+            return None
+        # Door closed: archive the previous sample and start again from it
+        archived = self.last
+        t0, v0 = archived
+        dt = t - t0
+        self.anchor = archived
+        self.slopeLow = (v - v0 - self.maxError)/dt
+        self.slopeHigh = (v - v0 + self.maxError)/dt
+        self.last = (t, v)
+        return archived
+
+    def flush(self):
+        """ Archive the held-back sample, if any """
+        last = self.last
+        if last is not None:
+            self.anchor = last
+            self.last = None
+        return last
+
+class SeriesCompressor:
+    """ One SwingingDoor per named series, for sensors that report several axes """
+    def __init__(self, names, maxError):
+        self.names = names
+        self.doors = [SwingingDoor(maxError) for n in names]
+
+    def update(self, dm, deviceID, timeStamp, values):
+        for i in range(len(self.names)):
+            p = self.doors[i].update(timeStamp, values[i])
+            if p is not None:
+                dm.storeValue(deviceID, self.names[i], p[0], p[1])
+
+    def flush(self, dm, deviceID):
+        """ Store the sample each door holds back """
+        for i in range(len(self.names)):
+            p = self.doors[i].flush()
+            if p is not None:
+                dm.storeValue(deviceID, self.names[i], p[0], p[1])
+
+    def snapshot(self):
+        return [[d.anchor, d.last, getattr(d, "slopeLow", None), getattr(d, "slopeHigh", None)]
+                for d in self.doors]
+
+    def restore(self, state):
+        if len(state) != len(self.doors):
+            return
+        for d, (anchor, last, slopeLow, slopeHigh) in zip(self.doors, state):
+            d.anchor = tuple(anchor) if anchor is not None else None
+            d.last = tuple(last) if last is not None else None
+            if d.last is not None:
+                d.slopeLow, d.slopeHigh = slopeLow, slopeHigh
+
+class AutoDeadband:
+    """
+    Deadband whose threshold follows each series' own noise. The noise is a
+    winsorized running mean of the absolute change between samples, so that
+    occasional real movements do not inflate it. The threshold is scale times
+    the noise, kept between floor and ceiling; scale is set from outside to
+    hold the bridge to a points budget. A change beyond the threshold on any
+    series stores all of them, as the min_change deadband does.
+    """
+    def __init__(self, names, floor, ceiling, alpha):
+        self.names = names
+        self.floor = floor
+        self.ceiling = ceiling
+        self.alpha = alpha
+        self.scale = 3.0
+        self.noise = [None]*len(names)
+        self.last = [None]*len(names)
+        self.lastTime = None
+        self.previous = None
+
+    def thresholds(self):
+        return [min(self.ceiling, max(self.floor, self.scale*n)) if n is not None else self.floor
+                for n in self.noise]
+
+    def update(self, dm, deviceID, timeStamp, values):
+        for i in range(len(self.names)):
+            last = self.last[i]
+            if last is not None:
+                d = abs(values[i] - last)
+                n = self.noise[i]
+                if n is None:
+                    self.noise[i] = d
+                else:
+                    self.noise[i] = n + self.alpha*(min(d, 3*n + self.floor) - n)
+            self.last[i] = values[i]
+        self.lastTime = timeStamp
+        if self.previous is not None:
+            thresholds = self.thresholds()
+            for i in range(len(self.names)):
+                if abs(values[i] - self.previous[i]) > thresholds[i]:
+                    break
+            else:
+                return
+        self.previous = list(values)
+        for i in range(len(self.names)):
+            dm.storeValue(deviceID, self.names[i], timeStamp, values[i])
+
+    def flush(self, dm, deviceID):
+        """ Store the last sample if the deadband held it back, so that the series ends where it did """
+        if self.lastTime is not None and self.last != self.previous:
+            self.previous = list(self.last)
+            for i in range(len(self.names)):
+                dm.storeValue(deviceID, self.names[i], self.lastTime, self.last[i])
+
+    def snapshot(self):
+        return {"noise": self.noise, "last": self.last, "lastTime": self.lastTime, "previous": self.previous}
+
+    def restore(self, state):
+        if len(state["noise"]) == len(self.names):
+            self.noise = state["noise"]
+            self.last = state["last"]
+            self.lastTime = state.get("lastTime")
+            self.previous = state["previous"]
+
+class WindowStats:
+    """
+    count, min, max, and sums of the differences from the window's first
+    value, from which the mean and variance follow without the loss of
+    precision of plain sums of squares. O(1) updates.
+    """
+    __slots__ = ("count", "min", "max", "shift", "sum", "sumsq")
+
+    def __init__(self):
+        self.count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.shift = 0.0
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def add(self, v):
+        if not self.count:
+            self.shift = v
+        self.count += 1
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+        d = v - self.shift
+        self.sum += d
+        self.sumsq += d*d
+
+    def mean(self):
+        return self.shift + self.sum/self.count if self.count else 0.0
+
+    def variance(self):
+        if not self.count:
+            return 0.0
+        return max(0.0, (self.sumsq - self.sum*self.sum/self.count)/self.count)
+
+def addColumns(stats, block):
+    """
+    WindowStats.add() for each column of block, a 2-d NumPy array of finite
+    values, row i going to stats[i]. Rounds exactly as add() does.
+    """
+    for w, row in zip(stats, block):
+        if not w.count:
+            w.shift = float(row[0])
+    d = block - numpy.array([[w.shift] for w in stats])
+    dd = d*d
+    d[:, 0] += [w.sum for w in stats]
+    dd[:, 0] += [w.sumsq for w in stats]
+    # accumulate adds one value at a time, as add() does; reduce would not
+    sums = numpy.add.accumulate(d, axis=1)[:, -1].tolist()
+    sumsqs = numpy.add.accumulate(dd, axis=1)[:, -1].tolist()
+    lows = numpy.minimum.reduce(block, axis=1).tolist()
+    highs = numpy.maximum.reduce(block, axis=1).tolist()
+    n = block.shape[1]
+    for i, w in enumerate(stats):
+        w.count += n
+        if lows[i] < w.min:
+            w.min = lows[i]
+        if highs[i] > w.max:
+            w.max = highs[i]
+        w.sum = sums[i]
+        w.sumsq = sumsqs[i]
+
+class TumblingWindows:
+    """
+    Tumbling windows of interval seconds for one series. A window closes
+    once a sample arrives more than lateness seconds after its end; samples
+    for a window that has already closed are counted in late and dropped.
+    update() returns a list of (windowStart, WindowStats) that closed.
+    """
+    def __init__(self, interval, lateness):
+        self.interval = interval
+        self.lateness = lateness
+        self.windows = {}
+        # Start of the last window closed; comparing starts, rather than adding the
+        # interval to it, does not depend on rounding
+        self.lastClosed = None
+        self.watermark = None
+        self.late = 0
+
+    def update(self, t, v):
+        start = t - t % self.interval
+        if self.lastClosed is not None and start <= self.lastClosed:
+            self.late += 1
+            return []
+        if start not in self.windows:
+            self.windows[start] = WindowStats()
+        self.windows[start].add(v)
+        if self.watermark is None or t > self.watermark:
+            self.watermark = t
+        return self.close()
+
+    def close(self):
+        closed = []
+        # Only a handful of windows can be open at once, bounded by lateness/interval
+        for s in sorted(self.windows):
+            if s + self.interval + self.lateness <= self.watermark:
+                closed.append((s, self.windows.pop(s)))
+                self.lastClosed = s
+            else:
+                break
+        return closed
+
+    def takesBlock(self, times):
+        """ Whether a block with times, a NumPy array in order, can be added a run at a time """
+        return self.watermark is None or times[0] >= self.watermark
+
+    def flush(self):
+        closed = [(s, self.windows[s]) for s in sorted(self.windows)]
+        if closed:
+            self.lastClosed = closed[-1][0]
+        self.windows = {}
+        return closed
+
+    def snapshot(self):
+        return {"interval": self.interval,
+                "windows": [[s, w.count, w.min, w.max, w.shift, w.sum, w.sumsq] for s, w in self.windows.items()],
+                "lastClosed": self.lastClosed,
+                "watermark": self.watermark,
+                "late": self.late}
+
+    def restore(self, state):
+        if state["interval"] != self.interval:
+            # Windows would not line up
+            return
+        self.windows = {}
+        for window in state["windows"]:
+            w = WindowStats()
+            if len(window) == 6:
+                # Saved as mean and sum of squared deviations
+                s, w.count, w.min, w.max, w.shift, w.sumsq = window
+            else:
+                s, w.count, w.min, w.max, w.shift, w.sum, w.sumsq = window
+            self.windows[s] = w
+        if "lastClosed" in state:
+            self.lastClosed = state["lastClosed"]
+        elif state.get("closedBefore") is not None:
+            self.lastClosed = state["closedBefore"] - self.interval
+        self.watermark = state["watermark"]
+        self.late = state["late"]
+
+class SeriesAggregator:
+    """
+    Replaces raw points with per-window summaries: <name>_min, _max, _mean,
+    _count and optionally _var, stamped with the start of the window.
+    """
+    def __init__(self, names, interval, lateness, variance=False):
+        self.names = names
+        self.variance = variance
+        self.windows = [TumblingWindows(interval, lateness) for n in names]
+
+    def update(self, dm, deviceID, timeStamp, values):
+        for i in range(len(self.names)):
+            windows = self.windows[i]
+            late = windows.late
+            for start, stats in windows.update(timeStamp, values[i]):
+                self.emit(dm, deviceID, self.names[i], start, stats)
+            if windows.late != late:
+                dm.metrics.incr("aggregate_late")
+
+    def updateBlock(self, dm, deviceID, timeStamps, columns):
+        """
+        update() for each row of a block, timeStamps being a NumPy array and
+        columns a 2-d one with a row per name. Summaries come out exactly as
+        from update(), in the same order. Returns the indices of the rows
+        that closed windows.
+        """
+        late = sum(w.late for w in self.windows)
+        rows = self.addBlock(dm, deviceID, timeStamps, columns)
+        late = sum(w.late for w in self.windows) - late
+        if late:
+            dm.metrics.incr("aggregate_late", late)
+        return rows
+
+    def addBlock(self, dm, deviceID, timeStamps, columns):
+        """
+        The series share timestamps, so their windows open and close
+        together: each run of rows in the same window is added at once, split
+        where the watermark passes the end of the earliest open window.
+        """
+        lead = self.windows[0]
+        if not ((timeStamps[1:] >= timeStamps[:-1]).all() and numpy.isfinite(columns).all() and
+                lead.takesBlock(timeStamps)):
+            # Out of order, or not numbers: one row at a time
+            rows = []
+            for i, row in enumerate(zip(timeStamps.tolist(), *columns.tolist())):
+                for c in range(len(self.names)):
+                    closed = self.windows[c].update(row[0], row[c + 1])
+                    for start, stats in closed:
+                        self.emit(dm, deviceID, self.names[c], start, stats)
+                    if closed and rows[-1:] != [i]:
+                        rows.append(i)
+            return rows
+        n = len(timeStamps)
+        starts = timeStamps - timeStamps % lead.interval
+        edges = ((starts[1:] != starts[:-1]).nonzero()[0] + 1).tolist()
+        rows = []
+        for a, b in zip([0] + edges, edges + [n]):
+            start = float(starts[a])
+            if lead.lastClosed is not None and start <= lead.lastClosed:
+                for w in self.windows:
+                    w.late += b - a
+                continue
+            for w in self.windows:
+                if start not in w.windows:
+                    w.windows[start] = WindowStats()
+            stats = [w.windows[start] for w in self.windows]
+            while a < b:
+                end = min(lead.windows) + lead.interval + lead.lateness
+                # The first row to take the watermark to the end of the earliest window
+                k = a + int(timeStamps[a:b].searchsorted(end))
+                addColumns(stats, columns[:, a:min(k, b - 1) + 1])
+                watermark = float(timeStamps[min(k, b - 1)])
+                for w in self.windows:
+                    w.watermark = watermark
+                if k >= b:
+                    break
+                rows.append(k)
+                for i, w in enumerate(self.windows):
+                    for s, closed in w.close():
+                        self.emit(dm, deviceID, self.names[i], s, closed)
+                if start not in lead.windows:
+                    # Closed itself: the rest of the run is late
+                    for w in self.windows:
+                        w.late += b - k - 1
+                    break
+                a = k + 1
+        return rows
+
+    def flush(self, dm, deviceID):
+        for i in range(len(self.names)):
+            for start, stats in self.windows[i].flush():
+                self.emit(dm, deviceID, self.names[i], start, stats)
+
+    def snapshot(self):
+        """ Open windows, so that a restart does not split them """
+        return [w.snapshot() for w in self.windows]
+
+    def restore(self, state):
+        if len(state) == len(self.windows):
+            for w, ws in zip(self.windows, state):
+                w.restore(ws)
+
+    def emit(self, dm, deviceID, name, start, stats):
+        dm.storeValue(deviceID, name + "_min", start, stats.min)
+        dm.storeValue(deviceID, name + "_max", start, stats.max)
+        dm.storeValue(deviceID, name + "_mean", start, stats.mean())
+        dm.storeValue(deviceID, name + "_count", start, stats.count)
+        if self.variance:
+            dm.storeValue(deviceID, name + "_var", start, stats.variance())
+
+class MotionFeatures:
+    """
+    Activity features of a 3-axis sensor over sliding windows of window
+    seconds, every hop seconds. Samples are only appended as they arrive;
+    the maths is done once per window over the whole batch, with NumPy for
+    long windows. Per window,
+    stamped with its end:
+      <prefix>_vm      mean vector magnitude
+      <prefix>_sma     signal magnitude area of the dynamic (mean removed) part
+      <prefix>_counts  samples whose magnitude differs from the window mean by
+                       more than countThreshold
+      <prefix>_moving  1 once the magnitude's standard deviation exceeds
+                       stillThreshold, 0 again once it drops below half of it
+    """
+    def __init__(self, prefix, window, hop, countThreshold, stillThreshold):
+        self.names = [prefix + "_vm", prefix + "_sma", prefix + "_counts", prefix + "_moving"]
+        self.window = window
+        self.hop = hop
+        self.countThreshold = countThreshold
+        self.stillThreshold = stillThreshold
+        self.t = array('d')
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        self.nextEnd = None
+        self.moving = 0
+
+    def update(self, dm, deviceID, timeStamp, values):
+        if self.nextEnd is None:
+            self.nextEnd = timeStamp - timeStamp % self.hop + self.hop
+        while timeStamp >= self.nextEnd:
+            self.emit(dm, deviceID, self.nextEnd)
+            if self.t:
+                self.nextEnd += self.hop
+            else:
+                # Nothing buffered: skip the empty windows of a gap in the data
+                self.nextEnd = timeStamp - timeStamp % self.hop + self.hop
+        self.t.append(timeStamp)
+        self.x.append(values[0])
+        self.y.append(values[1])
+        self.z.append(values[2])
+
+    def nextEmit(self, timeStamps, start):
+        """
+        Index of the first row of a block from start on whose update() would
+        emit, or the length of the block. timeStamps may be a NumPy array.
+        """
+        if numpy is not None and isinstance(timeStamps, numpy.ndarray):
+            due = timeStamps[start:] >= self.nextEnd
+            i = int(due.argmax()) if len(due) else 0
+            return start + i if len(due) and due[i] else len(timeStamps)
+        for i in range(start, len(timeStamps)):
+            if timeStamps[i] >= self.nextEnd:
+                return i
+        return len(timeStamps)
+
+    def extend(self, timeStamps, columns, start, end):
+        """ update() for rows start to end of a block, none of which emit """
+        self.t.extend(timeStamps[start:end])
+        self.x.extend(columns[0][start:end])
+        self.y.extend(columns[1][start:end])
+        self.z.extend(columns[2][start:end])
+
+    def emit(self, dm, deviceID, end):
+        i = bisect.bisect_left(self.t, end - self.window)
+        j = bisect.bisect_left(self.t, end)
+        if j > i:
+            vmMean, sma, counts, std = self.measure(i, j)
+            if std > self.stillThreshold:
+                self.moving = 1
+            elif std < self.stillThreshold/2:
+                self.moving = 0
+            for name, v in zip(self.names, (vmMean, sma, counts, self.moving)):
+                dm.storeValue(deviceID, name, end, v)
+        # Keep only what the next window needs
+        k = bisect.bisect_left(self.t, end + self.hop - self.window)
+        if k:
+            del self.t[:k], self.x[:k], self.y[:k], self.z[:k]
+
+    def measure(self, i, j):
+        """ Mean magnitude, SMA, counts and standard deviation of the magnitude of rows i to j """
+        n = j - i
+        if numpy is not None and n >= NUMPY_MIN_WINDOW:
+            # Views of the arrays, released before emit() trims them
+            xs, ys, zs = [numpy.frombuffer(a)[i:j] for a in (self.x, self.y, self.z)]
+            vm = numpy.sqrt(xs*xs + ys*ys + zs*zs)
+            vmMean = float(vm.sum())/n
+            sma = float(numpy.abs(xs - float(xs.sum())/n).sum() + numpy.abs(ys - float(ys.sum())/n).sum() +
+                        numpy.abs(zs - float(zs.sum())/n).sum())/n
+            dev = numpy.abs(vm - vmMean)
+            return vmMean, sma, int((dev > self.countThreshold).sum()), math.sqrt(float((dev*dev).sum())/n)
+        xs, ys, zs = self.x[i:j], self.y[i:j], self.z[i:j]
+        mx, my, mz = sum(xs)/n, sum(ys)/n, sum(zs)/n
+        vm = [math.sqrt(a*a + b*b + c*c) for a, b, c in zip(xs, ys, zs)]
+        vmMean = sum(vm)/n
+        sma = (sum([abs(a - mx) for a in xs]) + sum([abs(b - my) for b in ys]) +
+               sum([abs(c - mz) for c in zs]))/n
+        dev = [abs(v - vmMean) for v in vm]
+        counts = len([d for d in dev if d > self.countThreshold])
+        return vmMean, sma, counts, math.sqrt(sum([d*d for d in dev])/n)
+
+    def flush(self, dm, deviceID):
+        """ Emit the window that is filling, stamped with its end as update() would have """
+        if self.t:
+            self.emit(dm, deviceID, self.nextEnd)
+            del self.t[:], self.x[:], self.y[:], self.z[:]
+
+    def snapshot(self):
+        return {"moving": self.moving}
+
+    def restore(self, state):
+        self.moving = state["moving"]
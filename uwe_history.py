@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# uwe_history.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Recent readings kept on the bridge, so that local dashboards can ask the
+concentrator for them rather than going to Geras. Each series has a ring of
+fixed size, allocated once; an append overwrites the oldest reading.
+"""
+from array import array
+
+class RingBuffer:
+    """
+    The last size readings of one series. Readings are stored in the order
+    they were stored by the DataManager, which is time order for each series,
+    so a time range is found by binary search.
+    """
+    __slots__ = ("t", "v", "size", "start", "count")
+
+    def __init__(self, size):
+        self.t = array('d', [0.0])*size
+        self.v = array('d', [0.0])*size
+        self.size = size
+        # Index of the oldest reading
+        self.start = 0
+        self.count = 0
+
+    def append(self, timeStamp, value):
+        if self.count < self.size:
+            i = self.start + self.count
+            if i >= self.size:
+                i -= self.size
+            self.count += 1
+        else:
+            i = self.start
+            self.start += 1
+            if self.start == self.size:
+                self.start = 0
+        self.t[i] = timeStamp
+        self.v[i] = value
+
+    def extend(self, timeStamps, values):
+        """ append() for each reading, copying slices rather than one reading at a time """
+        n = len(timeStamps)
+        if n >= self.size:
+            self.t = array('d', timeStamps[n - self.size:])
+            self.v = array('d', values[n - self.size:])
+            self.start = 0
+            self.count = self.size
+            return
+        i = self._index(self.count)
+        first = min(n, self.size - i)
+        self.t[i:i + first] = array('d', timeStamps[:first])
+        self.v[i:i + first] = array('d', values[:first])
+        if first < n:
+            self.t[:n - first] = array('d', timeStamps[first:])
+            self.v[:n - first] = array('d', values[first:])
+        overwritten = max(0, self.count + n - self.size)
+        self.count = min(self.size, self.count + n)
+        self.start = self._index(overwritten)
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return self.size*(self.t.itemsize + self.v.itemsize)
+
+    def _index(self, n):
+        """ Position in the arrays of the n'th oldest reading """
+        i = self.start + n
+        return i - self.size if i >= self.size else i
+
+    def _slice(self, first, last):
+        """ [(t, v)] for the first'th to last'th oldest readings, last excluded """
+        t, v = self.t, self.v
+        return [(t[i], v[i]) for i in (self._index(n) for n in range(first, last))]
+
+    def latest(self):
+        if not self.count:
+            return []
+        i = self._index(self.count - 1)
+        return [(self.t[i], self.v[i])]
+
+    def last(self, n):
+        return self._slice(max(0, self.count - n), self.count)
+
+    def _bisect(self, timeStamp):
+        """ Number of readings older than timeStamp """
+        lo, hi = 0, self.count
+        t = self.t
+        while lo < hi:
+            mid = (lo + hi)//2
+            if t[self._index(mid)] < timeStamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        """ Readings with start <= t < end """
+        return self._slice(self._bisect(start), self._bisect(end))
+
+class History:
+    """
+    A RingBuffer of size readings for each (device, series), up to maxSeries
+    series; readings of series beyond that are not kept.
+    """
+    def __init__(self, size, maxSeries):
+        self.size = size
+        self.maxSeries = maxSeries
+        self.devices = {}
+        self.series = 0
+        self.refused = 0
+
+    def append(self, deviceID, name, timeStamp, value):
+        rings = self.devices.get(deviceID)
+        if rings is None:
+            rings = self.devices[deviceID] = {}
+        ring = rings.get(name)
+        if ring is None:
+            if self.series >= self.maxSeries:
+                self.refused += 1
+                return
+            ring = rings[name] = RingBuffer(self.size)
+            self.series += 1
+        ring.append(timeStamp, value)
+
+    def extend(self, deviceID, name, timeStamps, values):
+        if not len(timeStamps):
+            return
+        # The first reading creates the ring, if there is room for it
+        self.append(deviceID, name, timeStamps[0], values[0])
+        ring = self.devices[deviceID].get(name)
+        if ring is None:
+            self.refused += len(timeStamps) - 1
+        else:
+            ring.extend(timeStamps[1:], values[1:])
+
+    def remove(self, deviceID):
+        """ Forget a device's rings, so that their series no longer count against maxSeries """
+        rings = self.devices.pop(deviceID, None)
+        if rings:
+            self.series -= len(rings)
+
+    def nbytes(self):
+        return self.series*self.size*16
+
+    def query(self, deviceID=None, names=None, last=None, start=None, end=None):
+        """
+        SenML records for the devices and series asked for (all if None):
+        the latest reading of each series by default, the last readings if
+        last is given, or those from start up to end.
+        Returns {deviceID: [records]}.
+        """
+        if deviceID is None:
+            devices = self.devices
+        else:
+            devices = {deviceID: self.devices.get(deviceID, {})}
+        result = {}
+        for d, rings in devices.items():
+            records = []
+            for name, ring in rings.items():
+                if names is not None and name not in names:
+                    continue
+                if start is not None or end is not None:
+                    points = ring.range(start if start is not None else float("-inf"),
+                                        end if end is not None else float("inf"))
+                elif last is not None:
+                    points = ring.last(last)
+                else:
+                    points = ring.latest()
+                records.extend({"n": name, "v": v, "t": t} for t, v in points)
+            result[d] = records
+        return result
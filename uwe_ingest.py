@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# uwe_ingest.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Hand-over of adaptor messages from cbcommslib's threads to the reactor.
+Filters, buffers and uploads are only ever touched from the reactor thread;
+other threads just queue their messages. The queue is bounded: a producer
+that finds it full waits for up to blockTimeout seconds for room and then
+drops its message, and both are counted.
+"""
+ModuleName = "uwe_app"
+
+import time
+import logging
+import threading
+from collections import deque
+from twisted.internet import reactor
+from twisted.python import threadable
+
+class IngestQueue:
+    """
+    Messages put() from any thread are passed to process() on the reactor
+    thread, up to batchSize of them per reactor wakeup. A producer only
+    wakes the reactor when the queue was idle, so a burst costs one
+    callFromThread rather than one per message.
+    """
+    def __init__(self, process, maxSize, batchSize, blockTimeout, metrics):
+        self.process = process
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+        self.blockTimeout = blockTimeout
+        self.metrics = metrics
+        self.queue = deque()
+        self.room = threading.Condition(threading.Lock())
+        # True while a drain is due; only changed with room held
+        self.scheduled = False
+        self.blocked = 0
+        self.dropped = 0
+        self.wakeups = 0
+        self.drains = 0
+        self.drained = 0
+        metrics.gauge("ingest", lambda: {"queued": len(self.queue),
+                                         "blocked": self.blocked,
+                                         "dropped": self.dropped,
+                                         "wakeups": self.wakeups,
+                                         "drains": self.drains,
+                                         "drained": self.drained})
+
+    def put(self, message):
+        if not reactor.running or threadable.isInIOThread():
+            # Already on the reactor thread, or no reactor to hand over to
+            self.process(message)
+            return
+        with self.room:
+            if len(self.queue) >= self.maxSize:
+                self.blocked += 1
+                deadline = time.time() + self.blockTimeout
+                while len(self.queue) >= self.maxSize:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.dropped += 1
+                        return
+                    self.room.wait(remaining)
+            self.queue.append(message)
+            if self.scheduled:
+                return
+            self.scheduled = True
+            self.wakeups += 1
+        reactor.callFromThread(self.drain)
+
+    def drain(self):
+        with self.room:
+            batch = [self.queue.popleft() for _ in range(min(self.batchSize, len(self.queue)))]
+            self.room.notify_all()
+        for message in batch:
+            try:
+                self.process(message)
+            except Exception as ex:
+                logging.warning("%s Cannot process adaptor message: %s %s", ModuleName, type(ex), str(ex.args))
+        self.drains += 1
+        self.drained += len(batch)
+        with self.room:
+            if not self.queue:
+                self.scheduled = False
+                return
+        # More arrived, or the batch was full: let the rest of the reactor run first
+        reactor.callLater(0, self.drain)
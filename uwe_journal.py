@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# uwe_journal.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+On-disk store-and-forward journal for batches that could not be uploaded.
+SQLite in WAL mode; appends are grouped and committed together. Only used
+from the reactor thread.
+"""
+ModuleName = "uwe_app"
+
+import json
+import logging
+import sqlite3
+from twisted.internet import reactor
+
+class Journal:
+    def __init__(self, path, maxBytes, eviction="oldest", commitInterval=2.0):
+        """ eviction is either oldest (drop the oldest batches, bulk lane first) or newest (refuse new ones) """
+        self.maxBytes = maxBytes
+        self.eviction = eviction
+        self.commitInterval = commitInterval
+        self.pending = []
+        self.commitCall = None
+        self.evictedBatches = 0
+        self.evictedBytes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS batches "
+                        "(id INTEGER PRIMARY KEY AUTOINCREMENT, device TEXT, payload TEXT, bytes INTEGER, "
+                        "lane TEXT DEFAULT 'bulk')")
+        columns = [c[1] for c in self.db.execute("PRAGMA table_info(batches)")]
+        if "lane" not in columns:
+            # Journal written before upload lanes existed
+            self.db.execute("ALTER TABLE batches ADD COLUMN lane TEXT DEFAULT 'bulk'")
+        self.db.commit()
+        row = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM batches").fetchone()
+        self.count, self.bytes = row[0], row[1]
+        if self.count:
+            logging.info("%s Journal: %s batches, %s bytes waiting from previous run", ModuleName, self.count, self.bytes)
+
+    def append(self, deviceID, values, lane="bulk"):
+        """ Queue a batch; it is written at the next group commit """
+        self.pending.append((deviceID, json.dumps(values), lane))
+        if self.commitCall is None:
+            self.commitCall = reactor.callLater(self.commitInterval, self.commit)
+
+    def commit(self):
+        if self.commitCall is not None and self.commitCall.active():
+            self.commitCall.cancel()
+        self.commitCall = None
+        if not self.pending:
+            return
+        rows = []
+        for deviceID, payload, lane in self.pending:
+            size = len(payload)
+            if self.bytes + size > self.maxBytes and self.eviction == "newest":
+                self.evictedBatches += 1
+                self.evictedBytes += size
+                continue
+            rows.append((deviceID, payload, size, lane))
+            self.bytes += size
+            self.count += 1
+        self.pending = []
+        with self.db:
+            self.db.executemany("INSERT INTO batches (device, payload, bytes, lane) VALUES (?, ?, ?, ?)", rows)
+            while self.bytes > self.maxBytes and self.count > 0:
+                self._evictOldest()
+        logging.debug("%s Journal commit: %s batches, %s bytes", ModuleName, self.count, self.bytes)
+
+    def _evictOldest(self):
+        # Drop oldest batches in chunks rather than one row at a time. Bulk batches
+        # go first; event batches are only dropped once no bulk batches are left
+        over = self.bytes - self.maxBytes
+        dropped = 0
+        ids = []
+        events = 0
+        for batchID, size, lane in self.db.execute("SELECT id, bytes, lane FROM batches "
+                                                   "ORDER BY lane = 'event', id LIMIT 100"):
+            ids.append((batchID,))
+            if lane == "event":
+                events += 1
+            dropped += size
+            if dropped >= over:
+                break
+        self.db.executemany("DELETE FROM batches WHERE id = ?", ids)
+        self.count -= len(ids)
+        self.bytes -= dropped
+        self.evictedBatches += len(ids)
+        self.evictedBytes += dropped
+        logging.warning("%s Journal full, dropped %s oldest batches (%s event)", ModuleName, len(ids), events)
+
+    def peek(self, limit, afterID=0, lane=None):
+        """ Oldest batches after afterID first, optionally of one lane, as a list of (id, deviceID, values) """
+        self.commit()
+        if lane is None:
+            rows = self.db.execute("SELECT id, device, payload FROM batches WHERE id > ? ORDER BY id LIMIT ?",
+                                   (afterID, limit))
+        else:
+            rows = self.db.execute("SELECT id, device, payload FROM batches WHERE id > ? AND lane = ? "
+                                   "ORDER BY id LIMIT ?", (afterID, lane, limit))
+        return [(batchID, deviceID, json.loads(payload)) for batchID, deviceID, payload in rows]
+
+    def remove(self, ids):
+        with self.db:
+            for batchID in ids:
+                row = self.db.execute("SELECT bytes FROM batches WHERE id = ?", (batchID,)).fetchone()
+                if row:
+                    self.db.execute("DELETE FROM batches WHERE id = ?", (batchID,))
+                    self.count -= 1
+                    self.bytes -= row[0]
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def close(self):
+        self.commit()
+        self.db.close()
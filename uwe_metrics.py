@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# uwe_metrics.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Lightweight runtime metrics. Counters are plain dict increments with no
+locking: a count can occasionally be lost if two threads bump the same one
+at once, which is acceptable for monitoring and keeps the data path cheap.
+Gauges are functions that are only called when a snapshot is taken.
+"""
+ModuleName = "uwe_app"
+
+import json
+import bisect
+import logging
+from collections import defaultdict
+from twisted.internet import reactor
+
+# Upload latency buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+
+    def snapshot(self):
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        return {"buckets": dict(zip(bounds, self.counts)),
+                "count": self.count,
+                "sum": round(self.sum, 4)}
+
+class Metrics:
+    def __init__(self):
+        self.started = reactor.seconds()
+        # Messages received and messages that produced at least one point, per characteristic
+        self.received = defaultdict(int)
+        self.emitted = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.statuses = defaultdict(int)
+        self.uploadLatency = Histogram(LATENCY_BUCKETS)
+        self.laneLatency = {}
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def gauge(self, name, fn):
+        """ fn() is called for the current value each time a snapshot is taken """
+        self.gauges[name] = fn
+
+    def upload(self, status, latency, lane=None):
+        self.statuses[str(status)] += 1
+        self.uploadLatency.observe(latency)
+        if lane is not None:
+            if lane not in self.laneLatency:
+                self.laneLatency[lane] = Histogram(LATENCY_BUCKETS)
+            self.laneLatency[lane].observe(latency)
+
+    def snapshot(self):
+        filtered = dict((c, self.received[c] - self.emitted.get(c, 0)) for c in self.received)
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception as ex:
+                logging.debug("%s gauge %s failed: %s", ModuleName, name, str(ex))
+        return {"uptime": round(reactor.seconds() - self.started, 1),
+                "received": dict(self.received),
+                "emitted": dict(self.emitted),
+                "filtered": filtered,
+                "counters": dict(self.counters),
+                "gauges": gauges,
+                "upload_status": dict(self.statuses),
+                "upload_latency": self.uploadLatency.snapshot(),
+                "lane_latency": dict((lane, h.snapshot()) for lane, h in self.laneLatency.items())}
+
+def mergeSnapshots(snapshots):
+    """
+    One snapshot from several, given as {name: snapshot}, as for sharded
+    workers: counts and histograms are added up, gauges are kept by name.
+    """
+    def add(total, counts):
+        for k, v in counts.items():
+            total[k] = total.get(k, 0) + v
+    def addHistogram(total, h):
+        if not total:
+            total.update(buckets={}, count=0, sum=0.0)
+        add(total["buckets"], h["buckets"])
+        total["count"] += h["count"]
+        total["sum"] = round(total["sum"] + h["sum"], 4)
+    merged = {"uptime": 0.0, "received": {}, "emitted": {}, "filtered": {}, "counters": {},
+              "gauges": {}, "upload_status": {}, "upload_latency": {}, "lane_latency": {}}
+    for name, snapshot in snapshots.items():
+        merged["uptime"] = max(merged["uptime"], snapshot["uptime"])
+        for key in ("received", "emitted", "filtered", "counters", "upload_status"):
+            add(merged[key], snapshot[key])
+        addHistogram(merged["upload_latency"], snapshot["upload_latency"])
+        for lane, h in snapshot["lane_latency"].items():
+            addHistogram(merged["lane_latency"].setdefault(lane, {}), h)
+        merged["gauges"][name] = snapshot["gauges"]
+    return merged
+
+def threadPoolGauge():
+    """ Busy and total threads in the reactor threadpool """
+    pool = reactor.getThreadPool()
+    return {"working": len(getattr(pool, "working", [])),
+            "threads": len(getattr(pool, "threads", [])),
+            "max": pool.max}
+
+def listenHTTP(metrics, port, interface):
+    """ Serve metrics.snapshot() as JSON on http://interface:port/ """
+    from twisted.web import server, resource
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b"content-type", b"application/json")
+            return json.dumps(metrics.snapshot()).encode("utf-8")
+
+    site = server.Site(MetricsResource())
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# uwe_polling.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Activity-driven polling intervals. A quiet series, whose samples are nearly
+all discarded by its filter, is asked for samples less often; as soon as
+samples start passing again it goes back to its configured interval.
+Series with an aggregator, swinging door or motion features keep theirs.
+"""
+ModuleName = "uwe_app"
+
+class PollingController:
+    """
+    Interval for one adaptor characteristic, between base and maximum.
+    Slowing down takes quietChecks quiet checks in a row, each over at
+    least minSamples samples, and doubles the interval; speeding up takes
+    one busy check and goes straight back to base. The gap between
+    quietRatio and busyRatio gives the hysteresis.
+    """
+    __slots__ = ("base", "maximum", "quietRatio", "busyRatio", "quietChecks", "minSamples",
+                 "interval", "seen", "passed", "quiet")
+
+    def __init__(self, base, maximum, quietRatio, busyRatio, quietChecks, minSamples):
+        self.base = base
+        self.maximum = maximum
+        self.quietRatio = quietRatio
+        self.busyRatio = busyRatio
+        self.quietChecks = quietChecks
+        self.minSamples = minSamples
+        self.interval = base
+        self.seen = 0
+        self.passed = 0
+        self.quiet = 0
+
+    def sample(self, passed):
+        self.seen += 1
+        if passed:
+            self.passed += 1
+
+    def samples(self, seen, passed):
+        """ sample() for a block of seen samples, passed of which passed """
+        self.seen += seen
+        self.passed += passed
+
+    def check(self):
+        """ Called periodically; returns the new interval if it should change, else None """
+        seen, passed = self.seen, self.passed
+        ratio = float(passed)/seen if seen else 0.0
+        if passed and ratio >= self.busyRatio:
+            self.seen = self.passed = self.quiet = 0
+            if self.interval != self.base:
+                self.interval = self.base
+                return self.interval
+            return None
+        if seen < self.minSamples:
+            # Slowed right down there are few samples per check; let them add up
+            return None
+        self.seen = self.passed = 0
+        if ratio > self.quietRatio:
+            self.quiet = 0
+            return None
+        self.quiet += 1
+        if self.quiet >= self.quietChecks and self.interval < self.maximum:
+            self.quiet = 0
+            self.interval = min(self.maximum, self.interval*2)
+            return self.interval
+        return None
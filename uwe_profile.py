@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# uwe_profile.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Profiling that is switched on and off at run time, for bridges in the field.
+Three parts, each optional:
+  cpu     a thread samples the stacks of every other thread, the reactor's
+          and the threadpool's included, every interval seconds
+  memory  tracemalloc, with the top allocation sites and their growth
+  stages  time spent in dispatch, filter, store, serialize and upload
+Nothing is installed while profiling is off. When on, the sampler's cost
+is bounded by the interval, stack depth and number of distinct stacks kept.
+Stage timing adds about a microsecond to each timed call, and tracemalloc
+slows everything many times over, so both are off unless asked for.
+Profiling stops by itself after a maximum duration.
+Every report interval, stacks are appended to <file>.folded, one
+"thread;frame;frame count" line per stack as flamegraph.pl and speedscope
+read them, and everything else to <file>.jsonl, one JSON object per
+report. Both rotate at maxBytes.
+"""
+ModuleName = "uwe_app"
+
+import os
+import sys
+import time
+import json
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from twisted.internet import reactor, task
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+clock = getattr(time, "perf_counter", time.time)
+
+# Innermost frames of threads that are waiting rather than running
+IDLE = set([("threading.py", "wait"), ("queue.py", "get"), ("Queue.py", "get"),
+            ("epollreactor.py", "doPoll"), ("pollreactor.py", "doPoll"), ("selectreactor.py", "doSelect")])
+
+def rotatingLog(name, path, maxBytes, files):
+    """ A logger that writes bare lines to path, rotated at maxBytes """
+    log = logging.getLogger(name)
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = RotatingFileHandler(path, maxBytes=maxBytes, backupCount=files)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    return log
+
+def closeLog(log):
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+
+class Sampler:
+    """
+    Counts the stacks of all other threads, sampled every interval seconds,
+    up to maxDepth frames and maxStacks distinct stacks; samples of stacks
+    beyond that are counted as dropped, and those of waiting threads as idle.
+    """
+    def __init__(self, interval, maxDepth, maxStacks):
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.maxStacks = maxStacks
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.samples = 0
+        self.idle = 0
+        self.dropped = 0
+        self.names = {}
+        # Sampled from the reactor thread
+        self.names[threading.current_thread().ident] = "reactor"
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="uwe_profile")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        me = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(ident, frame)
+
+    def sample(self, ident, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+            self.idle += 1
+            return
+        stack = []
+        while frame is not None and len(stack) < self.maxDepth:
+            code = frame.f_code
+            stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        name = self.names.get(ident)
+        if name is None:
+            for t in threading.enumerate():
+                self.names.setdefault(t.ident, t.name)
+            name = self.names.get(ident, "thread")
+        stack.append(name)
+        key = ";".join(reversed(stack))
+        with self.lock:
+            self.samples += 1
+            if key in self.counts:
+                self.counts[key] += 1
+            elif len(self.counts) < self.maxStacks:
+                self.counts[key] = 1
+            else:
+                self.dropped += 1
+
+    def take(self):
+        """ Stack counts since the last take() """
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def stop(self):
+        self.stopped.set()
+        # At most one interval and one sample
+        self.thread.join()
+
+class StageTimer:
+    """
+    Wraps the methods that make up each stage. Times are exclusive: time in
+    a stage called from another, as an upload from a store that fills a
+    buffer, counts only towards the inner one. Used from the reactor thread.
+    """
+    def __init__(self):
+        self.stats = {}
+        # Time spent in timed calls made by the one running now
+        self.inner = [0.0]
+        self.installed = []
+
+    def wrap(self, stage, fn):
+        stats = self.stats.setdefault(stage, [0, 0.0, 0.0])
+        inner = self.inner
+        def timed(*args, **kwargs):
+            outer = inner[0]
+            inner[0] = 0.0
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                own = elapsed - inner[0]
+                stats[0] += 1
+                stats[1] += own
+                if own > stats[2]:
+                    stats[2] = own
+                inner[0] = outer + elapsed
+        timed.untimed = fn
+        return timed
+
+    def patch(self, obj, name, stage):
+        own = name in obj.__dict__
+        original = getattr(obj, name)
+        setattr(obj, name, self.wrap(stage, original))
+        self.installed.append((obj, name, original if own else None))
+
+    def install(self, app):
+        """
+        Messages are dispatched by the ingest queue's process() and filtered by
+        the handlers of the adaptors known now; those added later count as dispatch.
+        """
+        self.patch(app.ingest, "process", "dispatch")
+        self.handlers = app.handlers
+        for key, handler in list(app.handlers.items()):
+            app.handlers[key] = self.wrap("filter", handler)
+        dm = app.dm
+        if dm is not None:
+            self.patch(dm, "storeValue", "store")
+            self.patch(dm, "storeRows", "store")
+            # Whichever output encodes a batch first does it for those that share the encoding
+            for encoder in [dm.encoder] + [sink.encoder for sink in dm.sinks]:
+                self.patch(encoder, "encode", "serialize")
+            for lane in dm.lanes:
+                self.patch(lane.uploader, "post", "upload")
+
+    def uninstall(self):
+        for obj, name, original in reversed(self.installed):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self.installed = []
+        for key, handler in list(self.handlers.items()):
+            if hasattr(handler, "untimed"):
+                self.handlers[key] = handler.untimed
+
+    def take(self):
+        """ Per stage count, total ms, mean and max us since the last take() """
+        report = {}
+        for stage, stats in self.stats.items():
+            count, total, longest = stats
+            report[stage] = {"count": count,
+                             "total_ms": round(total*1e3, 3),
+                             "mean_us": round(total*1e6/count, 1) if count else 0.0,
+                             "max_us": round(longest*1e6, 1)}
+            stats[:] = [0, 0.0, 0.0]
+        return report
+
+class Profiler:
+    """
+    Started and stopped by control(), with a request from the concentrator:
+    {"action": "start", "cpu": true, "memory": false, "stages": false,
+    "duration": seconds}, {"action": "stop"} or {"action": "status"}.
+    """
+    def __init__(self, app, config, path):
+        self.app = app
+        self.config = config
+        self.path = path
+        self.sampler = None
+        self.stages = None
+        self.memory = False
+        self.ownTracing = False
+        self.lastSnapshot = None
+        self.started = None
+        self.reportLoop = None
+        self.stopCall = None
+        self.reports = 0
+
+    def running(self):
+        return self.started is not None
+
+    def control(self, req):
+        action = req.get("action", "status")
+        if action == "start":
+            if self.running():
+                self.stop()
+            self.start(req.get("cpu", True), req.get("memory", False), req.get("stages", False),
+                       req.get("duration", self.config["profile_max_duration"]))
+        elif action == "stop":
+            self.stop()
+        return self.status()
+
+    def status(self):
+        status = {"running": self.running(), "file": self.path, "reports": self.reports}
+        if self.running():
+            status.update(cpu=self.sampler is not None, memory=self.memory, stages=self.stages is not None,
+                          seconds=round(time.time() - self.started, 1))
+        return status
+
+    def start(self, cpu, memory, stages, duration):
+        config = self.config
+        self.folded = rotatingLog("uwe_profile.folded", self.path + ".folded",
+                                  config["profile_max_bytes"], config["profile_files"])
+        self.jsonl = rotatingLog("uwe_profile.jsonl", self.path + ".jsonl",
+                                 config["profile_max_bytes"], config["profile_files"])
+        self.started = time.time()
+        if cpu:
+            self.sampler = Sampler(config["profile_interval"], config["profile_max_depth"],
+                                   config["profile_max_stacks"])
+        if memory:
+            if tracemalloc is None:
+                logging.warning("%s tracemalloc is not available, no memory profile", ModuleName)
+            else:
+                self.memory = True
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(config["profile_memory_frames"])
+                    self.ownTracing = True
+                self.lastSnapshot = None
+        if stages:
+            self.stages = StageTimer()
+            self.stages.install(self.app)
+        self.reportLoop = task.LoopingCall(self.report)
+        self.reportLoop.start(config["profile_report_interval"], now=False)
+        duration = min(duration, config["profile_max_duration"])
+        self.stopCall = reactor.callLater(duration, self.stop)
+        logging.info("%s Profiling for up to %s s, cpu: %s memory: %s stages: %s",
+                     ModuleName, duration, cpu, memory, stages)
+
+    def stop(self):
+        if not self.running():
+            return
+        if self.stopCall.active():
+            self.stopCall.cancel()
+        self.reportLoop.stop()
+        self.report()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        if self.stages is not None:
+            self.stages.uninstall()
+            self.stages = None
+        if self.ownTracing:
+            tracemalloc.stop()
+            self.ownTracing = False
+        self.memory = False
+        self.lastSnapshot = None
+        closeLog(self.folded)
+        closeLog(self.jsonl)
+        self.started = None
+        logging.info("%s Profiling stopped", ModuleName)
+
+    def report(self):
+        now = time.time()
+        report = {"time": round(now, 3), "seconds": round(now - self.started, 1)}
+        if self.sampler is not None:
+            counts = self.sampler.take()
+            for stack, n in counts.items():
+                self.folded.info("%s %d", stack, n)
+            report["cpu"] = {"samples": self.sampler.samples,
+                             "idle": self.sampler.idle,
+                             "dropped": self.sampler.dropped,
+                             "stacks": len(counts)}
+        if self.stages is not None:
+            report["stages"] = self.stages.take()
+        if self.memory:
+            report["memory"] = self.memoryReport()
+        # Taking a memory snapshot blocks the reactor for longest
+        report["report_ms"] = round((time.time() - now)*1e3, 1)
+        self.jsonl.info("%s", json.dumps(report, separators=(",", ":"), sort_keys=True))
+        self.reports += 1
+
+    def memoryReport(self):
+        top = self.config["profile_top"]
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+        current, peak = tracemalloc.get_traced_memory()
+        def site(stat):
+            frame = stat.traceback[0]
+            return {"site": "%s:%d" % (frame.filename, frame.lineno), "bytes": stat.size, "count": stat.count}
+        report = {"traced_bytes": current,
+                  "peak_bytes": peak,
+                  "top": [site(s) for s in snapshot.statistics("lineno")[:top]]}
+        if self.lastSnapshot is not None:
+            growth = [s for s in snapshot.compare_to(self.lastSnapshot, "lineno")[:top] if s.size_diff > 0]
+            report["growth"] = [dict(site(s), bytes_diff=s.size_diff) for s in growth]
+        self.lastSnapshot = snapshot
+        return report
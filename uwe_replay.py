@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# uwe_replay.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Recording and replay of the messages an app receives, to reproduce field
+problems and to run old data through new filter settings.
+A recording is a file of gzip members, each holding JSON lines of
+[time, kind, message], kind being "configure", "service" or "data". It is
+only ever appended to, so a crash loses at most the last member.
+Replay feeds recordings through a full app on a simulated clock: timers
+keep their recorded spacing whether the replay runs in real time, faster,
+or as fast as possible. Output goes to a file sink archive, and to Geras
+or a stand-in if geras is among the sinks, and is summed up per series so
+that two runs can be compared. Every timer still runs, so the flush tick
+sets the pace of a long backfill; a longer flush_tick makes it much faster.
+Usage: python uwe_replay.py recording... --output dir [--speed x] [--config key=value]... [--compare replay.json]
+"""
+ModuleName = "uwe_app"
+
+import os
+import sys
+import gzip
+import json
+import time
+import zlib
+import logging
+import itertools
+import threading
+from twisted.internet import reactor, defer, task
+from uwe_senml import compress, decode
+from uwe_sinks import readArchive
+
+def encodeRecord(t, kind, message):
+    return json.dumps([round(t, 3), kind, message], separators=(",", ":"))
+
+def appendRecording(path, lines):
+    """ Append encoded records to a recording as one gzip member; returns the bytes written """
+    data = compress(("\n".join(lines) + "\n").encode("utf-8"))
+    with open(path, "ab") as f:
+        f.write(data)
+    return len(data)
+
+def readRecording(path):
+    """ Yield [time, kind, message] for each record, up to any member cut short by a crash """
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                yield json.loads(line.decode("utf-8"))
+        except (EOFError, IOError, ValueError, zlib.error) as ex:
+            logging.warning("%s Recording %s ends early: %s", ModuleName, path, str(ex))
+
+class Recorder:
+    """
+    Records messages from any thread. They are encoded as they arrive and
+    written every flushInterval seconds from the reactor thread. Recording
+    stops, and further messages are counted as dropped, once the file
+    reaches maxBytes.
+    """
+    def __init__(self, path, flushInterval, maxBytes, metrics):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        self.recorded = 0
+        self.dropped = 0
+        self.loop = task.LoopingCall(self.flush)
+        self.loop.start(flushInterval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        metrics.gauge("recorder", lambda: {"recorded": self.recorded,
+                                           "dropped": self.dropped,
+                                           "bytes": self.bytes})
+
+    def record(self, kind, message):
+        line = encodeRecord(time.time(), kind, message)
+        with self.lock:
+            self.pending.append(line)
+
+    def flush(self):
+        with self.lock:
+            lines, self.pending = self.pending, []
+        if not lines:
+            return
+        if self.bytes >= self.maxBytes:
+            self.dropped += len(lines)
+            return
+        try:
+            self.bytes += appendRecording(self.path, lines)
+            self.recorded += len(lines)
+        except Exception as ex:
+            logging.warning("%s Cannot write recording %s: %s %s", ModuleName, self.path, type(ex), str(ex.args))
+            self.dropped += len(lines)
+            return
+        if self.bytes >= self.maxBytes:
+            logging.warning("%s Recording %s is full, no more messages will be recorded", ModuleName, self.path)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        self.flush()
+
+class SimulatedClock:
+    """ Stands in for reactor.seconds(); only Replay moves it """
+    def __init__(self, now):
+        self.now = now
+
+    def seconds(self):
+        return self.now
+
+class Replay:
+    """
+    Feeds records to app in their recorded order. The clock moves forward to
+    the next record or timer, whichever is due first, but no further than
+    speed times real time allows (speed 0: no limit). It stands still while
+    uploads or sink writes are in flight, so that their timeouts mean what
+    they do on a bridge. After the last record the clock runs on for settle
+    seconds to let buffers flush.
+    """
+    def __init__(self, records, app, clock, speed, settle, batch=1000):
+        self.records = iter(records)
+        self.app = app
+        self.clock = clock
+        self.speed = speed
+        self.settle = settle
+        self.batch = batch
+        self.next = next(self.records, None)
+        self.last = clock.now
+        self.messages = {}
+        self.done = defer.Deferred()
+
+    def start(self):
+        self.rebase()
+        reactor.callLater(0, self.tick)
+        return self.done
+
+    def rebase(self):
+        self.realBase = time.time()
+        self.simBase = self.clock.now
+
+    def busy(self):
+        dm = self.app.dm
+        if dm is None:
+            return False
+        return any(lane.uploader.stats.inFlight for lane in dm.lanes) or \
+               any(sink.inFlight for sink in dm.sinks)
+
+    def tick(self):
+        clock = self.clock
+        if self.busy():
+            self.rebase()
+            reactor.callLater(0, self.tick)
+            return
+        end = self.next[0] if self.next is not None else self.last + self.settle
+        target = min([c.getTime() for c in reactor.getDelayedCalls()] + [end])
+        if self.speed:
+            limit = self.simBase + (time.time() - self.realBase)*self.speed
+            if limit < target:
+                target = limit
+                # Nothing to do until real time catches up
+                time.sleep(0.001)
+        if target > clock.now:
+            clock.now = target
+        fed = 0
+        while self.next is not None and self.next[0] <= clock.now and fed < self.batch:
+            self.dispatch(*self.next)
+            self.last = self.next[0]
+            self.next = next(self.records, None)
+            fed += 1
+        if self.next is None and clock.now >= self.last + self.settle:
+            self.done.callback(self.messages)
+        else:
+            reactor.callLater(0, self.tick)
+
+    def dispatch(self, t, kind, message):
+        if kind == "data":
+            self.app.onAdaptorData(message)
+        elif kind == "service":
+            self.app.onAdaptorService(message)
+        elif kind == "configure":
+            self.app.onConfigureMessage(message)
+        else:
+            logging.warning("%s Unknown record kind in recording: %s", ModuleName, kind)
+            return
+        self.messages[kind] = self.messages.get(kind, 0) + 1
+
+def summarise(directory):
+    """
+    Batches and points in a file sink archive, and for each series its
+    points, first and last time and a digest of the points that does not
+    depend on their order.
+    """
+    batches = 0
+    series = {}
+    for header, body in readArchive(directory):
+        batches += 1
+        for v in decode(body, header["ce"] or None):
+            # Bulk batches name their records U_<device>/<series>
+            name = header["d"] + "/" + v["n"] if header["d"] else v["n"][2:]
+            s = series.get(name)
+            if s is None:
+                s = series[name] = {"points": 0, "digest": 0, "first": v["t"], "last": v["t"]}
+            s["points"] += 1
+            s["digest"] = (s["digest"] + zlib.crc32(("%.3f:%r" % (v["t"], v["v"])).encode("ascii"))) & 0xffffffff
+            s["first"] = min(s["first"], v["t"])
+            s["last"] = max(s["last"], v["t"])
+    return {"batches": batches,
+            "points": sum(s["points"] for s in series.values()),
+            "series": series}
+
+def compare(previous, current):
+    """ Series added, removed, or with different points, between two replay results """
+    old, new = previous["series"], current["series"]
+    changed = {}
+    for name in set(old) & set(new):
+        if old[name]["points"] != new[name]["points"] or old[name]["digest"] != new[name]["digest"]:
+            changed[name] = {"points": [old[name]["points"], new[name]["points"]]}
+    return {"batches": [previous["batches"], current["batches"]],
+            "points": [previous["points"], current["points"]],
+            "added": sorted(set(new) - set(old)),
+            "removed": sorted(set(old) - set(new)),
+            "changed": changed}
+
+def replay(paths, output, speed=0, appConfig=None, appID="AID0", bridgeID="BID0", settle=None):
+    """
+    Replay the recordings in paths, in order, through an app configured with
+    appConfig, writing its archive and journal to the output directory.
+    Must be called before the reactor runs, and by a process of its own, as
+    the reactor's clock is replaced. Returns a Deferred that fires with the result.
+    """
+    records = (r for path in paths for r in readRecording(path))
+    first = next(records, None)
+    if first is None:
+        return defer.succeed({"messages": {}, "batches": 0, "points": 0, "series": {}})
+    archive = os.path.join(output, "archive")
+    journal = os.path.join(output, "replay.journal")
+    if os.path.exists(journal) or (os.path.isdir(archive) and os.listdir(archive)):
+        raise ValueError("%s has the output of an earlier replay" % output)
+    clock = SimulatedClock(first[0])
+    reactor.seconds = clock.seconds
+    import uwe_app_a
+    config = uwe_app_a.config
+    config.update(record='False', snapshot='False', shards=0, metrics_port=0, metrics_interval=0,
+                  sinks='file', file_sink_dir=archive, file_sink_segments=1000000, journal_file=journal)
+    config.update(appConfig or {})
+    sinks = [s.strip() for s in config["sinks"].split(",")]
+    if "file" not in sinks:
+        # The archive is what the result is worked out from
+        config["sinks"] = ",".join(sinks + ["file"])
+    if settle is None:
+        settle = config["flush_max_age"] + config["sink_delay"] + 1.0
+    sent = []
+    app = uwe_app_a.ShardApp(appID, bridgeID, sent.append)
+    driver = Replay(itertools.chain([first], records), app, clock, speed, settle)
+    started = time.time()
+
+    def finish(messages):
+        elapsed = time.time() - started
+        if app.dm is not None:
+            app.dm.stop()
+        snapshot = app.metrics.snapshot()
+        span = driver.last - first[0]
+        result = {"messages": messages,
+                  "recorded_seconds": round(span, 1),
+                  "replay_seconds": round(elapsed, 3),
+                  "speedup": round(span/elapsed, 1) if elapsed else None,
+                  "messages_per_sec": round(sum(messages.values())/elapsed) if elapsed else None,
+                  "received": snapshot["received"],
+                  "emitted": snapshot["emitted"],
+                  "upload_status": snapshot["upload_status"],
+                  "sent": len(sent)}
+        result.update(summarise(archive))
+        return result
+    return driver.start().addCallback(finish)
+
+def parseValue(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay uwe_app recordings")
+    parser.add_argument("recordings", nargs="+")
+    parser.add_argument("--output", required=True, help="directory for the archive, journal and replay.json")
+    parser.add_argument("--speed", type=float, default=0, help="times real time; 0 for as fast as possible")
+    parser.add_argument("--config", action="append", default=[], help="app config key=value")
+    parser.add_argument("--compare", help="replay.json of an earlier run")
+    parser.add_argument("--app-id", default="AID0")
+    parser.add_argument("--bridge-id", default="BID0")
+    args = parser.parse_args(argv)
+    appConfig = dict((c.split("=", 1)[0], parseValue(c.split("=", 1)[1])) for c in args.config)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    result = {}
+
+    def done(r):
+        result.update(r)
+        if args.compare:
+            with open(args.compare) as f:
+                result["diff"] = compare(json.load(f), r)
+        with open(os.path.join(args.output, "replay.json"), "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    def failed(failure):
+        result["error"] = failure.getErrorMessage()
+        logging.error("%s Replay failed: %s", ModuleName, failure.getTraceback())
+
+    try:
+        d = replay(args.recordings, args.output, args.speed, appConfig, args.app_id, args.bridge_id)
+    except ValueError as ex:
+        print(str(ex))
+        return 1
+    d.addCallbacks(done, failed)
+    d.addBoth(lambda _: reactor.callLater(0, reactor.stop))
+    reactor.run()
+    # The full series list is in replay.json
+    summary = dict((k, v) for k, v in result.items() if k != "series")
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    return 1 if "error" in result else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# uwe_senml.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+SenML encoders for upload payloads.
+legacy:  {"e": [{"n": ..., "v": ..., "t": ...}, ...]} as Geras has always had it.
+compact: an RFC 8428 pack. The first record of each series carries the base
+         name and base time; the rest carry only a relative time and value,
+         both rounded to the configured precision.
+Either can be gzipped. decode() accepts everything encode() produces.
+"""
+import gzip
+import json
+import math
+import zlib
+from io import BytesIO
+
+def _number(x):
+    """ Drop the fraction from whole numbers so that 1.0 is sent as 1; NaN and infinities are left alone """
+    if math.isnan(x) or math.isinf(x):
+        return x
+    if x == int(x):
+        return int(x)
+    return x
+
+def compactRecords(values, valuePrecision, timePrecision):
+    """ Group records by series and write base name/time once per series """
+    series = {}
+    order = []
+    for r in values:
+        n = r["n"]
+        if n not in series:
+            series[n] = []
+            order.append(n)
+        series[n].append(r)
+    pack = []
+    for n in order:
+        records = series[n]
+        bt = records[0]["t"]
+        first = True
+        for r in records:
+            rec = {"v": _number(round(r["v"], valuePrecision))}
+            dt = _number(round(r["t"] - bt, timePrecision))
+            if first:
+                rec["bn"] = n
+                rec["bt"] = bt
+                first = False
+            if dt:
+                rec["t"] = dt
+            pack.append(rec)
+    return pack
+
+class Encoder:
+    def __init__(self, senmlFormat="legacy", useGzip=False, valuePrecision=4, timePrecision=3, gzipMinBytes=512):
+        self.format = senmlFormat
+        self.gzip = useGzip
+        self.valuePrecision = valuePrecision
+        self.timePrecision = timePrecision
+        self.gzipMinBytes = gzipMinBytes
+
+    def encode(self, values):
+        """ Returns (body, headers) for a list of SenML records """
+        if self.format == "compact":
+            body = json.dumps(compactRecords(values, self.valuePrecision, self.timePrecision),
+                              separators=(',', ':')).encode('utf-8')
+            headers = {'Content-Type': 'application/senml+json'}
+        else:
+            body = json.dumps({"e": values}).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+        # Small bodies get bigger when gzipped
+        if self.gzip and len(body) >= self.gzipMinBytes:
+            body = compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def key(self):
+        """ Encoders with the same key encode the same records to the same bytes """
+        return (self.format, self.gzip, self.valuePrecision, self.timePrecision, self.gzipMinBytes)
+
+    def downgrade(self):
+        """
+        Called when a sink answers 415: fall back to plain legacy SenML.
+        Returns False if there is nothing left to fall back from.
+        """
+        if self.format == "legacy" and not self.gzip:
+            return False
+        self.format = "legacy"
+        self.gzip = False
+        return True
+
+def compress(body):
+    out = BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0)
+    f.write(body)
+    f.close()
+    return out.getvalue()
+
+def decode(body, contentEncoding=None):
+    """ Decode either format to a list of {"n", "v", "t"} records with absolute times """
+    if contentEncoding == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    data = json.loads(body.decode('utf-8'))
+    if isinstance(data, dict):
+        bn = data.get("bn", "")
+        bt = data.get("bt", 0)
+        return [{"n": bn + r.get("n", ""), "v": r["v"], "t": bt + r.get("t", 0)} for r in data["e"]]
+    values = []
+    bn = ""
+    bt = 0
+    for r in data:
+        bn = r.get("bn", bn)
+        bt = r.get("bt", bt)
+        values.append({"n": bn + r.get("n", ""), "v": r["v"], "t": bt + r.get("t", 0)})
+    return values
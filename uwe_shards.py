@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# uwe_shards.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Sharded mode, for bridges with more adaptors than one core can filter.
+Adaptors are split across worker processes by a stable hash of their id.
+Each worker runs the sensors, filters and a DataManager, with a journal
+and snapshot of its own, for its shard. The app's process only routes
+adaptor messages to the workers and relays what they send back. A worker
+that exits is started again and drains its shard's journal; readings it
+only held in memory are lost.
+Run as a script, this is a worker: uwe_shards.py <shard>
+"""
+ModuleName = "uwe_app"
+
+import os
+import sys
+import zlib
+import marshal
+import logging
+from collections import deque
+from twisted.internet import reactor, protocol, defer, task, stdio
+from twisted.protocols.basic import Int32StringReceiver
+from uwe_upload import Backoff
+from uwe_metrics import mergeSnapshots
+
+# Command that runs a worker; the shard number is appended
+WORKER_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "uwe_shards.py")]
+
+def shardOf(adaptorID, shards):
+    """ Stable across restarts and reconfigurations, unlike hash() """
+    return (zlib.crc32(adaptorID.encode("utf-8")) & 0xffffffff) % shards
+
+class Frames(Int32StringReceiver):
+    """
+    Length-prefixed frames over a worker's stdin or stdout, each a marshalled
+    list of messages. Adaptor messages are sent as they are; router and
+    worker messages have an "op".
+    """
+    MAX_LENGTH = 64*1024*1024
+
+    def __init__(self, onMessage):
+        self.onMessage = onMessage
+
+    def stringReceived(self, data):
+        for message in marshal.loads(data):
+            self.onMessage(message)
+
+    def sendMessages(self, messages):
+        self.sendString(marshal.dumps(messages))
+
+class Outbox:
+    """ Messages sent in one reactor turn go out as one frame """
+    def __init__(self):
+        self.frames = None
+        self.messages = []
+
+    def send(self, message):
+        if not self.messages:
+            reactor.callLater(0, self.flush)
+        self.messages.append(message)
+
+    def flush(self):
+        messages, self.messages = self.messages, []
+        if self.frames is not None and messages:
+            self.frames.sendMessages(messages)
+
+class Worker(protocol.ProcessProtocol):
+    """
+    The router's side of one worker process. Adaptor messages that arrive
+    while the worker is down are kept, up to maxPending, and sent once it
+    is back; the rest of its state is rebuilt by ShardRouter.startMessages().
+    """
+    def __init__(self, router, index, maxPending):
+        self.router = router
+        self.index = index
+        self.outbox = Outbox()
+        self.pending = deque(maxlen=maxPending)
+        self.backoff = Backoff(1.0, 60.0, 0.2)
+        self.stopping = False
+        self.ended = None
+
+    def start(self):
+        if self.stopping:
+            return
+        reactor.spawnProcess(self, WORKER_COMMAND[0], WORKER_COMMAND + [str(self.index)],
+                             env=os.environ, childFDs={0: "w", 1: "r", 2: 2})
+
+    def connectionMade(self):
+        frames = Frames(self.router.onWorkerMessage(self.index))
+        frames.makeConnection(self.transport)
+        self.outbox.frames = frames
+        for message in self.router.startMessages(self.index):
+            self.outbox.send(message)
+        while self.pending:
+            self.outbox.send(self.pending.popleft())
+
+    def outReceived(self, data):
+        self.outbox.frames.dataReceived(data)
+
+    def send(self, message, control=False):
+        if self.outbox.frames is not None:
+            self.outbox.send(message)
+        elif not control:
+            if len(self.pending) == self.pending.maxlen:
+                self.router.metrics.incr("shard_dropped")
+            self.pending.append(message)
+
+    def stop(self):
+        self.stopping = True
+        self.ended = defer.Deferred()
+        if self.outbox.frames is None:
+            self.ended.callback(None)
+        else:
+            self.send({"op": "stop"}, True)
+            self.outbox.flush()
+            kill = reactor.callLater(10.0, self.transport.signalProcess, "KILL")
+            self.ended.addBoth(lambda r: kill.active() and kill.cancel())
+        return self.ended
+
+    def processEnded(self, reason):
+        self.outbox.frames = None
+        # Adaptor messages not yet written wait for the next worker
+        unsent, self.outbox.messages = self.outbox.messages, []
+        self.pending.extendleft(reversed([m for m in unsent if "op" not in m]))
+        self.router.workerEnded(self.index)
+        if self.stopping:
+            if self.ended is not None and not self.ended.called:
+                self.ended.callback(None)
+            return
+        delay = self.backoff.next()
+        logging.warning("%s Shard %s worker ended (%s), restarting in %.1f s",
+                        ModuleName, self.index, reason.getErrorMessage(), delay)
+        self.router.metrics.incr("shard_restarts")
+        reactor.callLater(delay, self.start)
+
+class ShardRouter:
+    """
+    The app's side of sharded mode. route(), configure(), service(),
+    history() and profile() take the messages App would have handled
+    itself; history and profile replies from the workers are merged into
+    one answer, and the metrics they report into snapshot().
+    """
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        self.shards = config["shards"]
+        self.metrics = app.metrics
+        self.shardByID = {}
+        self.adaptors = [[] for i in range(self.shards)]
+        self.reports = {}
+        # Concentrator requests waiting for worker replies, by query id
+        self.queries = {}
+        self.lastQuery = 0
+        self.workers = [Worker(self, i, config["shard_max_pending"]) for i in range(self.shards)]
+        reactor.callWhenRunning(self.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+
+    def stop(self):
+        return defer.DeferredList([w.stop() for w in self.workers])
+
+    def shard(self, adaptorID):
+        i = self.shardByID.get(adaptorID)
+        if i is None:
+            i = self.shardByID[adaptorID] = shardOf(adaptorID, self.shards)
+        return i
+
+    def route(self, message):
+        self.workers[self.shard(message["id"])].send(message)
+
+    def configure(self, message):
+        """ Each worker is sent the configure message for its own adaptors """
+        self.adaptors = [[] for i in range(self.shards)]
+        for adaptor in message["adaptors"]:
+            self.adaptors[self.shard(adaptor["id"])].append(adaptor)
+        for i, w in enumerate(self.workers):
+            w.send({"op": "configure", "config": {"adaptors": self.adaptors[i]}}, True)
+
+    def service(self, message):
+        self.workers[self.shard(message["id"])].send({"op": "service", "message": message}, True)
+
+    def history(self, req):
+        """ A device's request goes to its shard; otherwise each shard finds its own devices """
+        names = dict((name, adtID) for adtID, name in self.app.idToName.items())
+        adtID = names.get(req.get("device"))
+        shards = [self.shard(adtID)] if adtID else range(self.shards)
+        self.ask(shards, "history", req, {})
+
+    def profile(self, req):
+        """ The app's own profiling status, with each worker's under "shards" """
+        profiling = self.app.profiler.control(req)
+        profiling["shards"] = {}
+        self.ask(range(self.shards), "profile", req, profiling)
+
+    def ask(self, shards, op, req, answer):
+        """
+        Sends a concentrator request to workers; their replies are merged into
+        answer, which is sent once all have replied, or at the timeout with
+        what has arrived. Workers that are down are not waited for.
+        """
+        self.lastQuery += 1
+        query = {"op": op, "req": req, "answer": answer,
+                 "waiting": set(i for i in shards if self.workers[i].outbox.frames is not None)}
+        self.queries[self.lastQuery] = query
+        for i in query["waiting"]:
+            self.workers[i].send({"op": op, "req": req, "query": self.lastQuery}, True)
+        if query["waiting"]:
+            query["timeout"] = reactor.callLater(self.config["shard_reply_timeout"], self.answer, self.lastQuery)
+        else:
+            self.answer(self.lastQuery)
+
+    def onReply(self, index, message):
+        query = self.queries.get(message["query"])
+        if query is None or index not in query["waiting"]:
+            # Timed out, or from a worker that was restarted since
+            return
+        if query["op"] == "history":
+            query["answer"].update(message["devices"])
+        else:
+            query["answer"]["shards"]["shard%d" % index] = message["profiling"]
+        self.replied(message["query"], index)
+
+    def replied(self, queryID, index):
+        query = self.queries[queryID]
+        query["waiting"].discard(index)
+        if not query["waiting"]:
+            self.answer(queryID)
+
+    def workerEnded(self, index):
+        """ A worker that ends will not reply to what it was asked """
+        for queryID, query in list(self.queries.items()):
+            if index in query["waiting"]:
+                self.replied(queryID, index)
+
+    def answer(self, queryID):
+        query = self.queries.pop(queryID)
+        timeout = query.get("timeout")
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if query["waiting"]:
+            logging.warning("%s No %s reply from shards %s", ModuleName, query["op"], sorted(query["waiting"]))
+            self.metrics.incr("shard_reply_timeouts")
+        if query["op"] == "history":
+            self.app.sendHistory(query["req"], query["answer"])
+        else:
+            self.app.sendProfile(query["req"], query["answer"])
+
+    def workerConfig(self, index):
+        """ The app's config, with the journal, snapshot, archive and profile of the shard """
+        from cbconfig import CB_CONFIG_DIR
+        c = dict(self.config)
+        suffix = ".shard%d" % index
+        c.update(shards=0, metrics_port=0, metrics_interval=0, record='False',
+                 journal_file=(c["journal_file"] or CB_CONFIG_DIR + "uwe_app.journal") + suffix,
+                 snapshot_file=(c["snapshot_file"] or CB_CONFIG_DIR + "uwe_app.snapshot") + suffix,
+                 file_sink_dir=(c["file_sink_dir"] or CB_CONFIG_DIR + "archive") + suffix,
+                 profile_file=(c["profile_file"] or CB_CONFIG_DIR + "uwe_app.profile") + suffix)
+        return c
+
+    def startMessages(self, index):
+        """ Everything a new worker needs to take over its shard """
+        messages = [{"op": "start", "config": self.workerConfig(index),
+                     "id": self.app.id, "bridge_id": self.app.bridge_id},
+                    {"op": "configure", "config": {"adaptors": self.adaptors[index]}}]
+        for d in self.app.devServices:
+            if self.shard(d["id"]) == index:
+                messages.append({"op": "service", "message": d})
+        return messages
+
+    def onWorkerMessage(self, index):
+        def onMessage(message):
+            op = message["op"]
+            if op == "message":
+                self.app.sendMessage(message["msg"], message["dest"])
+            elif op == "manager":
+                # The app reports its own state; anything else goes through
+                if message["msg"].get("status") != "state":
+                    self.app.sendManagerMessage(message["msg"])
+            elif op == "metrics":
+                self.reports[index] = message["snapshot"]
+            elif op == "reply":
+                self.onReply(index, message)
+            elif op == "ready":
+                self.workers[index].backoff.reset()
+        return onMessage
+
+    def snapshot(self):
+        snapshots = {"router": self.metrics.snapshot()}
+        for index, report in self.reports.items():
+            snapshots["shard%d" % index] = report
+        return mergeSnapshots(snapshots)
+
+class WorkerProcess:
+    """ A worker's side: router messages on stdin, replies on stdout """
+    def __init__(self, index):
+        self.index = index
+        self.app = None
+        self.outbox = Outbox()
+        frames = Frames(self.onMessage)
+        frames.connectionLost = self.connectionLost
+        self.outbox.frames = frames
+        stdio.StandardIO(frames)
+
+    def onMessage(self, message):
+        if "op" not in message:
+            self.app.processAdaptorData(message)
+            return
+        op = message["op"]
+        if op == "start":
+            import uwe_app_a
+            uwe_app_a.config.update(message["config"])
+            logging.basicConfig(filename=uwe_app_a.CB_LOGFILE, level=uwe_app_a.CB_LOGGING_LEVEL,
+                                format='%(asctime)s %(message)s')
+            self.app = uwe_app_a.ShardApp(message["id"], message["bridge_id"], self.outbox.send)
+            reportLoop = task.LoopingCall(self.report)
+            reportLoop.start(uwe_app_a.config["shard_report_interval"], now=False)
+            self.outbox.send({"op": "ready"})
+        elif op == "configure":
+            self.app.onConfigureMessage(message["config"])
+        elif op == "service":
+            self.app.onAdaptorService(message["message"])
+        elif op == "history":
+            self.outbox.send({"op": "reply", "query": message["query"],
+                              "devices": self.app.historyDevices(message["req"])})
+        elif op == "profile":
+            self.outbox.send({"op": "reply", "query": message["query"],
+                              "profiling": self.app.profiler.control(message["req"])})
+        elif op == "stop":
+            self.report()
+            self.outbox.flush()
+            reactor.stop()
+
+    def report(self):
+        self.outbox.send({"op": "metrics", "snapshot": self.app.metrics.snapshot()})
+
+    def connectionLost(self, reason):
+        # The router has gone
+        if reactor.running:
+            reactor.stop()
+
+if __name__ == '__main__':
+    WorkerProcess(int(sys.argv[1]))
+    reactor.run()
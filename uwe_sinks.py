@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# uwe_sinks.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+Extra outputs that DataManager fans flushed batches out to, alongside Geras.
+Each sink has an encoder of its own, which it may downgrade by itself; a
+Batch is encoded once for each encoding asked of it, so outputs that use
+the same one share the bytes. Each sink has its own queue, batching, retry
+with backoff and a byte limit beyond which the oldest batches are dropped,
+so a slow or dead sink only ever holds up itself. Used from the reactor thread.
+"""
+ModuleName = "uwe_app"
+
+import os
+import json
+import time
+import gzip
+import logging
+from collections import deque
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
+
+class Batch:
+    """ One flushed batch of SenML records for a device ("" for a bulk batch), encoded on first use """
+    __slots__ = ("deviceID", "values", "_encoded")
+
+    def __init__(self, deviceID, values):
+        self.deviceID = deviceID
+        self.values = values
+        self._encoded = {}
+
+    def encoded(self, encoder):
+        """ (body, headers) as encoder encodes them; headers must not be changed by the caller """
+        key = encoder.key()
+        if key not in self._encoded:
+            self._encoded[key] = encoder.encode(self.values)
+        return self._encoded[key]
+
+class QueueSink:
+    """
+    Base class. Up to maxBatches queued batches are passed to write() at a
+    time, delay seconds after the first arrives. write() returns a Deferred
+    that fires with the batches that could not be written, if any, or fails
+    if none were. Those go back to the front of the queue and are tried
+    again after a backoff.
+    """
+    def __init__(self, name, encoder, maxBatches, delay, maxBytes, backoff, metrics):
+        self.name = name
+        self.encoder = encoder
+        self.maxBatches = maxBatches
+        self.delay = delay
+        self.maxBytes = maxBytes
+        self.backoff = backoff
+        self.metrics = metrics
+        self.queue = deque()
+        self.bytes = 0
+        # Encoded size of each batch held, as counted in bytes; the encoding may change before it is written
+        self.sizes = {}
+        self.inFlight = False
+        self.call = None
+        metrics.gauge("sink_" + name, lambda: {"batches": len(self.queue), "bytes": self.bytes})
+
+    def put(self, batch):
+        body, headers = batch.encoded(self.encoder)
+        self.queue.append(batch)
+        self.sizes[batch] = len(body)
+        self.bytes += len(body)
+        while self.bytes > self.maxBytes and len(self.queue) > 1:
+            dropped = self.queue.popleft()
+            self.bytes -= self.sizes.pop(dropped)
+            self.metrics.incr("sink_" + self.name + "_dropped")
+        self.schedule(0 if len(self.queue) >= self.maxBatches else self.delay)
+
+    def schedule(self, delay):
+        if self.inFlight or self.call is not None or not self.queue:
+            return
+        self.call = reactor.callLater(delay, self.send)
+
+    def send(self):
+        self.call = None
+        batches = []
+        while self.queue and len(batches) < self.maxBatches:
+            batches.append(self.queue.popleft())
+        self.inFlight = True
+        d = self.write(batches)
+        d.addCallbacks(self.written, self.failed, callbackArgs=(batches,), errbackArgs=(batches,))
+
+    def written(self, failed, batches):
+        self.inFlight = False
+        failed = failed or []
+        done = [b for b in batches if b not in failed]
+        self.bytes -= sum(self.sizes.pop(b) for b in done)
+        self.metrics.incr("sink_" + self.name + "_batches", len(done))
+        if failed:
+            self.retry(failed)
+            return
+        self.backoff.reset()
+        self.schedule(0 if len(self.queue) >= self.maxBatches else self.delay)
+
+    def failed(self, failure, batches):
+        self.inFlight = False
+        logging.debug("%s Sink %s write failed: %s", ModuleName, self.name, failure.getErrorMessage())
+        self.retry(batches)
+
+    def retry(self, batches):
+        self.metrics.incr("sink_" + self.name + "_failures")
+        self.queue.extendleft(reversed(batches))
+        self.schedule(self.backoff.next())
+
+    def write(self, batches):
+        raise NotImplementedError
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+class FileSink(QueueSink):
+    """
+    Local archive of rotating segment files, gzip compressed if compress.
+    Each batch is a JSON header line followed by the encoded body, as read
+    back by readArchive(). Files are written on a thread of the sink's own.
+    """
+    def __init__(self, directory, segmentBytes, segments, compress, *args):
+        QueueSink.__init__(self, "file", *args)
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.segments = segments
+        self.compress = compress
+        self.current = None
+        self.currentBytes = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.pool = ThreadPool(1, 1, "uwe_file_sink")
+        self.pool.start()
+
+    def frames(self, batches):
+        frames = []
+        for b in batches:
+            body, headers = b.encoded(self.encoder)
+            header = {"d": b.deviceID,
+                      "ts": round(time.time(), 3),
+                      "ct": headers.get("Content-Type", ""),
+                      "ce": headers.get("Content-Encoding", ""),
+                      "n": len(body)}
+            frames.append(json.dumps(header, separators=(",", ":")).encode("ascii") + b"\n" + body + b"\n")
+        return frames
+
+    def write(self, batches):
+        return threads.deferToThreadPool(reactor, self.pool, self._write, self.frames(batches))
+
+    def _write(self, frames):
+        if self.current is None or self.currentBytes >= self.segmentBytes:
+            self._rotate()
+        data = b"".join(frames)
+        if self.compress:
+            with gzip.open(self.current, "ab") as f:
+                f.write(data)
+        else:
+            with open(self.current, "ab") as f:
+                f.write(data)
+        self.currentBytes += len(data)
+
+    def _rotate(self):
+        suffix = ".seg.gz" if self.compress else ".seg"
+        self.current = os.path.join(self.directory, "uwe_%.3f%s" % (time.time(), suffix))
+        self.currentBytes = 0
+        old = sorted(f for f in os.listdir(self.directory) if f.startswith("uwe_") and ".seg" in f)
+        for f in old[:max(0, len(old) - self.segments + 1)]:
+            os.remove(os.path.join(self.directory, f))
+
+    def stop(self):
+        """ Write whatever is queued before the reactor goes away """
+        QueueSink.stop(self)
+        # Waits for a write in progress
+        self.pool.stop()
+        if self.queue:
+            try:
+                self._write(self.frames(self.queue))
+            except Exception as ex:
+                logging.warning("%s File sink cannot write on stop: %s", ModuleName, str(ex))
+            self.queue.clear()
+            self.sizes.clear()
+
+def readArchive(directory):
+    """ Yield (header, body) for every batch in a FileSink directory, oldest first """
+    for name in sorted(f for f in os.listdir(directory) if f.startswith("uwe_") and ".seg" in f):
+        path = os.path.join(directory, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                header = json.loads(line.decode("ascii"))
+                body = f.read(header["n"])
+                f.read(1)
+                yield header, body
+
+class BrokerSink(QueueSink):
+    """
+    Publishes each batch to a local broker's HTTP interface, on topic
+    uwe/<bridge>/<device>, through an uploader of its own.
+    """
+    def __init__(self, url, bridgeID, uploader, *args):
+        QueueSink.__init__(self, "broker", *args)
+        self.url = url
+        self.bridgeID = bridgeID
+        self.uploader = uploader
+
+    def write(self, batches):
+        return self.publish(batches).addCallback(self.check, batches)
+
+    def publish(self, batches):
+        """ Post each batch; fires with their statuses """
+        results = []
+        for b in batches:
+            body, headers = b.encoded(self.encoder)
+            d = defer.Deferred()
+            topic = "uwe/" + self.bridgeID + ("/" + b.deviceID if b.deviceID else "")
+            self.uploader.post(self.url + topic, body, headers,
+                               lambda status, latency, d=d: d.callback(status))
+            results.append(d)
+        return defer.DeferredList(results).addCallback(lambda statuses: [status for ok, status in statuses])
+
+    def check(self, statuses, batches):
+        refused = [b for b, status in zip(batches, statuses) if status == 415]
+        if refused and self.encoder.downgrade():
+            # The broker does not understand compact SenML or gzip; send those again at once
+            logging.info("%s Broker sink format not accepted, falling back to plain SenML", ModuleName)
+            def merge(again):
+                retried = dict(zip(refused, again))
+                return self.check([retried.get(b, status) for b, status in zip(batches, statuses)], batches)
+            return self.publish(refused).addCallback(merge)
+        failed = []
+        for b, status in zip(batches, statuses):
+            if 400 <= status < 500 and status not in (408, 429):
+                # The broker is up but will never accept this batch
+                logging.warning("%s Broker sink rejected a batch with status %s, dropping it", ModuleName, status)
+                self.metrics.incr("sink_" + self.name + "_rejected")
+            elif status != 200:
+                failed.append(b)
+        if failed and len(failed) == len(batches):
+            raise IOError("broker status %s" % statuses[0])
+        return failed
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# uwe_upload.py
+# Copyright (C) ContinuumBridge Limited, 2014-2015 - All Rights Reserved
+#
+"""
+HTTP uploaders used by DataManager to post readings to Geras.
+Both keep connections alive per host and cap the number of requests in flight.
+Results are always reported back on the reactor thread as
+callback(status, latency), where status is 0 if the request raised.
+"""
+ModuleName = "uwe_app"
+
+import time
+import random
+import logging
+import threading
+from io import BytesIO
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from twisted.internet import reactor, defer
+
+class UploadStats:
+    """ Running request count and latency figures for an uploader """
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.inFlight = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def record(self, status, latency):
+        self.requests += 1
+        if status != 200:
+            self.failures += 1
+        self.totalLatency += latency
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+
+    def summary(self):
+        mean = self.totalLatency/self.requests if self.requests else 0.0
+        return {"requests": self.requests,
+                "failures": self.failures,
+                "in_flight": self.inFlight,
+                "mean_latency": round(mean, 4),
+                "max_latency": round(self.maxLatency, 4)}
+
+class AgentUploader:
+    """
+    Non-blocking uploader on the reactor's own HTTP client. Connections are
+    pooled and kept alive per host; a semaphore caps concurrent requests.
+    """
+    def __init__(self, maxConcurrent, timeout):
+        from twisted.web.client import Agent, HTTPConnectionPool
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxConcurrent
+        self.pool.retryAutomatically = False
+        self.agent = Agent(reactor, pool=self.pool)
+        self.sem = defer.DeferredSemaphore(maxConcurrent)
+        self.timeout = timeout
+        self.stats = UploadStats()
+
+    def post(self, url, body, headers, callback):
+        self.sem.run(self._post, url, body, headers, callback)
+
+    def _post(self, url, body, headers, callback):
+        from twisted.web.client import FileBodyProducer, readBody
+        from twisted.web.http_headers import Headers
+        start = reactor.seconds()
+        self.stats.inFlight += 1
+        h = Headers()
+        for k, v in headers.items():
+            h.addRawHeader(k.encode("ascii"), v.encode("ascii"))
+        d = self.agent.request(b"POST", url.encode("ascii"), h, FileBodyProducer(BytesIO(body)))
+        # Read the body so that the connection goes back to the pool
+        d.addCallback(lambda response: readBody(response).addCallback(lambda _: response.code))
+        timeoutCall = reactor.callLater(self.timeout, d.cancel)
+        def cancelTimeout(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+            return result
+        d.addBoth(cancelTimeout)
+        d.addErrback(self._failed, url)
+        d.addCallback(self._done, start, callback)
+        return d
+
+    def _failed(self, failure, url):
+        logging.debug("%s AgentUploader post to %s failed: %s", ModuleName, url, failure.getErrorMessage())
+        return 0
+
+    def _done(self, status, start, callback):
+        latency = reactor.seconds() - start
+        self.stats.inFlight -= 1
+        self.stats.record(status, latency)
+        logging.debug("%s upload status: %s latency: %.3f", ModuleName, status, latency)
+        callback(status, latency)
+
+    def stop(self):
+        return self.pool.closeCachedConnections()
+
+class PoolUploader:
+    """
+    Bounded pool of worker threads, each with its own persistent
+    requests.Session, so posts never take threads from the reactor threadpool.
+    """
+    def __init__(self, maxConcurrent, timeout):
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.stats = UploadStats()
+        self.workers = []
+        for i in range(maxConcurrent):
+            t = threading.Thread(target=self._worker, name="uwe_upload_" + str(i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def post(self, url, body, headers, callback):
+        self.stats.inFlight += 1
+        self.queue.put((url, body, headers, callback))
+
+    def _worker(self):
+        import requests
+        session = requests.Session()
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            url, body, headers, callback = job
+            start = time.time()
+            try:
+                r = session.post(url, data=body, headers=headers, timeout=self.timeout)
+                status = r.status_code
+            except Exception as ex:
+                logging.debug("%s PoolUploader post to %s failed: %s", ModuleName, url, str(ex))
+                status = 0
+            reactor.callFromThread(self._done, status, time.time() - start, callback)
+        session.close()
+
+    def _done(self, status, latency, callback):
+        self.stats.inFlight -= 1
+        self.stats.record(status, latency)
+        logging.debug("%s upload status: %s latency: %.3f", ModuleName, status, latency)
+        callback(status, latency)
+
+    def stop(self):
+        for t in self.workers:
+            self.queue.put(None)
+
+def makeUploader(config, prefix=""):
+    """ Build the uploader selected by config["uploader"], sized by the prefix + upload_* keys """
+    maxConcurrent = config[prefix + "upload_max_concurrent"]
+    timeout = config[prefix + "upload_timeout"]
+    if config["uploader"] == "pool":
+        return PoolUploader(maxConcurrent, timeout)
+    return AgentUploader(maxConcurrent, timeout)
+
+class Backoff:
+    """ Exponential backoff with jitter: initial*2^n, capped, +/- jitter fraction """
+    def __init__(self, initial, maximum, jitter):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial*(2**self.attempts))
+        self.attempts += 1
+        return delay*(1 + random.uniform(-self.jitter, self.jitter))
+
+    def reset(self):
+        self.attempts = 0
+
+class CircuitBreaker:
+    """
+    closed:    requests flow; failureThreshold failures in a row open the breaker.
+    open:      nothing is sent until the backoff delay has passed.
+    half_open: a single probe request is allowed; success closes the breaker,
+               failure opens it again with a longer delay.
+    """
+    def __init__(self, failureThreshold, backoff):
+        self.failureThreshold = failureThreshold
+        self.backoff = backoff
+        self.state = "closed"
+        self.failures = 0
+        self.openUntil = 0
+        self.probing = False
+        self.opened = 0
+
+    def allow(self):
+        """ True if a request may be sent now. In half_open only one is let through """
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if reactor.seconds() < self.openUntil:
+                return False
+            self.state = "half_open"
+            self.probing = False
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def probeDue(self):
+        """ True if allow() would let a probe through now, without taking it """
+        if self.state == "open":
+            return reactor.seconds() >= self.openUntil
+        return self.state == "half_open" and not self.probing
+
+    def record(self, success):
+        if success:
+            if self.state != "closed":
+                logging.info("%s Upload endpoint healthy again, circuit closed", ModuleName)
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+            self.backoff.reset()
+            return
+        self.failures += 1
+        if self.state == "open":
+            # A request sent before the breaker opened; the delay already covers it
+            return
+        if self.state == "half_open" or self.failures >= self.failureThreshold:
+            delay = self.backoff.next()
+            if self.state == "closed":
+                self.opened += 1
+                logging.warning("%s Upload endpoint failing, circuit open for %.1f s", ModuleName, delay)
+            self.state = "open"
+            self.openUntil = reactor.seconds() + delay
+            self.probing = False
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of new requests, plus a small steady allowance,
+    so that resending a backlog cannot swamp a recovering endpoint.
+    """
+    def __init__(self, ratio, minPerSecond, maxTokens=10.0):
+        self.ratio = ratio
+        self.minPerSecond = minPerSecond
+        self.maxTokens = maxTokens
+        self.tokens = maxTokens
+        self.last = reactor.seconds()
+
+    def _refill(self):
+        now = reactor.seconds()
+        self.tokens = min(self.maxTokens, self.tokens + (now - self.last)*self.minPerSecond)
+        self.last = now
+
+    def deposit(self):
+        """ Called for every new (non-retry) request """
+        self.tokens = min(self.maxTokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """ True if a retry may be sent """
+        self._refill()
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False